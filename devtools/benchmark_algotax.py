@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Time algotax.color_clades and algotax.walk on the trees drawn in
+tests/algotax_graphs and on random trees with colored leaves. Use as:
+
+    python devtools/benchmark_algotax.py --sizes 1000,10000 --block-size 20
+
+Random trees are built by joining adjacent subtrees, with leaves
+colored in contiguous blocks of --block-size leaves and a fraction
+(--noise) given the color of a neighboring block; a caterpillar tree
+of each size is included to exercise deep trees. Note that the
+solution is exponential in the number of colors cut by each clade, so
+leaves recolored at random quickly make the problem intractable.
+"""
+
+import argparse
+import glob
+import os
+import random
+import re
+import time
+
+from Bio.Phylo.BaseTree import Tree, Clade
+
+from taxtastic import algotax
+
+graphs = os.path.join(os.path.dirname(__file__), '..', 'tests', 'algotax_graphs')
+
+def read_dot(fname):
+    """
+    Returns (tree, colors) for a graph in tests/algotax_graphs, with
+    leaves colored by their fill color.
+    """
+
+    with open(fname) as f:
+        text = f.read()
+    fills = {}
+    for color, names in re.findall(r'\{\s*node\s*\[fillcolor="([^"]+)"\]([^}]*)\}', text):
+        fills.update((name, color) for name in names.split())
+    nodes = {}
+    children = set()
+    for parent, child in re.findall(r'(\w+)\s*->\s*(\w+)', text):
+        for name in [parent, child]:
+            nodes.setdefault(name, Clade(name=name))
+        if child not in children:
+            nodes[parent].clades.append(nodes[child])
+            children.add(child)
+    root, = [node for name, node in nodes.iteritems() if name not in children]
+    colors = dict((node, fills[name]) for name, node in nodes.iteritems()
+                  if not node.clades and name in fills)
+    return Tree(root=root, rooted=True), colors
+
+def random_tree(leaves, block, noise, caterpillar=False):
+    nodes = [Clade(name=str(i)) for i in xrange(leaves)]
+    ncolors = max(1, leaves // block)
+    colors = {}
+    for i, node in enumerate(nodes):
+        colors[node] = min(i // block, ncolors - 1)
+        if random.random() < noise:
+            # misplaced leaves take the color of a neighboring block
+            colors[node] = max(0, min(ncolors - 1, colors[node] + random.choice([-1, 1])))
+    if caterpillar:
+        root = nodes[0]
+        for node in nodes[1:]:
+            root = Clade(clades=[root, node])
+        return Tree(root=root, rooted=True), colors
+    while len(nodes) > 1:
+        i = random.randrange(len(nodes) - 1)
+        nodes[i:i + 2] = [Clade(clades=nodes[i:i + 2])]
+    return Tree(root=nodes[0], rooted=True), colors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-s', '--sizes', default='100,1000,10000',
+        help='comma-delimited numbers of leaves in random trees [%(default)s]')
+    parser.add_argument('-b', '--block-size', type=int, default=20,
+        help='number of leaves of each color in random trees [%(default)s]')
+    parser.add_argument('--noise', type=float, default=0.01,
+        help='fraction of leaves colored at random [%(default)s]')
+    a = parser.parse_args()
+
+    random.seed(1)
+    trees = [(os.path.basename(fname), read_dot(fname))
+             for fname in sorted(glob.glob(os.path.join(graphs, 'clade_coloring*.dot')))]
+    for size in [int(n) for n in a.sizes.split(',')]:
+        trees.append(('random %i' % size, random_tree(size, a.block_size, a.noise)))
+        trees.append(('caterpillar %i' % size,
+                      random_tree(size, a.block_size, a.noise, caterpillar=True)))
+
+    print '%-22s %8s %16s %10s %8s' % ('tree', 'leaves', 'color_clades ms', 'walk ms', 'kept')
+    for label, (tree, colors) in trees:
+        start = time.time()
+        metadata = algotax.color_clades(tree, colors)
+        colored = time.time()
+        kept = algotax.walk(tree.root, metadata)
+        walked = time.time()
+        print '%-22s %8i %16.1f %10.1f %8i' % (
+            label, len(colors), 1e3 * (colored - start),
+            1e3 * (walked - colored), len(kept))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Compare the time taken by algotax.color_clades and by its original
+implementation on random and caterpillar trees. Use as:
+
+    python devtools/benchmark_color_clades.py --sizes 1000,10000 --repeat 20
+
+Trees are built as in benchmark_algotax.py. The implementations are run
+alternately and the minimum and median of --repeat runs are reported; the
+original implementation is skipped for caterpillar trees larger than
+--max-deep leaves, since its running time grows with the square of the
+depth of the tree.
+"""
+
+import argparse
+import collections
+import gc
+import itertools
+import random
+import time
+
+from taxtastic import algotax
+
+from benchmark_algotax import random_tree
+
+def original_color_clades(tree, colors):
+    """The original implementation of algotax.color_clades."""
+
+    parents = {tree.root: None}
+    cut_colors = collections.defaultdict(set)
+    stack = [('down', tree.root, None)]
+    while stack:
+        phase, cur, color = stack.pop()
+        if phase == 'down':
+            if not cur.clades:
+                if cur not in colors:
+                    continue
+                stack.append(('up', cur, colors[cur]))
+            else:
+                for child in cur.clades:
+                    parents[child] = cur
+                    stack.append(('down', child, None))
+        elif phase == 'up':
+            if cur is None or color in cut_colors[cur]:
+                continue
+            cut_colors[cur].add(color)
+            stack.append(('up', parents[cur], color))
+
+    stack = [(tree.root, set())]
+    while stack:
+        node, okayed = stack.pop()
+        if not node.clades:
+            continue
+        okayed = algotax.union(cut_colors[a] & cut_colors[b]
+            for a, b in itertools.combinations(node.clades, 2)) | okayed
+        for e in node.clades:
+            e_ = cut_colors[e] & okayed
+            if e_ != cut_colors[e]:
+                stack.append((e, okayed))
+                cut_colors[e] = e_
+
+    return algotax.CladeMetadata(parents, colors, cut_colors)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-s', '--sizes', default='1000,10000',
+        help='comma-delimited numbers of leaves in random trees [%(default)s]')
+    parser.add_argument('-b', '--block-size', type=int, default=20,
+        help='number of leaves of each color [%(default)s]')
+    parser.add_argument('--noise', type=float, default=0.01,
+        help='fraction of leaves colored at random [%(default)s]')
+    parser.add_argument('-r', '--repeat', type=int, default=20,
+        help='number of times to run each implementation [%(default)s]')
+    parser.add_argument('--max-deep', type=int, default=2000,
+        help="""largest caterpillar tree on which to run the original
+        implementation [%(default)s]""")
+    a = parser.parse_args()
+
+    random.seed(1)
+    print '%-18s %-10s %10s %10s' % ('tree', 'version', 'min ms', 'median ms')
+    for size in [int(n) for n in a.sizes.split(',')]:
+        for label, caterpillar in [('random', False), ('caterpillar', True)]:
+            tree, colors = random_tree(size, a.block_size, a.noise, caterpillar)
+            funcs = [('current', algotax.color_clades)]
+            if not caterpillar or size <= a.max_deep:
+                funcs.append(('original', original_color_clades))
+            times = collections.defaultdict(list)
+            for i in xrange(a.repeat):
+                for version, func in funcs:
+                    gc.collect()
+                    start = time.time()
+                    func(tree, colors)
+                    times[version].append(time.time() - start)
+            for version, func in funcs:
+                elapsed = sorted(times[version])
+                print '%-18s %-10s %10.1f %10.1f' % (
+                    '%s %i' % (label, size), version,
+                    1e3 * elapsed[0], 1e3 * elapsed[len(elapsed) // 2])
+
+if __name__ == '__main__':
+    main()
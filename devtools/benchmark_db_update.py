@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Compare the time taken to update an on-disk taxonomy database from a
+newer taxdmp.zip using ncbi.db_update against rebuilding it from
+scratch as taxit new_database does. Use as:
+
+    python devtools/benchmark_db_update.py --nodes 2500000 --changes 0.005
+
+Two random archives are generated: the first with --nodes nodes, and
+the second with a fraction --changes of the nodes moved, renamed,
+added or deleted (and merged into their parent). A database is loaded
+from the first archive and then updated using the second; the update
+using the first archive again (no changes) is timed as well. Use
+--lineages and --hierarchy to include the corresponding tables, which
+db_update rebuilds when the nodes change.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+from taxtastic import ncbi
+
+ranks = ['no rank', 'superkingdom', 'phylum', 'class', 'order', 'family',
+         'genus', 'species']
+
+def synthetic_rows(size, seed=1):
+    """
+    Return (nodes, names, merged) for a random taxonomy with `size`
+    nodes, each with a scientific name and a synonym, as lists of
+    lists of fields of the corresponding dump files. Parents have
+    smaller tax_ids than their children.
+    """
+
+    random.seed(seed)
+    nodes = [['1', '1', 'no rank']]
+    depth = {'1': 0}
+    internal = ['1']
+    for i in xrange(2, size + 1):
+        tax_id, parent_id = str(i), random.choice(internal)
+        depth[tax_id] = min(depth[parent_id] + 1, len(ranks) - 1)
+        if depth[tax_id] < len(ranks) - 1:
+            internal.append(tax_id)
+        nodes.append([tax_id, parent_id, ranks[depth[tax_id]]])
+    names = []
+    for tax_id, _, _ in nodes:
+        names.append([tax_id, 'taxon %s' % tax_id, '', 'scientific name'])
+        names.append([tax_id, 'synonym %s' % tax_id, '', 'synonym'])
+    names[0][1] = 'root'
+    merged = [[str(size + i), str(random.randint(1, size))]
+              for i in xrange(1, size // 20)]
+    return nodes, names, merged
+
+def perturb(nodes, names, merged, fraction, seed=2):
+    """
+    Return copies of (nodes, names, merged) in which a fraction of
+    the nodes is changed: a quarter each are given a new parent
+    (with a smaller tax_id), renamed, added, or deleted and merged
+    into their parent.
+    """
+
+    random.seed(seed)
+    nodes = [list(row) for row in nodes]
+    names = [list(row) for row in names]
+    merged = [list(row) for row in merged]
+    n = max(1, int(len(nodes) * fraction / 4))
+    is_internal = set(parent_id for _, parent_id, _ in nodes)
+    leaves = [i for i, row in enumerate(nodes) if row[0] not in is_internal]
+
+    for i in random.sample(xrange(1, len(nodes)), n):
+        tax_id = int(nodes[i][0])
+        while True:
+            parent = nodes[random.randint(0, tax_id - 2)]
+            if parent[2] != ranks[-1]:
+                break
+        nodes[i][1] = parent[0]
+
+    by_tax_id = dict((row[0], i) for i, row in enumerate(names)
+                     if row[3] == 'scientific name')
+    for tax_id in random.sample(sorted(by_tax_id), n):
+        names[by_tax_id[tax_id]][1] = 'renamed %s' % tax_id
+
+    last = max(int(row[0]) for row in nodes + merged)
+    internal = [row[0] for row in nodes if row[2] != ranks[-1]]
+    for i in xrange(last + 1, last + n + 1):
+        nodes.append([str(i), random.choice(internal), ranks[-1]])
+        names.append([str(i), 'taxon %s' % i, '', 'scientific name'])
+
+    deleted = dict((nodes[i][0], nodes[i][1]) for i in random.sample(leaves, n))
+    nodes = [row for row in nodes if row[0] not in deleted]
+    names = [row for row in names if row[0] not in deleted]
+    merged.extend([tax_id, parent_id] for tax_id, parent_id in deleted.iteritems())
+    return nodes, names, merged
+
+def write_archive(dest, nodes, names, merged):
+    """
+    Write rows to the zip archive `dest` in the format of taxdmp.zip.
+    """
+
+    # nodes.dmp has 13 columns, of which 5 are used
+    def node_line(row):
+        tax_id, parent_id, rank = row
+        return [tax_id, parent_id, rank, '', '0'] + ['0'] * 7 + ['']
+
+    with zipfile.ZipFile(dest, 'w', zipfile.ZIP_DEFLATED) as out:
+        for fname, rows in [('nodes.dmp', (node_line(row) for row in nodes)),
+                            ('names.dmp', names),
+                            ('merged.dmp', merged)]:
+            out.writestr(fname, ''.join(
+                    '\t|\t'.join(row) + '\t|\n' for row in rows))
+
+def full_rebuild(dbname, archive, lineages, hierarchy):
+    con = ncbi.db_connect(dbname, schema=ncbi.db_tables, clobber=True)
+    ncbi.db_load(con, archive, bulk=True)
+    if lineages:
+        ncbi.db_lineages(con)
+    if hierarchy:
+        ncbi.db_hierarchy(con)
+    con.close()
+
+def update(dbname, archive):
+    con = sqlite3.connect(dbname)
+    counts = ncbi.db_update(con, archive)
+    con.close()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--nodes', type=int, default=2500000,
+        help='number of nodes in the first archive [%(default)s]')
+    parser.add_argument('-c', '--changes', type=float, default=0.005,
+        help='fraction of the nodes changed in the second archive [%(default)s]')
+    parser.add_argument('--lineages', action='store_true', default=False,
+        help='include table "lineages"')
+    parser.add_argument('--hierarchy', action='store_true', default=False,
+        help='include table "hierarchy"')
+    parser.add_argument('--tmpdir',
+        help='directory in which to create files (must have space for 3 copies of the database)')
+    a = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(dir=a.tmpdir)
+    try:
+        old_zip = os.path.join(tmpdir, 'old.zip')
+        new_zip = os.path.join(tmpdir, 'new.zip')
+        rows = synthetic_rows(a.nodes)
+        write_archive(old_zip, *rows)
+        write_archive(new_zip, *perturb(*(rows + (a.changes,))))
+        del rows
+
+        old_db = os.path.join(tmpdir, 'old.db')
+        full_rebuild(old_db, old_zip, a.lineages, a.hierarchy)
+        print 'database: %.0f MB' % (os.path.getsize(old_db) / 2.0 ** 20)
+
+        print '%-22s %10s %s' % ('method', 'seconds', 'rows changed')
+        dbname = os.path.join(tmpdir, 'taxonomy.db')
+        for method, archive in [('full rebuild', new_zip),
+                                ('update (no changes)', old_zip),
+                                ('update', new_zip)]:
+            shutil.copy(old_db, dbname)
+            start = time.time()
+            if method == 'full rebuild':
+                full_rebuild(dbname, archive, a.lineages, a.hierarchy)
+                changed = '-'
+            else:
+                counts = update(dbname, archive)
+                changed = ', '.join(
+                    '%s %s' % (tablename, sum(counts[tablename].values()))
+                    for tablename, _ in ncbi.dmp_tables)
+            print '%-22s %10.2f %s' % (method, time.time() - start, changed)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
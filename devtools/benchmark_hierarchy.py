@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Report the time needed to build table "hierarchy" (see
+ncbi.db_hierarchy), and compare the latency of Taxonomy.is_ancestor_of
+and Taxonomy.descendants with and without it. Use as:
+
+    python devtools/benchmark_hierarchy.py -d ncbi_taxonomy.db
+
+or, using a random taxonomy with N nodes (see benchmark_schema.py):
+
+    python devtools/benchmark_hierarchy.py --synthetic 1000000
+
+Note that table "hierarchy" is added to the database if absent.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import sqlalchemy
+
+from taxtastic import ncbi
+from taxtastic.taxonomy import Taxonomy
+
+from benchmark_schema import synthetic_taxonomy
+
+def timeit(func, args):
+    start = time.time()
+    for arg in args:
+        func(*arg)
+    return 1e6 * (time.time() - start) / len(args)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('-d', '--database-file',
+        help='taxonomy database')
+    input_group.add_argument('--synthetic', type=int, metavar='N',
+        help='generate a random taxonomy with N nodes')
+    parser.add_argument('-n', '--lookups', type=int, default=1000,
+        help='number of lookups to time [%(default)s]')
+    a = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dbname = a.database_file
+        if a.synthetic:
+            dbname = os.path.join(tmpdir, 'taxonomy.db')
+            synthetic_taxonomy(dbname, a.synthetic).close()
+
+        con = sqlite3.connect(dbname)
+        if not ncbi.has_hierarchy(con):
+            start = time.time()
+            ncbi.db_hierarchy(con)
+            print 'build hierarchy: %.2f s' % (time.time() - start)
+        tax_ids = [str(tax_id) for tax_id, in con.execute('SELECT tax_id FROM nodes')]
+        # internal nodes at a range of depths
+        parents = [str(tax_id) for tax_id, in con.execute(
+                """SELECT tax_id FROM nodes WHERE rank IN ('phylum', 'class', 'order')""")]
+        con.close()
+        random.seed(1)
+        pairs = zip(random.sample(tax_ids, a.lookups), random.sample(tax_ids, a.lookups))
+        parents = [(p,) for p in random.sample(parents, min(100, len(parents)))]
+        del tax_ids
+
+        engine = sqlalchemy.create_engine('sqlite:///%s' % dbname)
+        print '%-20s %14s %14s' % ('method', 'walk us', 'hierarchy us')
+        for method, args in [('is_ancestor_of', pairs), ('descendants', parents)]:
+            timings = []
+            for hierarchy in [False, True]:
+                tax = Taxonomy(engine, list(ncbi.ranks))
+                if not hierarchy:
+                    tax.hierarchy = None
+                timings.append(timeit(getattr(tax, method), args))
+            print '%-20s %14.1f %14.1f' % tuple([method] + timings)
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Compare the per-tax_id cost of Taxonomy.lineage with that of
+Taxonomy.lineages for increasing numbers of tax_ids. Use as:
+
+    python devtools/benchmark_lineages.py -d ncbi_taxonomy.db
+
+or, using a random taxonomy with N nodes (see benchmark_schema.py):
+
+    python devtools/benchmark_lineages.py --synthetic 1000000
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import sqlalchemy
+
+from taxtastic import ncbi
+from taxtastic.taxonomy import Taxonomy
+
+from benchmark_schema import synthetic_taxonomy
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('-d', '--database-file',
+        help='taxonomy database')
+    input_group.add_argument('--synthetic', type=int, metavar='N',
+        help='generate a random taxonomy with N nodes')
+    parser.add_argument('-b', '--batch-sizes', default='1,10,100,1000,10000',
+        help='comma-delimited numbers of tax_ids [%(default)s]')
+    a = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dbname = a.database_file
+        if a.synthetic:
+            dbname = os.path.join(tmpdir, 'taxonomy.db')
+            synthetic_taxonomy(dbname, a.synthetic).close()
+
+        con = sqlite3.connect(dbname)
+        tax_ids = [str(tax_id) for tax_id, in con.execute('SELECT tax_id FROM nodes')]
+        con.close()
+
+        engine = sqlalchemy.create_engine('sqlite:///%s' % dbname)
+        random.seed(1)
+        print '%10s %14s %14s' % ('tax_ids', 'lineage us/id', 'lineages us/id')
+        for size in [int(n) for n in a.batch_sizes.split(',')]:
+            batch = random.sample(tax_ids, size)
+            timings = []
+            for method in ['lineage', 'lineages']:
+                # start with an empty cache
+                tax = Taxonomy(engine, list(ncbi.ranks))
+                start = time.time()
+                if method == 'lineage':
+                    for tax_id in batch:
+                        tax.lineage(tax_id)
+                else:
+                    tax.lineages(batch)
+                timings.append(1e6 * (time.time() - start) / size)
+            print '%10i %14.1f %14.1f' % tuple([size] + timings)
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
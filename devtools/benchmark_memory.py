@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Report the load time and memory use of MemoryTaxonomy, and compare
+its lookup latency with that of Taxonomy. Use as:
+
+    python devtools/benchmark_memory.py -d ncbi_taxonomy.db
+
+or, using a random taxonomy with N nodes (see benchmark_schema.py):
+
+    python devtools/benchmark_memory.py --synthetic 1000000
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import sqlalchemy
+
+from taxtastic import ncbi
+from taxtastic.taxonomy import Taxonomy, MemoryTaxonomy
+
+from benchmark_schema import synthetic_taxonomy
+
+def maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _load(queue, dbname):
+    engine = sqlalchemy.create_engine('sqlite:///%s' % dbname)
+    rss, start = maxrss(), time.time()
+    MemoryTaxonomy(engine, list(ncbi.ranks))
+    queue.put((time.time() - start, maxrss() - rss))
+
+def load(dbname):
+    """
+    Returns (seconds, kB) used to load MemoryTaxonomy in a separate
+    process, so that the increase in peak RSS is not masked by
+    earlier allocations.
+    """
+
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_load, args=(queue, dbname))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+def timeit(func, args):
+    start = time.time()
+    for arg in args:
+        func(arg)
+    return 1e6 * (time.time() - start) / len(args)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('-d', '--database-file',
+        help='taxonomy database')
+    input_group.add_argument('--synthetic', type=int, metavar='N',
+        help='generate a random taxonomy with N nodes')
+    parser.add_argument('-n', '--lookups', type=int, default=1000,
+        help='number of lookups to time [%(default)s]')
+    a = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dbname = a.database_file
+        if a.synthetic:
+            dbname = os.path.join(tmpdir, 'taxonomy.db')
+            synthetic_taxonomy(dbname, a.synthetic).close()
+
+        con = sqlite3.connect(dbname)
+        tax_ids = [str(tax_id) for tax_id, in con.execute('SELECT tax_id FROM nodes')]
+        names = [name for name, in con.execute(
+                'SELECT tax_name FROM names WHERE is_primary = 1')]
+        con.close()
+        random.seed(1)
+        ids = random.sample(tax_ids, a.lookups)
+        names = random.sample(names, a.lookups)
+        del tax_ids
+
+        print 'load: %.2f s; peak RSS increased by %i kB' % load(dbname)
+
+        engine = sqlalchemy.create_engine('sqlite:///%s' % dbname)
+        tax = Taxonomy(engine, list(ncbi.ranks))
+        mem = MemoryTaxonomy(engine, list(ncbi.ranks))
+
+        print '%-20s %14s %14s' % ('method', 'Taxonomy us', 'Memory us')
+        for method, args in [('_node', ids), ('primary_from_id', ids),
+                             ('primary_from_name', names), ('lineage', ids)]:
+            timings = []
+            for t in [tax, mem]:
+                t.cached.clear()
+                timings.append(timeit(getattr(t, method), args))
+            print '%-20s %14.1f %14.1f' % tuple([method] + timings)
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
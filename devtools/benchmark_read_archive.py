@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Compare peak memory use of reading the NCBI taxonomy dump with
+ncbi.read_archive against reading each file into memory in one go.
+
+Each measurement runs in a separate process so that peak RSS values
+are independent. Use as:
+
+    python devtools/benchmark_read_archive.py testfiles/taxdmp.zip --scale 10
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+import zipfile
+
+from taxtastic import ncbi
+
+dmp_files = ['nodes.dmp', 'names.dmp', 'merged.dmp']
+
+def scale_archive(archive, dest, scale):
+    """
+    Write a copy of `archive` to `dest` in which nodes, names and
+    merged contain `scale` copies of the original rows, each with
+    tax_ids shifted by a constant offset.
+    """
+
+    src = zipfile.ZipFile(archive)
+    out = zipfile.ZipFile(dest, 'w', zipfile.ZIP_DEFLATED)
+
+    offset = 10 ** 7
+    # columns containing tax_ids in each file
+    id_cols = {'nodes.dmp': (0, 1), 'names.dmp': (0,), 'merged.dmp': (0, 1)}
+
+    for fname in dmp_files:
+        lines = src.read(fname).splitlines()
+        scaled = []
+        for i in xrange(scale):
+            for line in lines:
+                fields = line.split('\t|\t')
+                for col in id_cols[fname]:
+                    fields[col] = str(int(fields[col].rstrip('\t|')) + i * offset)
+                scaled.append('\t|\t'.join(fields))
+        out.writestr(fname, '\n'.join(scaled) + '\n')
+
+    out.close()
+    src.close()
+
+def read_whole(archive, fname):
+    """The previous implementation of ncbi.read_archive."""
+
+    zfile = zipfile.ZipFile(archive, 'r')
+    for line in zfile.read(fname).splitlines():
+        yield line.rstrip('\t|\n').split('\t|\t')
+
+def run_reader(reader, archive):
+    nrows = 0
+    for fname in dmp_files:
+        for row in reader(archive, fname):
+            nrows += 1
+    return nrows
+
+def run_db_load(archive):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        con = ncbi.db_connect(os.path.join(tmpdir, 'taxonomy.db'))
+        ncbi.db_load(con, archive)
+        con.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return None
+
+def _measure(queue, func, args):
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((result, elapsed, maxrss))
+
+def measure(func, *args):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure, args=(queue, func, args))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('archive', help='path to taxdmp.zip')
+    parser.add_argument('-s', '--scale', type=int, default=10,
+        help='number of copies of each dump file in the synthetic archive [%(default)s]')
+    a = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        scaled = os.path.join(tmpdir, 'taxdmp_x%s.zip' % a.scale)
+        scale_archive(a.archive, scaled, a.scale)
+
+        print '%-22s %-16s %10s %10s %14s' % (
+            'archive', 'method', 'rows', 'seconds', 'peak RSS (kB)')
+        for label, archive in [('original', a.archive),
+                               ('x%s' % a.scale, scaled)]:
+            for method, func, args in [
+                ('read whole file', run_reader, (read_whole, archive)),
+                ('read_archive', run_reader, (ncbi.read_archive, archive)),
+                ('db_load', run_db_load, (archive,))]:
+                nrows, elapsed, maxrss = measure(func, *args)
+                print '%-22s %-16s %10s %10.3f %14s' % (
+                    label, method, nrows if nrows is not None else '-',
+                    elapsed, maxrss)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
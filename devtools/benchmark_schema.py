@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Compare database size and lookup latency of the "text" and "integer"
+taxonomy database schemas (see ncbi.db_schemas). Node and name lookups
+are timed using sqlite3 directly; _node and lineage using Taxonomy.
+
+The taxonomy is copied from an existing database (eg, one created by
+`taxit new_database`) into each schema using ncbi.db_convert:
+
+    python devtools/benchmark_schema.py -d ncbi_taxonomy.db
+
+Alternatively, generate a random taxonomy with N nodes:
+
+    python devtools/benchmark_schema.py --synthetic 1000000
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import sqlalchemy
+
+from taxtastic import ncbi
+from taxtastic.taxonomy import Taxonomy
+
+def synthetic_taxonomy(dbname, size, seed=1):
+    """
+    Create a database containing a random taxonomy with `size` nodes,
+    each with a primary name and a synonym.
+    """
+
+    random.seed(seed)
+    ranks = ['root', 'superkingdom', 'phylum', 'class', 'order', 'family',
+             'genus', 'species']
+    con = ncbi.db_connect(dbname, schema=ncbi.db_tables, clobber=True)
+    nodes = [('1', '1', 'root', '', 0, 1)]
+    names = [('1', 'root', '', 'scientific name', 1)]
+    depth = {'1': 0}
+    internal = ['1']
+    for i in xrange(2, size + 1):
+        # parents are chosen uniformly, so depth grows as log(size)
+        tax_id, parent_id = str(i), random.choice(internal)
+        # some nodes have no rank, as in the NCBI taxonomy
+        if random.random() < 0.1:
+            rank = 'no_rank'
+            depth[tax_id] = depth[parent_id]
+        else:
+            depth[tax_id] = min(depth[parent_id] + 1, len(ranks) - 1)
+            rank = ranks[depth[tax_id]]
+        if rank != 'species':
+            internal.append(tax_id)
+        nodes.append((tax_id, parent_id, rank, '', 0, 1))
+        names.append((tax_id, 'taxon %s' % tax_id, '', 'scientific name', 1))
+        names.append((tax_id, 'synonym %s' % tax_id, '', 'synonym', 0))
+    ncbi.do_insert(con, 'nodes', iter(nodes))
+    ncbi.do_insert(con, 'names', iter(names))
+    ncbi.db_index(con)
+    return con
+
+def timeit(func, args):
+    start = time.time()
+    for arg in args:
+        func(arg)
+    return 1e6 * (time.time() - start) / len(args)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('-d', '--database-file',
+        help='taxonomy database to copy')
+    input_group.add_argument('--synthetic', type=int, metavar='N',
+        help='generate a random taxonomy with N nodes')
+    parser.add_argument('-n', '--lookups', type=int, default=10000,
+        help='number of lookups to time [%(default)s]')
+    a = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if a.database_file:
+            con = sqlite3.connect(a.database_file)
+        else:
+            con = synthetic_taxonomy(os.path.join(tmpdir, 'source.db'), a.synthetic)
+
+        cur = con.cursor()
+        cur.execute('SELECT tax_id FROM nodes')
+        tax_ids = [str(tax_id) for tax_id, in cur.fetchall()]
+        cur.execute('SELECT tax_name FROM names')
+        tax_names = [tax_name for tax_name, in cur.fetchall()]
+        random.seed(1)
+        ids = [random.choice(tax_ids) for i in xrange(a.lookups)]
+        names = [random.choice(tax_names) for i in xrange(a.lookups)]
+
+        print '%-8s %10s %12s %10s %10s %10s %12s' % (
+            'schema', 'convert s', 'size (kB)', 'node us', 'name us',
+            '_node us', 'lineage us')
+        for schema in ['text', 'integer']:
+            dbname = os.path.join(tmpdir, '%s.db' % schema)
+            start = time.time()
+            ncbi.db_convert(con, dbname, schema=schema).close()
+            elapsed = time.time() - start
+
+            # lookups using sqlite3 directly measure the effect of the
+            # schema without the overhead of sqlalchemy
+            new_con = sqlite3.connect(dbname)
+            node_us = timeit(lambda tax_id: new_con.execute(
+                    'SELECT parent_id, rank FROM nodes WHERE tax_id = ?',
+                    (tax_id,)).fetchone(), ids)
+            name_us = timeit(lambda tax_name: new_con.execute(
+                    'SELECT tax_id, is_primary FROM names WHERE tax_name = ?',
+                    (tax_name,)).fetchone(), names)
+            new_con.close()
+
+            engine = sqlalchemy.create_engine('sqlite:///%s' % dbname)
+            tax = Taxonomy(engine, list(ncbi.ranks))
+            taxonomy_us = timeit(tax._node, ids[:a.lookups / 10])
+            # clear the cache before each lookup
+            def lineage(tax_id):
+                tax.cached.clear()
+                tax.lineage(tax_id)
+            lineage_us = timeit(lineage, ids[:a.lookups / 10])
+            engine.dispose()
+
+            print '%-8s %10.2f %12i %10.1f %10.1f %10.1f %12.1f' % (
+                schema, elapsed, os.path.getsize(dbname) / 1024,
+                node_us, name_us, taxonomy_us, lineage_us)
+        con.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
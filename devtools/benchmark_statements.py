@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Count the SQL statements issued by Taxonomy.lineage per tax_id, for
+lookups starting with an empty lineage cache and for repeated
+lookups. Use as:
+
+    python devtools/benchmark_statements.py -d ncbi_taxonomy.db
+
+or, using a random taxonomy with N nodes (see benchmark_schema.py):
+
+    python devtools/benchmark_statements.py --synthetic 100000
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy import event
+
+from taxtastic import ncbi
+from taxtastic.taxonomy import Taxonomy
+
+from benchmark_schema import synthetic_taxonomy
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('-d', '--database-file',
+        help='taxonomy database')
+    input_group.add_argument('--synthetic', type=int, metavar='N',
+        help='generate a random taxonomy with N nodes')
+    parser.add_argument('-n', '--lookups', type=int, default=1000,
+        help='number of tax_ids to look up [%(default)s]')
+    a = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dbname = a.database_file
+        if a.synthetic:
+            dbname = os.path.join(tmpdir, 'taxonomy.db')
+            synthetic_taxonomy(dbname, a.synthetic).close()
+
+        con = sqlite3.connect(dbname)
+        tax_ids = [str(tax_id) for tax_id, in con.execute('SELECT tax_id FROM nodes')]
+        con.close()
+        random.seed(1)
+        ids = random.sample(tax_ids, a.lookups)
+
+        engine = sqlalchemy.create_engine('sqlite:///%s' % dbname)
+        statements = []
+        event.listen(engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+
+        tax = Taxonomy(engine, list(ncbi.ranks))
+        print '%-22s %14s %12s %10s' % ('lookup', 'statements/id', 'merged/id', 'us/id')
+        for label, clear in [('empty cache', True), ('cached lineages', False)]:
+            del statements[:]
+            start = time.time()
+            for tax_id in ids:
+                if clear:
+                    tax.cached.clear()
+                tax.lineage(tax_id)
+            elapsed = time.time() - start
+            merged = [s for s in statements if 'merged' in s]
+            print '%-22s %14.1f %12.1f %10.1f' % (
+                label, float(len(statements)) / len(ids),
+                float(len(merged)) / len(ids), 1e6 * elapsed / len(ids))
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
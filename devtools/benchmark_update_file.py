@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Compare the time taken to insert a large alignment into a refpkg by
+hashing and then copying it, by hashing while copying, and by hard
+linking it.
+
+The file cache is dropped between measurements only if run as root
+with --drop-caches; otherwise repeated reads may be served from memory.
+Use as:
+
+    python devtools/benchmark_update_file.py --size 4 --tmpdir /data/tmp
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from taxtastic import refpkg
+
+def write_alignment(path, size):
+    """
+    Write a FASTA alignment of about `size` bytes to `path`, with lines
+    of 80 residues.
+    """
+
+    line = ('ACGT-' * 16) + '\n'
+    seq = line * 1250
+    written, i = 0, 0
+    with open(path, 'w') as h:
+        while written < size:
+            record = '>seq%d\n%s' % (i, seq)
+            h.write(record)
+            written += len(record)
+            i += 1
+
+def drop_caches():
+    with open('/proc/sys/vm/drop_caches', 'w') as h:
+        h.write('3\n')
+
+def hash_then_copy(src, dest):
+    """The previous implementation of Refpkg.update_file."""
+
+    md5_value = refpkg.md5file(src)
+    shutil.copyfile(src, dest)
+    return md5_value
+
+def hash_and_link(src, dest):
+    os.link(src, dest)
+    return refpkg.md5file(dest)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-s', '--size', type=float, default=2,
+        help='size of the synthetic alignment in GB [%(default)s]')
+    parser.add_argument('--tmpdir',
+        help='directory in which to write the alignment and the copies')
+    parser.add_argument('--drop-caches', action='store_true', default=False,
+        help='drop the page cache before each measurement (requires root)')
+    a = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(dir=a.tmpdir)
+    try:
+        src = os.path.join(tmpdir, 'aln.fasta')
+        write_alignment(src, int(a.size * 1024 ** 3))
+        size = os.path.getsize(src)
+
+        print '%-16s %10s %10s %34s' % ('method', 'seconds', 'MB/s', 'md5')
+        for i, (method, func) in enumerate([
+                ('hash then copy', hash_then_copy),
+                ('copy_md5file', refpkg.copy_md5file),
+                ('hard link', hash_and_link)]):
+            dest = os.path.join(tmpdir, 'dest%d.fasta' % i)
+            if a.drop_caches:
+                drop_caches()
+            start = time.time()
+            md5_value = func(src, dest)
+            elapsed = time.time() - start
+            print '%-16s %10.3f %10.1f %34s' % (
+                method, elapsed, size / elapsed / 1024 ** 2, md5_value)
+            os.unlink(dest)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Report the throughput of update_taxids.update_rows for a range of
+chunk sizes, using a seq_info file with repeated tax_ids. Use as:
+
+    python devtools/benchmark_update_taxids.py -d ncbi_taxonomy.db
+
+or, using a random taxonomy with N nodes (see benchmark_schema.py):
+
+    python devtools/benchmark_update_taxids.py --synthetic 1000000
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import sqlalchemy
+
+from taxtastic import ncbi
+from taxtastic.taxonomy import Taxonomy
+from taxtastic.subcommands.update_taxids import update_rows
+
+from benchmark_schema import synthetic_taxonomy
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('-d', '--database-file',
+        help='taxonomy database')
+    input_group.add_argument('--synthetic', type=int, metavar='N',
+        help='generate a random taxonomy with N nodes')
+    parser.add_argument('-r', '--rows', type=int, default=1000000,
+        help='number of seq_info rows [%(default)s]')
+    parser.add_argument('--distinct', type=int, default=50000,
+        help='number of distinct tax_ids [%(default)s]')
+    parser.add_argument('-c', '--chunk-sizes', default='100,1000,10000,100000',
+        help='comma-delimited chunk sizes [%(default)s]')
+    a = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dbname = a.database_file
+        if a.synthetic:
+            dbname = os.path.join(tmpdir, 'taxonomy.db')
+            synthetic_taxonomy(dbname, a.synthetic).close()
+
+        con = sqlite3.connect(dbname)
+        tax_ids = [str(tax_id) for tax_id, in con.execute('SELECT tax_id FROM nodes')]
+        merged = [str(tax_id) for tax_id, in con.execute('SELECT old_tax_id FROM merged')]
+        con.close()
+        random.seed(1)
+        distinct = random.sample(tax_ids, min(a.distinct, len(tax_ids))) + merged[:100]
+        del tax_ids
+        seq_info = [{'seqname': 's%i' % i, 'tax_id': random.choice(distinct)}
+                    for i in xrange(a.rows)]
+
+        engine = sqlalchemy.create_engine('sqlite:///%s' % dbname)
+        tax = Taxonomy(engine, list(ncbi.ranks))
+        print '%12s %12s %14s' % ('chunk size', 'seconds', 'rows/s')
+        for chunk_size in [int(n) for n in a.chunk_sizes.split(',')]:
+            rows = (dict(row) for row in seq_info)
+            start = time.time()
+            for row in update_rows(tax, rows, 'remove', chunk_size):
+                pass
+            elapsed = time.time() - start
+            print '%12i %12.2f %14.0f' % (chunk_size, elapsed, a.rows / elapsed)
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,8 @@
 #    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
 import collections
 import logging
-from itertools import combinations
+
+from taxtastic.refpkg import NoAncestor
 
 log = logging.getLogger(__name__)
 
@@ -40,119 +41,306 @@ def intersection(it):
 CladeMetadata = collections.namedtuple(
     'CladeMetadata', 'parents colors cut_colors')
 
-def color_clades(tree, colors):
-    "Given a biopython tree and colors of its leaves, color its edges."
+def postorder(cur):
+    "Iterate over the descendants of a biopython clade, children first."
 
-    parents = {tree.root: None}
-    cut_colors = collections.defaultdict(set)
-    stack = [('down', tree.root, None)]
-    while stack:
-        phase, cur, color = stack.pop()
-        if phase == 'down':
-            if not cur.clades:
-                if cur not in colors:
-                    continue
-                stack.append(('up', cur, colors[cur]))
-            else:
-                for child in cur.clades:
-                    parents[child] = cur
-                    stack.append(('down', child, None))
-        elif phase == 'up':
-            if cur is None or color in cut_colors[cur]:
-                continue
-            cut_colors[cur].add(color)
-            stack.append(('up', parents[cur], color))
-
-    stack = [(tree.root, set())]
+    stack = [(cur, False)]
     while stack:
-        node, okayed = stack.pop()
-        if not node.clades:
+        node, visited = stack.pop()
+        if visited or not node.clades:
+            yield node
             continue
-        okayed = union(cut_colors[a] & cut_colors[b]
-            for a, b in combinations(node.clades, 2)) | okayed
-        for e in node.clades:
-            e_ = cut_colors[e] & okayed
-            if e_ != cut_colors[e]:
-                stack.append((e, okayed))
-                cut_colors[e] = e_
+        stack.append((node, True))
+        stack.extend((child, False) for child in reversed(node.clades))
+
+def bits(mask):
+    "Iterate over the bits set in an integer."
+
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
+
+def color_clades(tree, colors):
+    """Given a biopython tree and colors of its leaves, color its edges.
+
+    Clades are numbered in preorder and colors are represented as bits of
+    integers, so that the colors below each clade and the colors cut by
+    each edge are found using one pass over the clades in each direction.
+    The cut colors are returned as a ``CutColors`` mapping, which builds the
+    set of colors for a clade only when it is looked up.
+    """
+
+    root = tree.root
+    parents = {root: None}
+    nodes, parent_of, below = [], [], []
+    color_bits = {}
+    stack = [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        i = len(nodes)
+        nodes.append(node)
+        parent_of.append(parent)
+        if node.clades:
+            below.append(0)
+            for child in node.clades:
+                parents[child] = node
+                stack.append((child, i))
+        elif node in colors:
+            color = colors[node]
+            if color not in color_bits:
+                color_bits[color] = 1 << len(color_bits)
+            below.append(color_bits[color])
+        else:
+            below.append(0)
+
+    # Children are numbered after their parents, so iterating backwards
+    # visits each clade after its descendants.
+    shared = [0] * len(nodes)
+    for i in xrange(len(nodes) - 1, 0, -1):
+        mask = below[i]
+        if mask:
+            parent = parent_of[i]
+            # colors below more than one child of the parent
+            shared[parent] |= below[parent] & mask
+            below[parent] |= mask
+
+    # A color is only retained as cut by an edge if it is below more than
+    # one child of some clade above the edge. The root is reported to cut
+    # every color below it.
+    okayed = [0] * len(nodes)
+    okayed[0] = shared[0]
+    masks = {root: below[0]} if below[0] else {}
+    for i in xrange(1, len(nodes)):
+        above = okayed[parent_of[i]]
+        okayed[i] = above | shared[i]
+        mask = below[i] & above
+        if mask:
+            masks[nodes[i]] = mask
+
+    return CladeMetadata(parents, colors, CutColors(masks, color_bits))
+
+class CutColors(collections.Mapping):
+    """
+    Maps each clade to the set of colors cut by the edge above it, as found
+    by ``color_clades``. Sets are built from the bitmasks in ``masks`` (in
+    which each color is represented by the bit in ``color_bits``) when a
+    clade is looked up; like a ``defaultdict(set)``, clades that cut no
+    colors map to an empty set, but only clades that cut at least one color
+    are counted or iterated over.
+    """
+
+    def __init__(self, masks, color_bits):
+        self.masks = masks
+        self.color_bits = color_bits
+        self.palette = sorted(color_bits, key=color_bits.get)
+
+    def __getitem__(self, node):
+        return set(self.palette[i] for i in bit_indexes(self.masks.get(node, 0)))
+
+    def __contains__(self, node):
+        return node in self.masks
+
+    def __iter__(self):
+        return iter(self.masks)
+
+    def __len__(self):
+        return len(self.masks)
+
+def bit_indexes(mask):
+    """
+    Iterate over the indexes of the bits set in an integer, which is
+    faster than ``bits`` for wide, sparse integers.
+    """
+
+    digits = bin(mask)[:1:-1]
+    i = digits.find('1')
+    while i >= 0:
+        yield i
+        i = digits.find('1', i + 1)
 
-    return CladeMetadata(parents, colors, cut_colors)
+def prune(states):
+    """
+    Drop dominated states from a dict mapping a bitmask of used colors to a
+    (node count, node bitmask) tuple. A state is dominated if another state
+    uses a subset of its colors and has at least as many nodes; replacing it
+    with the dominating state can't make any solution at an ancestor node
+    infeasible or smaller.
+    """
+
+    if len(states) < 2:
+        return states
+    kept = {}
+    for used, state in sorted(states.iteritems(), key=lambda item: -item[1][0]):
+        unused = ~used
+        for other in kept:
+            if not other & unused:
+                break
+        else:
+            kept[used] = state
+    return kept
 
 def walk(cur, metadata):
-    "Walk a biopython clade, determining the optimal convex subcoloring."
+    """Walk a biopython clade, determining the optimal convex subcoloring.
+
+    Clades are visited in postorder using an explicit stack. Colors (as
+    numbered in the ``CutColors`` mapping from ``color_clades``) and the
+    leaves below each clade are represented as bits of integers, and
+    the solutions for each clade are built one child at a time, keeping
+    only the largest set of leaves for each set of colors used and
+    discarding dominated solutions (see ``prune``).
+
+    Returns the largest set of leaves with a convex coloring if `cur` is
+    the root; otherwise, returns the solutions for `cur` keyed by the
+    color of the edge above it and then by the cut colors used.
+    """
 
     parents, colors, cut_colors = metadata
+    masks, color_bits = cut_colors.masks, cut_colors.color_bits
 
-    # The root node is reported to cut every color that crosses the root, but
-    # we want to treat the root node as if it doesn't cut any color because we
-    # only want the best set of nodes from the root.
-    if parents[cur] is None:
-        K = set()
-    else:
-        K = cut_colors[cur]
-
-    ret = collections.defaultdict(dict)
-
-    if not cur.clades:
-        if K:
-            color = colors[cur]
-            assert len(K) == 1 and color in K
-            ret[color][frozenset([color])] = {cur}
-            ret[None][frozenset([color])] = {cur}
+    leaves = []
+    solutions = {}
+    for node in postorder(cur):
+        # The root node is reported to cut every color that crosses the root,
+        # but we want to treat the root node as if it doesn't cut any color
+        # because we only want the best set of nodes from the root.
+        if parents[node] is None:
+            K = 0
         else:
-            ret[None][frozenset()] = {cur}
-        return ret
-
-    phi = [walk(x, metadata) for x in cur.clades]
-    B = union(cut_colors[a] & cut_colors[b]
-        for a, b in combinations(cur.clades, 2))
-
-    for c in K | {None}:
-        ret_c = collections.defaultdict(list)
-        for b in B | {c}:
-            def aux(phis, used_colors, accum):
-                # Base case; we've reached the end of the list.
-                if not phis:
-                    ret_c[frozenset(used_colors)].append(accum)
-                    return
-
-                phi_i, phi_rest = phis[0], phis[1:]
-                X_is = phi_i[b]
-
-                # One possible solution is to ignore this `phi` completely.
-                aux(phi_rest, used_colors, accum)
-
-                if not X_is:
-                    X_is = phi_i[None]
-
-                for X_i in X_is:
-                    if (X_i & used_colors) - {b}:
-                        continue
-                    if b != c and c in X_i:
-                        continue
-                    aux(phi_rest, used_colors | X_i, accum | X_is[X_i])
-
-            aux(phi, set(), set())
-
-        # For each `X_i`, the optimal `T_i` is the one with the most nodes in
-        # it.
-        ret[c] = {X_i: max(T_is, key=len) for X_i, T_is in ret_c.iteritems()}
-
-    # If there were no cut colors, the only relevant data is the biggest set of
-    # nodes, so prune everything else out.
-    if not K:
-        total = max(ret[None].itervalues(), key=len)
-        ret.clear()
-        ret[None][frozenset()] = total
+            K = masks.get(node, 0)
+
+        # Solutions are keyed by the cut color of the clade (0 for none),
+        # then by the colors used.
+        if not node.clades:
+            state = (1, 1 << len(leaves))
+            leaves.append(node)
+            if K:
+                color = color_bits[colors[node]]
+                assert K == color
+                solutions[node] = {color: {color: state}, 0: {color: state}}
+            else:
+                solutions[node] = {0: {0: state}}
+            continue
+
+        phi = [solutions.pop(child) for child in node.clades]
+        B, seen = 0, 0
+        for child in node.clades:
+            child_K = masks.get(child, 0)
+            B |= seen & child_K
+            seen |= child_K
+
+        ret = {}
+        for c in list(bits(K)) + [0]:
+            ret_c = {}
+            for b in set(bits(B)) | {c}:
+                states = {0: (0, 0)}
+                for phi_i in phi:
+                    X_is = phi_i.get(b) or phi_i[0]
+                    # One possible solution is to ignore this `phi` completely.
+                    combined = dict(states)
+                    for used, (n, T) in states.iteritems():
+                        for X_i, (n_i, T_i) in X_is.iteritems():
+                            if X_i & used & ~b:
+                                continue
+                            if b != c and X_i & c:
+                                continue
+                            key = used | X_i
+                            if key not in combined or combined[key][0] < n + n_i:
+                                combined[key] = (n + n_i, T | T_i)
+                    states = prune(combined)
+                for used, state in states.iteritems():
+                    if used not in ret_c or ret_c[used][0] < state[0]:
+                        ret_c[used] = state
+            ret[c] = ret_c
+
+        # Colors that aren't cut by this clade can't be used anywhere else in
+        # the tree, so only the cut colors are relevant to the solutions of
+        # ancestors. If there were no cut colors, the only relevant data is
+        # the biggest set of nodes, so prune everything else out.
+        for c, ret_c in ret.iteritems():
+            projected = {}
+            for used, state in ret_c.iteritems():
+                used &= K
+                if used not in projected or projected[used][0] < state[0]:
+                    projected[used] = state
+            ret[c] = prune(projected)
+        solutions[node] = ret
 
+    def nodes(state):
+        return {leaves[bit.bit_length() - 1] for bit in bits(state[1])}
+
+    ret = solutions[cur]
     # If this is the parent node, return just the biggest set of nodes.
     if parents[cur] is None:
-        return ret[None][frozenset()]
+        return nodes(ret[0][0])
 
-    return ret
+    colors_of = dict((bit, color) for color, bit in color_bits.iteritems())
+    colors_of[0] = None
+    def color_set(mask):
+        return frozenset(colors_of[bit] for bit in bits(mask))
+    return collections.defaultdict(dict, (
+        (colors_of[c], dict((color_set(X), nodes(state))
+                            for X, state in ret_c.iteritems()))
+        for c, ret_c in ret.iteritems()))
 
 Ranking = collections.namedtuple('Ranking', 'rank node')
 
+def lineage_index(db):
+    """
+    Build a map of each tax_id to its parent and depth from the nested sets
+    in the ``hierarchy`` table of a refpkg taxonomy database.
+    """
+
+    index = {}
+    stack = []
+    for tax_id, lft, rgt in db.cursor().execute("""
+        SELECT tax_id, lft, rgt
+        FROM   hierarchy
+        ORDER  BY lft
+    """):
+        while stack and stack[-1][1] < lft:
+            stack.pop()
+        parent = stack[-1][0] if stack else None
+        index[tax_id] = (parent, len(stack))
+        stack.append((tax_id, rgt))
+    return index
+
+def clade_mrcas(root, name_map, index, ignore_missing_sequences=False):
+    """
+    Find the MRCA tax_id of the leaves below each clade of a biopython tree
+    in a single postorder pass, combining the MRCAs of each clade's children.
+    Clades with no leaves in `name_map` map to None.
+    """
+
+    def mrca(a, b):
+        if a is None or a == b:
+            return b
+        if b is None:
+            return a
+        (a_parent, a_depth), (b_parent, b_depth) = index[a], index[b]
+        while a != b:
+            if a_depth >= b_depth:
+                a = a_parent
+                a_parent, a_depth = index[a]
+            else:
+                b = b_parent
+                b_parent, b_depth = index[b]
+        return a
+
+    mrcas = {}
+    for node in postorder(root):
+        if not node.clades:
+            if ignore_missing_sequences and node.name not in name_map:
+                mrcas[node] = None
+            else:
+                mrcas[node] = name_map[node.name]
+            continue
+        cur = None
+        for child in node.clades:
+            cur = mrca(cur, mrcas[child])
+        mrcas[node] = cur
+    return mrcas
+
 def reroot_from_rp(root, rp, ignore_missing_sequences=False):
     name_map = dict(rp.db.cursor().execute("""
         SELECT seqname, tax_id
@@ -163,11 +351,13 @@ def reroot_from_rp(root, rp, ignore_missing_sequences=False):
         FROM   taxa
                JOIN ranks USING (rank)
     """))
+    mrcas = clade_mrcas(
+        root, name_map, lineage_index(rp.db), ignore_missing_sequences)
     def subrk_min(t):
-        mrca = rp.most_recent_common_ancestor(
-            *set(name_map[n.name] for n in t.get_terminals()
-                 if not ignore_missing_sequences or n.name in name_map))
+        mrca = mrcas[t]
         logging.debug("mrca for %r is %r", t, mrca)
+        if mrca is None:
+            raise NoAncestor()
         return rank_map[mrca]
 
     return reroot(root, subrk_min)
@@ -16,10 +16,14 @@
 Methods and variables specific to the NCBI taxonomy.
 """
 
+import Queue
+import collections
 import sqlite3
 import itertools
 import logging
+import multiprocessing
 import os
+import time
 import urllib
 import zipfile
 
@@ -29,7 +33,7 @@ log = logging
 
 ncbi_data_url = 'ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdmp.zip'
 
-db_schema = """
+db_tables = """
 -- nodes.dmp specifies additional columns but these are not implemented yet
 CREATE TABLE nodes(
 tax_id        TEXT UNIQUE PRIMARY KEY NOT NULL,
@@ -64,7 +68,9 @@ INSERT INTO "source"
   (id, name, description)
 VALUES
   (1, "NCBI", "NCBI taxonomy");
+"""
 
+db_indices = """
 -- indices on nodes
 CREATE INDEX nodes_tax_id ON nodes(tax_id);
 CREATE INDEX nodes_parent_id ON nodes(parent_id);
@@ -81,10 +87,161 @@ CREATE INDEX names_name_is_primary ON names(tax_name, is_primary);
 
 """
 
+db_schema = db_tables + db_indices
+
+# A more compact alternative to the schema above: tax_ids are stored
+# as integers, and nodes is clustered on its primary key. Tax_ids
+# that are not integers (eg, those of custom nodes) are stored as
+# text. Taxonomy presents tax_ids as strings using either schema.
+db_tables_integer = """
+CREATE TABLE nodes(
+tax_id        INTEGER PRIMARY KEY NOT NULL,
+parent_id     INTEGER,
+rank          TEXT,
+embl_code     TEXT,
+division_id   INTEGER,
+source_id     INTEGER DEFAULT 1 -- added to support multiple sources
+) WITHOUT ROWID;
+
+CREATE TABLE names(
+tax_id        INTEGER REFERENCES nodes(tax_id),
+tax_name      TEXT,
+unique_name   TEXT,
+name_class    TEXT,
+is_primary    INTEGER -- not defined in names.dmp
+);
+
+CREATE TABLE merged(
+old_tax_id    INTEGER PRIMARY KEY NOT NULL,
+new_tax_id    INTEGER REFERENCES nodes(tax_id)
+) WITHOUT ROWID;
+
+-- table "source" supports addition of custom taxa (not provided by NCBI)
+CREATE TABLE source(
+id            INTEGER PRIMARY KEY AUTOINCREMENT,
+name          TEXT UNIQUE,
+description   TEXT
+);
+
+INSERT INTO "source"
+  (id, name, description)
+VALUES
+  (1, "NCBI", "NCBI taxonomy");
+"""
+
+# nodes.tax_id and merged.old_tax_id are already indexed by their
+# primary keys
+db_indices_integer = """
+-- indices on nodes
+CREATE INDEX nodes_parent_id ON nodes(parent_id);
+CREATE INDEX nodes_rank ON nodes(rank);
+
+-- indices on names
+CREATE INDEX names_tax_name ON names(tax_name);
+CREATE INDEX names_taxid_is_primary ON names(tax_id, is_primary);
+CREATE INDEX names_name_is_primary ON names(tax_name, is_primary);
+"""
+
+# keys: schema name; vals: (tables, indices)
+db_schemas = {
+    'text': (db_tables, db_indices),
+    'integer': (db_tables_integer, db_indices_integer),
+    }
+
+# Optional table providing the lineage of each node (see
+# db_lineages), serialized as "rank:tax_id;rank:tax_id;..." from the
+# root to the node itself. Keys: schema name.
+lineages_tables = {
+    'text': """
+CREATE TABLE lineages(
+tax_id        TEXT PRIMARY KEY NOT NULL,
+lineage       TEXT
+)""",
+    'integer': """
+CREATE TABLE lineages(
+tax_id        INTEGER PRIMARY KEY NOT NULL,
+lineage       TEXT
+) WITHOUT ROWID""",
+    }
+
+# Optional nested-set index of nodes (see db_hierarchy): the subtree
+# below each node contains exactly the nodes with lft between its own
+# lft and rgt, as in table "hierarchy" of taxdb.Taxdb. Keys: schema
+# name.
+hierarchy_tables = {
+    'text': """
+CREATE TABLE hierarchy(
+tax_id        TEXT PRIMARY KEY NOT NULL,
+lft           INTEGER NOT NULL UNIQUE,
+rgt           INTEGER NOT NULL UNIQUE
+)""",
+    'integer': """
+CREATE TABLE hierarchy(
+tax_id        INTEGER PRIMARY KEY NOT NULL,
+lft           INTEGER NOT NULL UNIQUE,
+rgt           INTEGER NOT NULL UNIQUE
+) WITHOUT ROWID""",
+    }
+
+# SQL expression giving the normalized form of the name %s used for
+# case-insensitive name lookups (see db_name_index): lowercase, with
+# each run of ASCII whitespace (space, tab, newline, carriage return,
+# vertical tab or form feed) replaced by a single space and leading
+# and trailing whitespace removed; equivalent to
+# ' '.join(name.split()).lower() for names without control
+# characters. Whitespace characters are first replaced by spaces;
+# each space is then followed by a marker character, and markers
+# followed by a space are removed along with the remaining markers,
+# which leaves one space per run. Only builtin functions are used so
+# that the expression can be evaluated by triggers on any connection.
+name_normalization = (
+    "lower(trim(replace(replace(replace("
+    "replace(replace(replace(replace(replace(%s, char(9), ' '), char(10), ' '), "
+    "char(11), ' '), char(12), ' '), char(13), ' '), "
+    "' ', ' ' || char(1)), char(1) || ' ', ''), char(1), '')))")
+
+# Optional indices for name searches (see db_name_index): a column
+# "names.normalized_name" and its index, and a full-text index of
+# trigrams of names.tax_name, both kept up to date using triggers.
+name_index = """
+ALTER TABLE names ADD COLUMN normalized_name TEXT;
+UPDATE names SET normalized_name = %(normalized)s;
+CREATE INDEX names_normalized_name ON names(normalized_name);
+CREATE VIRTUAL TABLE names_fts USING fts5(
+  tax_name, content='names', content_rowid='rowid', tokenize='trigram');
+INSERT INTO names_fts(names_fts) VALUES ('rebuild');
+CREATE TRIGGER names_fts_insert AFTER INSERT ON names BEGIN
+  UPDATE names SET normalized_name = %(new)s WHERE rowid = new.rowid;
+  INSERT INTO names_fts(rowid, tax_name) VALUES (new.rowid, new.tax_name);
+END;
+CREATE TRIGGER names_fts_delete AFTER DELETE ON names BEGIN
+  INSERT INTO names_fts(names_fts, rowid, tax_name)
+  VALUES ('delete', old.rowid, old.tax_name);
+END;
+CREATE TRIGGER names_fts_update AFTER UPDATE OF tax_name ON names BEGIN
+  UPDATE names SET normalized_name = %(new)s WHERE rowid = new.rowid;
+  INSERT INTO names_fts(names_fts, rowid, tax_name)
+  VALUES ('delete', old.rowid, old.tax_name);
+  INSERT INTO names_fts(rowid, tax_name) VALUES (new.rowid, new.tax_name);
+END;
+""" % dict(normalized=name_normalization % 'tax_name',
+           new=name_normalization % 'new.tax_name')
+
+# PRAGMAs used while loading data in bulk (see db_load); values are
+# restored to the sqlite defaults once loading is complete.
+bulk_pragmas = [
+    ('journal_mode', 'OFF', 'DELETE'),
+    ('synchronous', 'OFF', 'FULL'),
+    ('cache_size', '-500000', '-2000'), # negative values are in KiB
+    ('temp_store', 'MEMORY', 'DEFAULT'),
+    ]
+
 # define headers in names.dmp, etc (may not correspond to table columns above)
 merged_keys = 'old_tax_id new_tax_id'.split()
 
 undefined_rank = 'no_rank'
+# undefined ranks are renamed to undef_prefix + '_' + the parent rank
+undef_prefix = 'below'
 root_name = 'root'
 
 _ranks = """
@@ -127,6 +284,9 @@ def db_connect(dbname='ncbi_taxonomy.db', schema=db_schema, clobber = False):
     Create a connection object to a database. Attempt to establish a
     schema. If there are existing tables, delete them if clobber is
     True and return otherwise. Returns a connection object.
+
+    Use schema=db_tables to defer creation of indices when data will
+    be loaded using db_load(..., bulk=True).
     """
 
     if clobber:
@@ -139,7 +299,18 @@ def db_connect(dbname='ncbi_taxonomy.db', schema=db_schema, clobber = False):
     con = sqlite3.connect(dbname)
     cur = con.cursor()
 
-    cmds = [cmd.strip() for cmd in schema.split(';') if cmd.strip()]
+    execute_script(cur, schema)
+
+    return con
+
+def execute_script(cur, script):
+    """
+    Execute each of the semicolon-delimited statements in `script`
+    using cursor `cur`, stopping at the first statement that fails
+    (for example, because the table or index already exists).
+    """
+
+    cmds = [cmd.strip() for cmd in script.split(';') if cmd.strip()]
     try:
         for cmd in cmds:
             cur.execute(cmd)
@@ -147,48 +318,422 @@ def db_connect(dbname='ncbi_taxonomy.db', schema=db_schema, clobber = False):
     except sqlite3.OperationalError as err:
         log.info(err)
 
-    return con
+def schema_name(con):
+    """
+    Return the name of the schema (a key of db_schemas) used by the
+    database identified by con.
+    """
+
+    cur = con.cursor()
+    cur.execute('PRAGMA table_info(nodes)')
+    types = dict((row[1], row[2].upper()) for row in cur.fetchall())
+    return 'integer' if types.get('tax_id') == 'INTEGER' else 'text'
+
+def db_index(con, indices=None):
+    """
+    Create indices and collect statistics for the query planner. By
+    default, the indices appropriate for the schema of the database
+    (see schema_name) are created.
+    """
+
+    cur = con.cursor()
+    if indices is None:
+        indices = db_schemas[schema_name(con)][1]
+    execute_script(cur, indices)
+    cur.execute('ANALYZE')
+    con.commit()
+
+def has_lineages(con):
+    """
+    Return True if the database identified by con contains table
+    "lineages" (see db_lineages).
+    """
+
+    cur = con.cursor()
+    cur.execute("""SELECT count(*) FROM sqlite_master
+                   WHERE type = 'table' AND name = 'lineages'""")
+    return bool(cur.fetchone()[0])
+
+def db_lineages(con, tax_ids=None):
+    """
+    Create (or replace) table "lineages" containing the lineage of
+    each node reachable from the root, serialized as
+    "rank:tax_id;rank:tax_id;..." from the root to the node itself.
+    Undefined ranks are renamed as in Taxonomy._get_lineage (eg,
+    "no_rank" below "genus" becomes "below_genus"), so that lineages
+    can be read using a single query. The table is built in one pass
+    over nodes using a recursive query.
+
+    If `tax_ids` is provided, the table must already exist, and only
+    the rows for these nodes and their descendants are replaced (eg,
+    once nodes have been added, deleted, moved or given a new rank).
+    """
+
+    cur = con.cursor()
+    if tax_ids is None:
+        cur.execute('DROP TABLE IF EXISTS lineages')
+        cur.execute(lineages_tables[schema_name(con)])
+        seeds = """SELECT tax_id, rank, rank || ':' || tax_id
+                   FROM nodes WHERE tax_id = parent_id"""
+    else:
+        _stale_lineages(cur, tax_ids)
+        seeds = 'SELECT tax_id, rank, lineage FROM temp.lineage_seeds'
+
+    # undefined ranks are renamed relative to the (renamed) parent rank
+    rank = """CASE WHEN n.rank = :undefined THEN :prefix || '_' || lin.rank
+              ELSE n.rank END"""
+    cur.execute("""
+        INSERT INTO lineages (tax_id, lineage)
+        WITH RECURSIVE lin(tax_id, rank, lineage) AS (
+          %(seeds)s
+          UNION ALL
+          SELECT n.tax_id, %(rank)s, lin.lineage || ';' || %(rank)s || ':' || n.tax_id
+          FROM lin JOIN nodes n
+          ON n.parent_id = lin.tax_id AND n.tax_id != n.parent_id
+        )
+        SELECT tax_id, lineage FROM lin""" % dict(seeds=seeds, rank=rank),
+                dict(undefined=undefined_rank, prefix=undef_prefix))
+    cur.execute('DROP TABLE IF EXISTS temp.lineage_seeds')
+    con.commit()
+
+def _stale_lineages(cur, tax_ids):
+    """
+    Delete the rows of table "lineages" for nodes in `tax_ids` and
+    their descendants, and fill table temp.lineage_seeds with the
+    (tax_id, renamed rank, lineage) of each of these nodes whose
+    parent is not among them, from which db_lineages rebuilds the
+    rest.
+    """
+
+    for tablename in ['changed', 'stale', 'lineage_seeds']:
+        cur.execute('DROP TABLE IF EXISTS temp.%s' % tablename)
+    cur.execute('CREATE TEMP TABLE changed (tax_id)')
+    cur.executemany('INSERT INTO temp.changed VALUES (?)', ((tax_id,) for tax_id in tax_ids))
+    cur.execute("""
+        CREATE TEMP TABLE stale AS
+        WITH RECURSIVE below(tax_id) AS (
+          SELECT tax_id FROM temp.changed
+          UNION
+          SELECT n.tax_id FROM below JOIN nodes n
+          ON n.parent_id = below.tax_id AND n.tax_id != n.parent_id
+        )
+        SELECT tax_id FROM below""")
+    cur.execute('DELETE FROM lineages WHERE tax_id IN (SELECT tax_id FROM temp.stale)')
+
+    cur.execute("""
+        SELECT n.tax_id, n.parent_id, n.rank, p.lineage
+        FROM nodes n LEFT JOIN lineages p ON p.tax_id = n.parent_id
+        WHERE n.tax_id IN (SELECT tax_id FROM temp.stale)
+        AND (n.tax_id = n.parent_id
+             OR n.parent_id NOT IN (SELECT tax_id FROM temp.stale))""")
+    seeds = []
+    for tax_id, parent_id, rank, lineage in cur.fetchall():
+        if tax_id == parent_id:
+            seeds.append((tax_id, rank, '%s:%s' % (rank, tax_id)))
+        elif lineage is not None:
+            # the (renamed) rank of the parent ends its lineage
+            if rank == undefined_rank:
+                parent_rank = lineage.rsplit(';', 1)[-1].split(':', 1)[0]
+                rank = '%s_%s' % (undef_prefix, parent_rank)
+            seeds.append((tax_id, rank, '%s;%s:%s' % (lineage, rank, tax_id)))
+    cur.execute('DROP TABLE temp.changed')
+    cur.execute('DROP TABLE temp.stale')
+
+    cur.execute('CREATE TEMP TABLE lineage_seeds (tax_id, rank, lineage)')
+    cur.executemany('INSERT INTO temp.lineage_seeds VALUES (?, ?, ?)', seeds)
+
+def has_hierarchy(con):
+    """
+    Return True if the database identified by con contains table
+    "hierarchy" (see db_hierarchy).
+    """
+
+    cur = con.cursor()
+    cur.execute("""SELECT count(*) FROM sqlite_master
+                   WHERE type = 'table' AND name = 'hierarchy'""")
+    return bool(cur.fetchone()[0])
+
+def has_name_index(con):
+    """
+    Return True if the database identified by con contains the name
+    search indices created by db_name_index.
+    """
 
-def db_load(con, archive, root_name='root', maxrows=None):
+    cur = con.cursor()
+    cur.execute("""SELECT count(*) FROM sqlite_master
+                   WHERE type = 'table' AND name = 'names_fts'""")
+    return bool(cur.fetchone()[0])
+
+def db_name_index(con):
+    """
+    Add a column "normalized_name" (see name_normalization) and its
+    index to table "names", and a full-text index of trigrams of
+    names.tax_name in table "names_fts", for case-insensitive and
+    fuzzy name searches (see Taxonomy.search_names). Both are
+    maintained by sqlite as rows of "names" change. Does nothing if
+    the indices already exist.
+    """
+
+    if has_name_index(con):
+        return
+
+    # trigger bodies contain semicolons, so execute_script can't be used
+    con.executescript(name_index)
+    con.commit()
+
+def db_hierarchy(con):
+    """
+    Create (or replace) table "hierarchy" containing a nested-set
+    numbering of each node reachable from the root: node A is an
+    ancestor of node B if and only if A.lft <= B.lft <= A.rgt, so
+    that ancestor tests and subtree queries require a comparison or
+    a range scan of the index on lft rather than a walk of the
+    tree. Nodes are numbered in a single depth-first traversal.
+    """
+
+    cur = con.cursor()
+    cur.execute('DROP TABLE IF EXISTS hierarchy')
+    cur.execute(hierarchy_tables[schema_name(con)])
+
+    children, roots = {}, []
+    for tax_id, parent_id in cur.execute('SELECT tax_id, parent_id FROM nodes'):
+        if tax_id == parent_id:
+            roots.append(tax_id)
+        else:
+            children.setdefault(parent_id, []).append(tax_id)
+
+    def intervals():
+        counter = itertools.count(1).next
+        lft = {}
+        # (tax_id, True) is pushed below the children of tax_id, and
+        # popped once all of them have been numbered
+        stack = [(root, False) for root in roots]
+        while stack:
+            tax_id, visited = stack.pop()
+            if visited:
+                yield tax_id, lft.pop(tax_id), counter()
+            else:
+                lft[tax_id] = counter()
+                stack.append((tax_id, True))
+                stack.extend((child, False) for child in children.pop(tax_id, []))
+
+    cur.executemany('INSERT INTO hierarchy (tax_id, lft, rgt) VALUES (?, ?, ?)',
+                    intervals())
+    con.commit()
+
+# tables loaded by db_load and the files in taxdmp.zip providing their contents
+dmp_tables = [('nodes', 'nodes.dmp'), ('names', 'names.dmp'), ('merged', 'merged.dmp')]
+
+def read_table(archive, fname, root_name='root'):
+    """
+    Return an iterator of rows from file `fname` in the zip archive
+    ready to insert into the corresponding table.
+    """
+
+    rows = read_archive(archive, fname)
+    if fname == 'nodes.dmp':
+        rows = read_nodes(rows=rows, root_name=root_name, ncbi_source_id=1)
+    elif fname == 'names.dmp':
+        rows = read_names(rows=rows)
+    return rows
+
+def db_load(con, archive, root_name='root', maxrows=None, bulk=False, jobs=1):
     """
     Load data from zip archive into database identified by con. Data
     is not loaded if target tables already contain data.
+
+    If bulk is True, all rows are inserted in a single transaction
+    with journaling and synchronous writes turned off (see
+    bulk_pragmas), and indices are created only once loading is
+    complete. The database is left in an inconsistent state if
+    loading fails, so this should be used only when creating a new
+    database (ie, connected using schema=db_tables).
+
+    If jobs is greater than 1, files in the archive are parsed in
+    parallel by up to `jobs` worker processes (see load_parallel).
+
+    Returns a list of (stage, seconds) tuples.
     """
 
-    try:
-        # nodes
-        rows = read_nodes(
-            rows=read_archive(archive, 'nodes.dmp'),
-            root_name=root_name,
-            ncbi_source_id=1)
-        do_insert(con, 'nodes', rows, maxrows, add=False)
-
-        # names
-        rows = read_names(
-            rows=read_archive(archive, 'names.dmp')
-            )
-        do_insert(con, 'names', rows, maxrows, add=False)
-
-        # merged
-        rows = read_archive(archive, 'merged.dmp')
-        do_insert(con, 'merged', rows, maxrows, add=False)
+    cur = con.cursor()
+    if bulk:
+        for pragma, value, _ in bulk_pragmas:
+            cur.execute('PRAGMA %s = %s' % (pragma, value))
 
+    try:
+        if jobs > 1:
+            timings = load_parallel(con, archive, root_name, maxrows,
+                                    jobs=jobs, commit=not bulk)
+        else:
+            timings = []
+            for tablename, fname in dmp_tables:
+                start = time.time()
+                rows = read_table(archive, fname, root_name)
+                do_insert(con, tablename, rows, maxrows, add=False, commit=not bulk)
+                timings.append(('load %s' % tablename, time.time() - start))
     except sqlite3.IntegrityError, err:
         raise IntegrityError(err)
 
-def do_insert(con, tablename, rows, maxrows=None, add=True):
+    if bulk:
+        con.commit()
+        start = time.time()
+        db_index(con)
+        timings.append(('create indices', time.time() - start))
+        for pragma, _, default in bulk_pragmas:
+            cur.execute('PRAGMA %s = %s' % (pragma, default))
+
+    for stage, seconds in timings:
+        log.info('%s: %.2f s' % (stage, seconds))
+
+    return timings
 
+_queue = None
+
+def _init_worker(queue):
+    global _queue
+    _queue = queue
+
+def _parse_worker(archive, fname, root_name, maxrows, batch_size):
     """
-    Insert rows into a table. Do not perform the insert if
-    add is False and table already contains data.
+    Parse `fname` in a worker process, putting batches of rows onto
+    the queue as (fname, rows). A first (fname, pid) message
+    identifies the worker process, and a final (fname, None) message
+    signals that the file is complete; (fname, exception) is sent
+    in case of an error.
+    """
+
+    start = time.time()
+    _queue.put((fname, os.getpid()))
+    try:
+        rows = read_table(archive, fname, root_name)
+        if maxrows:
+            rows = itertools.islice(rows, maxrows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            _queue.put((fname, batch))
+    except Exception, err:
+        _queue.put((fname, err))
+    else:
+        _queue.put((fname, None))
+    return fname, time.time() - start
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def _check_workers(pending, results, pids):
+    """
+    Raise an exception if the worker parsing any file in `pending`
+    failed or exited without sending all of its rows, given the
+    AsyncResult for each file and the pids of the workers that have
+    started.
+    """
+
+    for fname in pending:
+        result = results[fname]
+        if result.ready():
+            # re-raises the exception from the worker, if any
+            result.get()
+            raise RuntimeError(
+                'worker parsing %s finished without sending all rows' % fname)
+        # A worker killed by a signal (eg, by the OOM killer) never
+        # completes its AsyncResult.
+        if fname in pids and not _process_exists(pids[fname]):
+            raise RuntimeError(
+                'worker parsing %s (pid %s) exited unexpectedly' % (
+                    fname, pids[fname]))
+
+def load_parallel(con, archive, root_name='root', maxrows=None,
+                  jobs=3, commit=True, batch_size=10000, timeout=5):
+    """
+    Parse files in `archive` using a pool of `jobs` worker
+    processes. Rows are passed back in batches of `batch_size` and
+    inserted by this process as they arrive, so that there is a
+    single writer to the database. Tables already containing data are
+    not loaded. Returns a list of (stage, seconds) tuples.
+
+    If no rows arrive for `timeout` seconds, the workers are checked,
+    and an exception is raised if any has failed or died.
     """
 
     cur = con.cursor()
+    pending = dict((fname, tablename) for tablename, fname in dmp_tables
+                   if not has_data(cur, tablename))
+    for tablename, fname in dmp_tables:
+        if fname not in pending:
+            log.info('Table "%s" already contains data; load not performed.' % tablename)
+
+    queue = multiprocessing.Queue(maxsize=jobs * 4)
+    pool = multiprocessing.Pool(min(jobs, len(pending) or 1),
+                                initializer=_init_worker, initargs=(queue,))
+    results = collections.OrderedDict(
+        (fname, pool.apply_async(_parse_worker,
+                                 (archive, fname, root_name, maxrows, batch_size)))
+        for tablename, fname in dmp_tables if fname in pending)
+    pool.close()
+
+    insert_times = dict((fname, 0.0) for fname in pending)
+    pids = {}
+    try:
+        while pending:
+            try:
+                fname, batch = queue.get(timeout=timeout)
+            except Queue.Empty:
+                _check_workers(pending, results, pids)
+                continue
+            if batch is None:
+                del pending[fname]
+            elif isinstance(batch, Exception):
+                raise batch
+            elif isinstance(batch, int):
+                pids[fname] = batch
+            else:
+                start = time.time()
+                do_insert(con, pending[fname], iter(batch), commit=False)
+                insert_times[fname] += time.time() - start
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.join()
+
+    if commit:
+        con.commit()
+
+    timings = []
+    for result in results.itervalues():
+        fname, seconds = result.get()
+        timings.append(('parse %s' % fname, seconds))
+    for tablename, fname in dmp_tables:
+        if fname in insert_times:
+            timings.append(('insert %s' % tablename, insert_times[fname]))
 
-    cur.execute('select count(*) from "%s" where rowid < 2' % tablename)
-    has_data = cur.fetchone()[0]
+    return timings
 
-    if not add and has_data:
+def has_data(cur, tablename):
+    """
+    Return True if table `tablename` contains at least one row.
+    """
+
+    cur.execute('select exists (select 1 from "%s")' % tablename)
+    return bool(cur.fetchone()[0])
+
+def do_insert(con, tablename, rows, maxrows=None, add=True, commit=True):
+
+    """
+    Insert rows into a table. Do not perform the insert if
+    add is False and table already contains data. If commit is
+    False, the caller is responsible for committing the transaction.
+    """
+
+    cur = con.cursor()
+
+    if not add and has_data(cur, tablename):
         log.info('Table "%s" already contains data; load not performed.' % tablename)
         return False
 
@@ -203,10 +748,224 @@ def do_insert(con, tablename, rows, maxrows=None, add=True):
         rows = itertools.islice(rows, maxrows)
 
     cur.executemany(cmd, rows)
-    con.commit()
+    if commit:
+        con.commit()
 
     return True
 
+def db_convert(con, dbname, schema='integer', clobber=False):
+    """
+    Copy the taxonomy in the database identified by con into a new
+    database `dbname` using the schema identified by `schema` (a key
+    of db_schemas). Tables "lineages" and "hierarchy" and the name
+    search indices are rebuilt in the new database if present. Returns a connection to the new database.
+    """
+
+    if not clobber and os.access(dbname, os.F_OK):
+        raise ValueError('%s already exists' % dbname)
+
+    tables, indices = db_schemas[schema]
+    new_con = db_connect(dbname, schema=tables, clobber=True)
+    cur = new_con.cursor()
+    for pragma, value, _ in bulk_pragmas:
+        cur.execute('PRAGMA %s = %s' % (pragma, value))
+
+    src = con.cursor()
+    for tablename in ['source', 'nodes', 'names', 'merged']:
+        cur.execute('PRAGMA table_info("%s")' % tablename)
+        columns = [row[1] for row in cur.fetchall()]
+        cur.execute('DELETE FROM "%s"' % tablename)
+        src.execute('SELECT %s FROM "%s"' % (', '.join(columns), tablename))
+        cur.executemany('INSERT INTO "%s" (%s) VALUES (%s)' % (
+                tablename, ', '.join(columns), ', '.join(['?'] * len(columns))),
+                        src)
+
+    new_con.commit()
+    db_index(new_con, indices)
+    if has_lineages(con):
+        db_lineages(new_con)
+    if has_hierarchy(con):
+        db_hierarchy(new_con)
+    if has_name_index(con):
+        db_name_index(new_con)
+    for pragma, _, default in bulk_pragmas:
+        cur.execute('PRAGMA %s = %s' % (pragma, default))
+
+    return new_con
+
+# columns of each table provided by the corresponding file in taxdmp.zip
+dmp_columns = {
+    'nodes': 'tax_id parent_id rank embl_code division_id source_id'.split(),
+    'names': 'tax_id tax_name unique_name name_class is_primary'.split(),
+    'merged': merged_keys,
+    }
+
+def db_update(con, archive, root_name='root', ncbi_source_id=1):
+    """
+    Update the taxonomy in the database identified by con using the
+    contents of a (presumably newer) zip archive. The contents of the
+    archive are compared with the existing tables, and only the
+    differences are applied in a single transaction.
+
+    Nodes from sources other than NCBI (ie, with a source_id other
+    than `ncbi_source_id`, as added by Taxonomy.add_node) and their
+    names are preserved; NCBI nodes that have been assigned a custom
+    parent keep that parent.
+
+    If any nodes have changed, table "hierarchy" is rebuilt if
+    present, and the lineages of the changed nodes and their
+    descendants are replaced in table "lineages" (see db_hierarchy
+    and db_lineages).
+
+    Returns a dict keyed by table name of dicts providing the number
+    of rows inserted, updated, and deleted.
+    """
+
+    cur = con.cursor()
+
+    # temporary tables are large, so keep them in memory; unlike
+    # db_load(..., bulk=True), journaling is left on so that a failed
+    # update leaves the database untouched
+    update_pragmas = [p for p in bulk_pragmas if p[0] in ('cache_size', 'temp_store')]
+    for pragma, value, _ in update_pragmas:
+        cur.execute('PRAGMA %s = %s' % (pragma, value))
+
+    # load the new data into temporary tables
+    for tablename, fname in dmp_tables:
+        columns = dmp_columns[tablename]
+        cur.execute('DROP TABLE IF EXISTS temp."new_%s"' % tablename)
+        cur.execute('CREATE TEMP TABLE "new_%s" AS SELECT %s FROM "%s" WHERE 0' % (
+                tablename, ', '.join(columns), tablename))
+        rows = read_table(archive, fname, root_name)
+        cur.executemany('INSERT INTO "new_%s" VALUES (%s)' % (
+                tablename, ', '.join(['?'] * len(columns))), rows)
+    # names and merged are compared with the existing tables row by
+    # row, so their indices include every column: each lookup is then
+    # answered by the index alone
+    cur.execute('CREATE INDEX temp.new_nodes_tax_id ON new_nodes(tax_id)')
+    cur.execute('CREATE INDEX temp.new_names_all ON new_names(%s)' % (
+            ', '.join(dmp_columns['names'])))
+    cur.execute('CREATE INDEX temp.new_merged_all ON new_merged(%s)' % (
+            ', '.join(dmp_columns['merged'])))
+    con.commit()
+
+    custom = '(SELECT tax_id FROM nodes WHERE source_id != %i)' % ncbi_source_id
+    counts = dict((tablename, {}) for tablename, _ in dmp_tables)
+
+    try:
+        # nodes
+        cur.execute("""SELECT tax_id FROM new_nodes
+                       WHERE tax_id IN %s""" % custom)
+        for tax_id, in cur.fetchall():
+            log.warning('tax_id %s in the archive is already defined by '
+                        'another source; not updated' % tax_id)
+
+        cur.execute("""SELECT tax_id FROM nodes
+                       WHERE source_id = ?
+                       AND tax_id NOT IN (SELECT tax_id FROM new_nodes)""",
+                    (ncbi_source_id,))
+        deleted = cur.fetchall()
+        cur.executemany('DELETE FROM nodes WHERE tax_id = ?', deleted)
+        counts['nodes']['deleted'] = len(deleted)
+
+        cur.execute("""SELECT n.parent_id, n.rank, n.embl_code, n.division_id,
+                              n.tax_id, o.parent_id IN %s
+                       FROM new_nodes n JOIN nodes o USING (tax_id)
+                       WHERE o.source_id = ?
+                       AND (o.parent_id IS NOT n.parent_id
+                            OR o.rank IS NOT n.rank
+                            OR o.embl_code IS NOT n.embl_code
+                            OR o.division_id IS NOT n.division_id)""" % custom,
+                    (ncbi_source_id,))
+        updates, keep_parent = [], []
+        for parent_id, rank, embl_code, division_id, tax_id, custom_parent in cur.fetchall():
+            if custom_parent:
+                keep_parent.append((rank, embl_code, division_id, tax_id))
+            else:
+                updates.append((parent_id, rank, embl_code, division_id, tax_id))
+        cur.executemany("""UPDATE nodes
+                           SET parent_id = ?, rank = ?, embl_code = ?, division_id = ?
+                           WHERE tax_id = ?""", updates)
+        cur.executemany("""UPDATE nodes
+                           SET rank = ?, embl_code = ?, division_id = ?
+                           WHERE tax_id = ?""", keep_parent)
+        counts['nodes']['updated'] = len(updates) + len(keep_parent)
+
+        columns = dmp_columns['nodes']
+        cur.execute("""SELECT %s FROM new_nodes
+                       WHERE tax_id NOT IN (SELECT tax_id FROM nodes)""" % (
+                ', '.join(columns)))
+        inserted = cur.fetchall()
+        cur.executemany('INSERT INTO nodes (%s) VALUES (%s)' % (
+                ', '.join(columns), ', '.join(['?'] * len(columns))), inserted)
+        counts['nodes']['inserted'] = len(inserted)
+
+        # nodes whose lineages may have changed
+        changed = ([row[-1] for row in updates + keep_parent] +
+                   [row[0] for row in deleted + inserted])
+
+        # names and merged; rows are compared as a whole
+        def match(tablename, other):
+            columns = dmp_columns[tablename]
+            return ' AND '.join(
+                ['n.%(c)s = %(o)s.%(c)s' % {'c': columns[0], 'o': other}] +
+                ['n.%(c)s IS %(o)s.%(c)s' % {'c': c, 'o': other} for c in columns[1:]])
+
+        cur.execute("""DELETE FROM names
+                       WHERE tax_id NOT IN %s
+                       AND NOT EXISTS (SELECT 1 FROM new_names n WHERE %s)""" % (
+                custom, match('names', 'names')))
+        counts['names']['deleted'] = cur.rowcount
+
+        cur.execute("""INSERT INTO names (%(columns)s)
+                       SELECT %(columns)s FROM new_names n
+                       WHERE n.tax_id NOT IN %(custom)s
+                       AND NOT EXISTS (SELECT 1 FROM names o WHERE %(match)s)""" % dict(
+                columns=', '.join(dmp_columns['names']), custom=custom,
+                match=match('names', 'o')))
+        counts['names']['inserted'] = cur.rowcount
+
+        cur.execute("""DELETE FROM merged
+                       WHERE NOT EXISTS (SELECT 1 FROM new_merged n WHERE %s)""" % (
+                match('merged', 'merged')))
+        counts['merged']['deleted'] = cur.rowcount
+
+        cur.execute("""INSERT INTO merged (old_tax_id, new_tax_id)
+                       SELECT old_tax_id, new_tax_id FROM new_merged
+                       EXCEPT
+                       SELECT old_tax_id, new_tax_id FROM merged""")
+        counts['merged']['inserted'] = cur.rowcount
+
+        cur.execute("""SELECT tax_id, parent_id FROM nodes
+                       WHERE source_id != ?
+                       AND parent_id NOT IN (SELECT tax_id FROM nodes)""",
+                    (ncbi_source_id,))
+        for tax_id, parent_id in cur.fetchall():
+            log.warning('parent %s of tax_id %s is no longer defined' % (
+                    parent_id, tax_id))
+    except sqlite3.IntegrityError, err:
+        con.rollback()
+        raise IntegrityError(err)
+    except:
+        con.rollback()
+        raise
+    else:
+        con.commit()
+        # both tables depend only on nodes; lineages change only for
+        # the changed nodes and their descendants
+        if changed:
+            if has_lineages(con):
+                db_lineages(con, changed)
+            if has_hierarchy(con):
+                db_hierarchy(con)
+    finally:
+        for tablename, _ in dmp_tables:
+            cur.execute('DROP TABLE IF EXISTS temp."new_%s"' % tablename)
+        for pragma, _, default in update_pragmas:
+            cur.execute('PRAGMA %s = %s' % (pragma, default))
+
+    return counts
+
 def fetch_data(dest_dir='.', clobber=False, url=ncbi_data_url):
 
     """
@@ -242,17 +1001,28 @@ def fetch_data(dest_dir='.', clobber=False, url=ncbi_data_url):
 
     return (fout, downloaded)
 
-def read_archive(archive, fname):
+def read_archive(archive, fname, bufsize=2 ** 20):
     """
-    Return an iterator of rows from a zip archive.
+    Return an iterator of rows from a zip archive. The compressed
+    file is decompressed incrementally, so memory use is bounded by
+    `bufsize` rather than by the uncompressed size of the file.
 
     * archive - path to the zip archive.
     * fname - name of the compressed file within the archive.
+    * bufsize - number of uncompressed bytes to read at a time.
     """
 
-    zfile = zipfile.ZipFile(archive, 'r')
-    for line in zfile.read(fname).splitlines():
-        yield line.rstrip('\t|\n').split('\t|\t')
+    with zipfile.ZipFile(archive, 'r') as zfile:
+        with zfile.open(fname) as f:
+            tail = ''
+            for block in iter(lambda: f.read(bufsize), ''):
+                lines = (tail + block).split('\n')
+                # the last element is an incomplete line (or '')
+                tail = lines.pop()
+                for line in lines:
+                    yield line.rstrip('\t|\r').split('\t|\t')
+            if tail:
+                yield tail.rstrip('\t|\r').split('\t|\t')
 
 def read_dmp(fname):
     for line in open(fname,'rU'):
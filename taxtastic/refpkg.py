@@ -22,6 +22,8 @@ Note that Refpkg objects are *NOT* thread safe!
 #    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
 import contextlib
 from decorator import decorator
+import multiprocessing
+import multiprocessing.pool
 import subprocess
 import tempfile
 import hashlib
@@ -39,13 +41,27 @@ from taxtastic import utils, taxdb
 
 FORMAT_VERSION = '1.1'
 
+BLOCK_SIZE = 1 << 20
+
 def md5file(path):
     md5 = hashlib.md5()
-    with open(path) as h:
-        for block in iter(lambda: h.read(4096), ''):
+    with open(path, 'rb') as h:
+        for block in iter(lambda: h.read(BLOCK_SIZE), ''):
             md5.update(block)
     return md5.hexdigest()
 
+def copy_md5file(src, dest):
+    """Copy *src* to *dest*, returning the MD5 sum of its contents.
+
+    The file is only read once: each block is hashed as it is copied.
+    """
+    md5 = hashlib.md5()
+    with open(src, 'rb') as i, open(dest, 'wb') as o:
+        for block in iter(lambda: i.read(BLOCK_SIZE), ''):
+            md5.update(block)
+            o.write(block)
+    return md5.hexdigest()
+
 
 @contextlib.contextmanager
 def scratch_file(unlink=True, **kwargs):
@@ -68,6 +84,167 @@ def scratch_file(unlink=True, **kwargs):
             os.unlink(tmp_name)
 
 
+def parallel_map(func, items, jobs=1, processes=False):
+    """Apply *func* to each of *items* using up to *jobs* workers.
+
+    Threads are used unless *processes* is ``True``, in which case
+    *func* must be picklable (that is, defined at module level).  The
+    results are returned in the order of *items*.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) < 2:
+        return map(func, items)
+    if processes:
+        pool = multiprocessing.Pool(min(jobs, len(items)))
+    else:
+        pool = multiprocessing.pool.ThreadPool(min(jobs, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _nonempty_file(path):
+    return os.stat(path).st_size != 0
+
+def _check_fasta(path):
+    """Return an error message or None, and the names in FASTA file *path*.
+
+    Only the header lines are examined; a non-empty file is invalid if
+    it contains no records.
+    """
+    names = set()
+    nonempty = False
+    with open(path) as f:
+        for line in f:
+            nonempty = True
+            if line.startswith('>'):
+                title = line[1:].split(None, 1)
+                names.add(title[0] if title else '')
+    if nonempty and not names:
+        return 'aln_fasta file is not valid FASTA.', None
+    return None, names
+
+def _check_seq_info(path):
+    """Return an error message or None, and the names in seq_info *path*."""
+    names = set()
+    with open(path) as f:
+        reader = csv.reader(f)
+        try:
+            headers = next(reader)
+        except StopIteration:
+            return None, names
+        # Check required headers
+        for req_header in 'seqname', 'tax_id':
+            if not req_header in headers:
+                return "seq_info is missing {0}".format(req_header), None
+        width = len(headers)
+        if width <= 1:
+            return "seq_info is not valid CSV.", None
+        for row in reader:
+            if len(row) != width:
+                return "seq_info is not valid CSV.", None
+            names.add(row[0])
+    return None, names
+
+def _check_stockholm(path):
+    """Return an error message or None, and the names in Stockholm file *path*.
+
+    Rather than building the alignment, only the name and length of
+    each sequence are kept.
+    """
+    header = '# STOCKHOLM 1.0'
+    invalid = 'aln_sto file is not valid Stockholm.', None
+    names = set()
+    # lengths of the sequences in each alignment in the file
+    alignments = []
+    with open(path) as f:
+        lines = (line.strip() for line in f)
+        for line in lines:
+            if line:
+                if line != header:
+                    return invalid
+                alignments.append({})
+                break
+        else:
+            # empty file
+            return None, names
+        for line in lines:
+            if line == header:
+                alignments.append({})
+            elif not line or line[0] == '#' or line == '//':
+                continue
+            else:
+                parts = line.split(' ', 1)
+                if len(parts) != 2:
+                    return invalid
+                name, seq = parts
+                lengths = alignments[-1]
+                lengths[name] = lengths.get(name, 0) + len(seq.strip())
+                names.add(name)
+    if not names:
+        return invalid
+    for lengths in alignments:
+        if len(set(lengths.itervalues())) > 1:
+            return invalid
+    return None, names
+
+def _check_tree(path):
+    """Return an error message or None, and the leaf names in Newick file *path*."""
+    with open(path) as f:
+        try:
+            tree = Bio.Phylo.read(f, 'newick')
+        except:
+            if _nonempty_file(path):
+                return 'tree file is not valid Newick.', None
+            raise
+    return None, set([n.name for n in tree.get_terminals()])
+
+def _check_taxonomy(path):
+    """Return an error message or None for the taxonomy CSV file *path*."""
+    with open(path) as f:
+        width = None
+        for row in csv.reader(f):
+            if width is None:
+                width = len(row)
+            if len(row) != width or width <= 1:
+                return "Taxonomy is invalid: not all lines had the same number of fields.", None
+        # I don't try to check if the taxids match up to those
+        # mentioned in aln_fasta, since that would make taxtastic
+        # depend on RefsetInternalFasta in romperroom.
+    return None, None
+
+def _check_phylo_model(path):
+    """Return an error message or None for the JSON file *path*."""
+    with open(path) as f:
+        try:
+            json.load(f)
+        except ValueError, v:
+            return "phylo_model is not valid JSON.", None
+    return None, None
+
+def _check_file(args):
+    """Run a check on a file, returning rather than raising any exception,
+    so that it is only raised if no earlier check failed."""
+    checker, path = args
+    try:
+        return checker(path)
+    except Exception, e:
+        return e, None
+
+# Checks of files under known keys by is_ill_formed, in the order in
+# which their errors are reported.
+_file_checks = [
+    ('aln_fasta', _check_fasta),
+    ('seq_info', _check_seq_info),
+    ('aln_sto', _check_stockholm),
+    ('tree', _check_tree),
+    ('taxonomy', _check_taxonomy),
+    ('phylo_model', _check_phylo_model),
+]
+
+
 def manifest_template():
     return {'metadata': {'create_date': time.strftime('%Y-%m-%d %H:%M:%S'),
                          'format_version': FORMAT_VERSION},
@@ -133,16 +310,47 @@ def transaction(f, self, *args, **kwargs):
 class NoAncestor(Exception):
     pass
 
+VERIFY_MODES = ('full', 'cached', 'none')
+
 class Refpkg(object):
     _manifest_name = 'CONTENTS.json'
+    _md5_cache_name = 'CONTENTS.md5cache.json'
+
+    # How is_invalid checks the MD5 sums of files; see __init__
+    verify = 'cached'
+
+    # Number of files hashed or checked at once
+    jobs = 1
 
-    def __init__(self, path):
+    def __init__(self, path, verify=None, jobs=None):
         """Create a reference to a new or existing RefPkg at *path*.
 
         If there is already a RefPkg at *path*, a reference is
         returned to that RefPkg.  If *path* does not exist, then an
         empty RefPkg is created.
+
+        *verify* sets how the MD5 sums of files are checked when the
+        refpkg is loaded: ``'full'`` hashes every file, ``'cached'``
+        only hashes files whose size, modification time or inode
+        differ from when they were last hashed (as recorded in
+        ``CONTENTS.md5cache.json``), and ``'none'`` only checks that
+        the files exist.  The default is ``Refpkg.verify``.  Files are
+        not hashed again by the same Refpkg unless they change.
+
+        *jobs* sets the number of files hashed at once, and checked at
+        once by ``is_ill_formed``.  The default is ``Refpkg.jobs``.
         """
+        if jobs is not None:
+            self.jobs = jobs
+        if verify is not None:
+            if verify not in VERIFY_MODES:
+                raise ValueError("verify must be one of %s, not %r" %
+                                 (', '.join(VERIFY_MODES), verify))
+            self.verify = verify
+        self._md5_cache = None
+        # MD5 sums computed by this Refpkg, in the same form as the
+        # entries of the cache
+        self._hashed = {}
         # The logic of __init__ is complicated by having to check for
         # validity of a refpkg.  Much of its can be dispatched to the
         # isvalid method, but I want that to work at any time on the
@@ -198,12 +406,13 @@ class Refpkg(object):
         """
         return self.contents['log']
 
-    def is_invalid(self):
+    def is_invalid(self, verify=None):
         """Check if this RefPkg is invalid.
 
         Valid means that it contains a properly named manifest, and
         each of the files described in the manifest exists and has the
-        proper MD5 hashsum.
+        proper MD5 hashsum.  MD5 sums are checked as described by
+        *verify* (see ``__init__``), which defaults to ``self.verify``.
 
         If the Refpkg is valid, is_invalid returns False.  Otherwise it
         returns a nonempty string describing the error.
@@ -250,19 +459,107 @@ class Refpkg(object):
                     (self.contents['files'].keys(),
                      self.contents['md5'].keys())
         # All files in the manifest exist and match the MD5 sums
-        for key,filename in self.contents['files'].iteritems():
-            expected_md5 = self.contents['md5'][key]
+        files = sorted(self.contents['files'].iteritems())
+        for key,filename in files:
             filepath = os.path.join(self.path, filename)
             if not(os.path.exists(filepath)):
                 return "File %s referred to by key %s not found in refpkg" % \
                     (filename, key)
-            found_md5 = md5file(filepath)
+        verify = verify or self.verify
+        if verify == 'none':
+            return False
+        md5s = self._file_md5s((filename for key, filename in files), verify)
+        for key,filename in files:
+            expected_md5 = self.contents['md5'][key]
+            found_md5 = md5s[filename]
             if found_md5 != expected_md5:
+                self._save_md5_cache()
                 return ("File %s referred to by key %s did "
                         "not match its MD5 sum (found: %s, expected %s)") % \
                         (filename, key, found_md5, expected_md5)
+        self._save_md5_cache()
         return False
 
+    def _load_md5_cache(self):
+        """Read the MD5 sums of files recorded in the refpkg's cache.
+
+        The cache maps each filename to a list of its size,
+        modification time and inode when it was hashed, followed by
+        its MD5 sum.  A missing or unreadable cache is treated as
+        empty.
+        """
+        if self._md5_cache is None:
+            self._md5_cache = {}
+            self._md5_cache_dirty = False
+            try:
+                with open(os.path.join(self.path, self._md5_cache_name)) as h:
+                    cache = json.load(h)
+            except (IOError, ValueError):
+                return self._md5_cache
+            if isinstance(cache, dict):
+                self._md5_cache = cache
+        return self._md5_cache
+
+    def _save_md5_cache(self):
+        """Write the MD5 sum cache if it has changed.
+
+        Entries for files no longer in the refpkg directory are
+        dropped.  Failing to write the cache (for example, if the
+        refpkg is read-only) is not an error.
+        """
+        if self._md5_cache is None or not self._md5_cache_dirty:
+            return
+        cache = dict((filename, entry)
+                     for filename, entry in self._md5_cache.iteritems()
+                     if os.path.exists(os.path.join(self.path, filename)))
+        try:
+            with open(os.path.join(self.path, self._md5_cache_name), 'w') as h:
+                json.dump(cache, h, indent=4)
+        except IOError:
+            return
+        self._md5_cache = cache
+        self._md5_cache_dirty = False
+
+    def _file_stat(self, filename):
+        st = os.stat(os.path.join(self.path, filename))
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+    def _record_md5(self, filename, md5_value):
+        """Record *md5_value*, just computed, as the MD5 sum of *filename*."""
+        cache = self._load_md5_cache()
+        cache[filename] = self._hashed[filename] = \
+            self._file_stat(filename) + [md5_value]
+        self._md5_cache_dirty = True
+
+    def _file_md5s(self, filenames, verify=None):
+        """Return a dict of the MD5 sums of *filenames* in the refpkg.
+
+        The sum computed by this Refpkg, or unless *verify* (by
+        default ``self.verify``) is ``'full'`` the sum recorded in the
+        cache, is used for each file which appears unchanged since it
+        was recorded.  The other files are hashed by up to
+        ``self.jobs`` threads.
+        """
+        if (verify or self.verify) == 'full':
+            cache = self._hashed
+        else:
+            cache = self._load_md5_cache()
+        md5s = {}
+        to_hash = []
+        for filename in filenames:
+            entry = cache.get(filename)
+            if (entry is not None and
+                    entry[:3] == self._file_stat(filename)):
+                md5s[filename] = entry[3]
+            else:
+                to_hash.append(filename)
+        hashed = parallel_map(
+            md5file, [os.path.join(self.path, f) for f in to_hash], self.jobs)
+        for filename, md5_value in zip(to_hash, hashed):
+            self._record_md5(filename, md5_value)
+            md5s[filename] = md5_value
+        return md5s
+
     def _sync_to_disk(self):
         """Write any changes made on Refpkg to disk.
 
@@ -313,7 +610,7 @@ class Refpkg(object):
         return old_value
 
     @transaction
-    def update_file(self, key, new_path):
+    def update_file(self, key, new_path, link=False):
         """Insert file *new_path* into the refpkg under *key*.
 
         The filename of *new_path* will be preserved in the refpkg
@@ -322,6 +619,17 @@ class Refpkg(object):
         previous file, if there was one, is left in the refpkg.  If
         you wish to delete it, see the ``strip`` method.
 
+        If *link* is ``True``, *new_path* is hard linked into the
+        refpkg rather than copied when both are on the same
+        filesystem, so only its MD5 sum is computed.  The file must
+        then not be modified in place afterwards, since that would
+        also modify the refpkg.
+
+        If the refpkg stores its files in an object directory (see
+        ``convert_layout``), the file is stored under its MD5 sum
+        instead, and nothing is stored if an identical file is
+        already present.
+
         The full path to the previous file referred to by *key* is
         returned, or ``None`` if *key* was not previously defined in
         the refpkg.
@@ -332,11 +640,17 @@ class Refpkg(object):
             old_path = None
         if not(os.path.isfile(new_path)):
             raise ValueError("Cannot update Refpkg with file %s" % (new_path,))
-        md5_value = md5file(new_path)
-        filename = os.path.basename(new_path)
-        while os.path.exists(os.path.join(self.path, filename)):
-            filename += "1"
-        shutil.copyfile(new_path, os.path.join(self.path, filename))
+        objects = self.contents.get('objects')
+        if objects:
+            filename, md5_value = self._store_object(new_path, objects, link)
+            self.contents.setdefault('names', {})[key] = \
+                os.path.basename(new_path)
+        else:
+            filename = self._unique_filename(os.path.basename(new_path))
+            md5_value = self._store_file(
+                new_path, os.path.join(self.path, filename), link)
+        self._record_md5(filename, md5_value)
+        self._save_md5_cache()
         self.contents['files'][key] = filename
         self.contents['md5'][key] = md5_value
         self._log('Updated file: %s=%s' % (key,new_path))
@@ -344,6 +658,117 @@ class Refpkg(object):
             self.update_phylo_model(None, new_path)
         return old_path
 
+    def _unique_filename(self, filename):
+        """Append a suffix to *filename* until it names no file in the refpkg."""
+        while os.path.exists(os.path.join(self.path, filename)):
+            filename += "1"
+        return filename
+
+    def _store_file(self, src, dest, link=False):
+        """Copy or hard link *src* to *dest*, returning its MD5 sum."""
+        if link:
+            try:
+                os.link(src, dest)
+            except OSError:
+                # e.g. on another filesystem; fall back to copying
+                pass
+            else:
+                return md5file(dest)
+        return copy_md5file(src, dest)
+
+    def _object_dir(self, objects):
+        objects_path = os.path.join(self.path, objects)
+        if not os.path.isdir(objects_path):
+            os.makedirs(objects_path)
+        return objects_path
+
+    def _store_object(self, src, objects, link=False):
+        """Store *src* in the object directory *objects* under its MD5 sum.
+
+        *src* is hashed (after hard linking it into the object
+        directory, if *link* is ``True``) before anything is copied,
+        so nothing is written if the object is already present.
+
+        Returns the filename of the object relative to the refpkg
+        (or absolute, if *objects* is) and the MD5 sum.
+        """
+        objects_path = self._object_dir(objects)
+        fd, tmp_name = tempfile.mkstemp(dir=objects_path, prefix='.tmp')
+        os.close(fd)
+        try:
+            linked = False
+            if link:
+                os.unlink(tmp_name)
+                try:
+                    os.link(src, tmp_name)
+                    linked = True
+                except OSError:
+                    # e.g. on another filesystem; fall back to copying
+                    pass
+            md5_value = md5file(tmp_name if linked else src)
+            dest = os.path.join(objects_path, md5_value)
+            if not os.path.exists(dest):
+                if not linked and copy_md5file(src, tmp_name) != md5_value:
+                    raise ValueError("%s changed while it was stored" % src)
+                os.rename(tmp_name, dest)
+        finally:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+        return os.path.join(objects, md5_value), md5_value
+
+    @transaction
+    def convert_layout(self, objects=None):
+        """Change how the files in the refpkg are stored.
+
+        If *objects* is a path, each file is stored in that directory
+        (relative to the refpkg, unless it is absolute) under its MD5
+        sum, so that identical files are stored once.  Several refpkgs
+        may share an absolute object directory.  If *objects* is
+        ``None``, each file is stored in the refpkg directory under its
+        original name, as by ``update_file``.
+
+        Files are hard linked when possible.  The files in the previous
+        layout are left in place until the refpkg is stripped (see
+        ``strip``), so the conversion can be rolled back.
+        """
+        def link_or_copy(src, dest):
+            try:
+                os.link(src, dest)
+            except OSError:
+                shutil.copyfile(src, dest)
+
+        names = self.contents.get('names', {})
+        for key, filename in sorted(self.contents['files'].iteritems()):
+            src = self.file_abspath(key)
+            md5_value = self.contents['md5'][key]
+            if objects:
+                new_filename = os.path.join(objects, md5_value)
+                dest = os.path.join(self._object_dir(objects), md5_value)
+                if not os.path.exists(dest):
+                    link_or_copy(src, dest)
+                names[key] = names.get(key, os.path.basename(filename))
+            elif self.contents.get('objects'):
+                new_filename = names.get(key, os.path.basename(filename))
+                # reuse the file from before the conversion if it is unchanged
+                if not (os.path.isfile(os.path.join(self.path, new_filename))
+                        and self._file_md5s([new_filename])[new_filename] == md5_value):
+                    new_filename = self._unique_filename(new_filename)
+                    link_or_copy(src, os.path.join(self.path, new_filename))
+            else:
+                continue
+            self._record_md5(new_filename, md5_value)
+            self.contents['files'][key] = new_filename
+        self._save_md5_cache()
+
+        if objects:
+            self.contents['objects'] = objects
+            self.contents['names'] = names
+            self._log('Stored files in object directory %s' % objects)
+        else:
+            self.contents.pop('objects', None)
+            self.contents.pop('names', None)
+            self._log('Stored files under their names')
+
     def file_abspath(self, key):
         """Return the absolute path to the file referenced by *key*."""
         return os.path.join(self.path, self.file_name(key))
@@ -466,16 +891,26 @@ class Refpkg(object):
         refpkg which is not relevant to its current state.
         """
         self._sync_from_disk()
-        current_filenames = set(self.contents['files'].values())
-        all_filenames = set(os.listdir(self.path))
-        to_delete = all_filenames.difference(current_filenames)
-        to_delete.discard('CONTENTS.json')
-        for f in to_delete:
-            os.unlink(os.path.join(self.path, f))
+        keep = set(os.path.normpath(os.path.join(self.path, f))
+                   for f in self.contents['files'].values())
+        keep.add(os.path.join(self.path, self._manifest_name))
+        keep.add(os.path.join(self.path, self._md5_cache_name))
+        # Objects in a shared object directory outside the refpkg may
+        # be used by other refpkgs, so only the refpkg's own directory
+        # is searched.
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(self.path, topdown=False):
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                if path not in keep:
+                    os.unlink(path)
+                    removed += 1
+            if dirpath != self.path and not os.listdir(dirpath):
+                os.rmdir(dirpath)
         self.contents['rollback'] = None
         self.contents['rollforward'] = None
         self.contents['log'].insert(0,
-                                    'Stripped refpkg (removed %d files)' % len(to_delete))
+                                    'Stripped refpkg (removed %d files)' % removed)
         self._sync_to_disk()
 
     def start_transaction(self):
@@ -507,10 +942,13 @@ class Refpkg(object):
         """Stronger set of checks than is_invalid for Refpkg.
 
         Checks that FASTA, Stockholm, JSON, and CSV files under known
-        keys are all valid as well as calling is_invalid.  Returns
-        either False or a string describing the error.
+        keys are all valid as well as calling is_invalid.  The MD5 sum
+        of each file not already hashed by this Refpkg is computed
+        rather than read from the cache, unless ``self.verify`` is
+        ``'none'``.  Returns either False or a string describing the
+        error.
         """
-        m = self.is_invalid()
+        m = self.is_invalid('none' if self.verify == 'none' else 'full')
         if m:
             return m
 
@@ -522,87 +960,40 @@ class Refpkg(object):
 
         # aln_fasta, seq_info, tree, and aln_sto must be valid FASTA,
         # CSV, Newick, and Stockholm files, respectively, and describe
-        # the same sequences.
-
-        def nonempty_file(path):
-            return os.stat(self.file_abspath('aln_fasta')).st_size != 0
+        # the same sequences. Each file is checked by one of up to
+        # self.jobs processes.
+        results = dict(zip(
+            [k for k, _ in _file_checks],
+            parallel_map(_check_file,
+                         [(checker, self.file_abspath(k))
+                          for k, checker in _file_checks],
+                         self.jobs, processes=True)))
+
+        def error(k):
+            m, _ = results[k]
+            if isinstance(m, Exception):
+                raise m
+            return m
 
-        if nonempty_file(self.file_abspath('aln_fasta')):
-            with open(self.file_abspath('aln_fasta')) as f:
-                try:
-                    Bio.SeqIO.read(f, 'fasta')
-                except ValueError, v:
-                    if v[0] == 'No records found in handle':
-                        return 'aln_fasta file is not valid FASTA.'
-
-        if nonempty_file(self.file_abspath('seq_info')):
-            with open(self.file_abspath('seq_info')) as f:
-                lines = list(csv.reader(f))
-                headers = set(lines[0])
-
-                # Check required headers
-                for req_header in 'seqname', 'tax_id':
-                    if not req_header in headers:
-                        return "seq_info is missing {0}".format(req_header)
-                lens = [len(l) for l in lines]
-                if not(all([l == lens[0] and l > 1 for l in lens])):
-                    return "seq_info is not valid CSV."
-
-
-        if nonempty_file(self.file_abspath('aln_sto')):
-            with open(self.file_abspath('aln_sto')) as f:
-                try:
-                    Bio.SeqIO.read(f, 'stockholm')
-                except ValueError, v:
-                    if v[0] == 'No records found in handle':
-                        return 'aln_sto file is not valid Stockholm.'
+        for k in ('aln_fasta', 'seq_info', 'aln_sto', 'tree'):
+            m = error(k)
+            if m:
+                return m
 
-        if nonempty_file(self.file_abspath('tree')):
-            with open(self.file_abspath('tree')) as f:
-                try:
-                    Bio.Phylo.read(f, 'newick')
-                except:
-                    return 'tree file is not valid Newick.'
-
-        with open(self.file_abspath('aln_fasta')) as f:
-            os.stat(self.file_abspath('aln_fasta'))
-
-        with open(self.file_abspath('aln_fasta')) as f:
-            fasta_names = set([s.id for s in Bio.SeqIO.parse(f, 'fasta')])
-        with open(self.file_abspath('seq_info')) as f:
-            csv_names = set([s[0] for s in csv.reader(f)][1:]) # Remove header with [1:]
-        with open(self.file_abspath('tree')) as f:
-            tree_names = set([n.name for n in
-                              Bio.Phylo.read(f, 'newick').get_terminals()])
-        with open(self.file_abspath('aln_sto')) as f:
-            sto_names = set([s.id for s in Bio.SeqIO.parse(f, 'stockholm')])
-        d = fasta_names.symmetric_difference(sto_names)
-        if len(d) != 0:
-            return "Names in aln_fasta did not match aln_sto.  Mismatches: " + \
-                ', '.join([str(x) for x in d])
-        d = fasta_names.symmetric_difference(csv_names)
-        if len(d) != 0:
-            return "Names in aln_fasta did not match seq_info.  Mismatches: " + \
-                ', '.join([str(x) for x in d])
-        d = fasta_names.symmetric_difference(tree_names)
-        if len(d) != 0:
-            return "Names in aln_fasta did not match nodes in tree.  Mismatches: " + \
-                ', '.join([str(x) for x in d])
+        fasta_names = results['aln_fasta'][1]
+        for k, desc in [('aln_sto', 'aln_sto'),
+                        ('seq_info', 'seq_info'),
+                        ('tree', 'nodes in tree')]:
+            d = fasta_names.symmetric_difference(results[k][1])
+            if len(d) != 0:
+                return ("Names in aln_fasta did not match %s.  Mismatches: " % desc) + \
+                    ', '.join(sorted([str(x) for x in d]))
 
         # Next make sure that taxonomy is valid CSV, phylo_model is valid JSON
-        with open(self.file_abspath('taxonomy')) as f:
-            lines = list(csv.reader(f))
-            lens = [len(l) for l in lines]
-            if not(all([l == lens[0] and l > 1 for l in lens])):
-                return "Taxonomy is invalid: not all lines had the same number of fields."
-            # I don't try to check if the taxids match up to those
-            # mentioned in aln_fasta, since that would make taxtastic
-            # depend on RefsetInternalFasta in romperroom.
-        with open(self.file_abspath('phylo_model')) as f:
-            try:
-                json.load(f)
-            except ValueError, v:
-                return "phylo_model is not valid JSON."
+        for k in ('taxonomy', 'phylo_model'):
+            m = error(k)
+            if m:
+                return m
 
         return False
 
@@ -23,7 +23,7 @@ from argparse import RawDescriptionHelpFormatter
 import sys
 import os
 import logging
-from taxtastic import subcommands, __version__ as version
+from taxtastic import refpkg, subcommands, __version__ as version
 
 PROG = os.path.basename(__file__)
 DESCRIPTION = __doc__.strip()
@@ -65,7 +65,11 @@ def parse_arguments(argv):
     parser.add_argument('-q', '--quiet',
         action='store_const', dest='verbosity', const=0,
         help='Suppress output')
-
+    parser.add_argument('--verify', choices=refpkg.VERIFY_MODES,
+        help='How to check the MD5 sums of the files in reference packages '
+             'when loading them: hash every file (full), only files that '
+             'changed since they were last hashed (cached), or not at all '
+             '(none) [%s, or full for check]' % refpkg.Refpkg.verify)
 
     ##########################
     # Setup all sub-commands #
@@ -18,10 +18,13 @@ commands = [
     'info',
     'create',
     'new_database',
+    'convert_database',
+    'convert_refpkg',
     'reroot',
     'update',
     'taxids',
     'update_taxids',
+    'update_database',
     'taxtable',
     'strip',
     'rollback',
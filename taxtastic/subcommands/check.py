@@ -22,13 +22,21 @@ import taxtastic.refpkg
 def build_parser(parser):
     parser.add_argument('refpkg', action='store', metavar='REFPKG',
         help='Path to Refpkg to check')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+        help='Number of files to hash and check at once [%(default)s]')
 
 def action(args):
     if not os.path.isdir(args.refpkg):
         print args.refpkg, 'is not a directory.'
         return 1
 
-    r = taxtastic.refpkg.Refpkg(args.refpkg)
+    # every file is hashed unless taxit --verify says otherwise
+    try:
+        r = taxtastic.refpkg.Refpkg(args.refpkg, verify=args.verify or 'full',
+                                    jobs=args.jobs)
+    except ValueError, e:
+        print e
+        return 1
     msg = r.is_ill_formed()
     if msg:
         print msg
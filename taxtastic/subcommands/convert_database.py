@@ -0,0 +1,70 @@
+"""Convert a taxonomy database to another schema"""
+# This file is part of taxtastic.
+#
+#    taxtastic is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    taxtastic is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
+
+from taxtastic import ncbi
+import os
+import logging
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+def build_parser(parser):
+
+    parser.add_argument(
+        '-d', '--database-file',
+        dest = 'database_file',
+        metavar = 'FILE',
+        required = True,
+        help = """Name of the sqlite database file to convert.""")
+
+    parser.add_argument(
+        '-o', '--out-file',
+        dest = 'out_file',
+        metavar = 'FILE',
+        required = True,
+        help = """Name of the new sqlite database file.""")
+
+    parser.add_argument(
+        '-s', '--schema',
+        dest = 'schema',
+        choices = sorted(ncbi.db_schemas.keys()),
+        default = 'integer',
+        help = """Schema of the new database; "integer" stores tax_ids
+        as integers, "text" as strings. [%(default)s]""")
+
+    parser.add_argument(
+        '-x', '--clobber', action = 'store_true',
+        dest = 'clobber', default = False,
+        help = """Replace the output file if it already exists. [%(default)s]""")
+
+def action(args):
+
+    if not os.access(args.database_file, os.F_OK):
+        log.error('taxonomy database %s does not exist' % args.database_file)
+        return 1
+
+    if os.access(args.out_file, os.F_OK) and not args.clobber:
+        log.error('%s already exists; use --clobber to replace it' % args.out_file)
+        return 1
+
+    con = sqlite3.connect(args.database_file)
+    log.warning('converting %s (%s schema) to %s (%s schema)' % (
+            args.database_file, ncbi.schema_name(con), args.out_file, args.schema))
+    new_con = ncbi.db_convert(con, args.out_file, schema=args.schema, clobber=True)
+    new_con.close()
+    con.close()
+
+    return 0
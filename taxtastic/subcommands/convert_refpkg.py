@@ -0,0 +1,61 @@
+"""Change how the files in a refpkg are stored
+
+By default, each file is stored in the refpkg directory under its
+original name. With --objects, each file is stored in an object
+directory under its MD5 sum, so that identical files are stored once,
+and the object directory may be shared by several refpkgs:
+
+$ taxit convert_refpkg my-refpkg --objects objects
+$ taxit convert_refpkg my-refpkg --objects /shared/refpkg-objects
+
+Use --flat to store the files under their original names again.  The
+files in the previous layout are removed by taxit strip.
+"""
+# This file is part of taxtastic.
+#
+#    taxtastic is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    taxtastic is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from taxtastic import refpkg
+
+log = logging.getLogger(__name__)
+
+def build_parser(parser):
+    parser.add_argument('refpkg', action='store', metavar='refpkg',
+                        help='the reference package to operate on')
+    layout = parser.add_mutually_exclusive_group(required=True)
+    layout.add_argument('--objects', metavar='DIR',
+                        help=('store files under their MD5 sums in DIR, '
+                              'relative to the refpkg unless absolute'))
+    layout.add_argument('--flat', action='store_true', default=False,
+                        help='store files under their original names')
+
+
+def action(args):
+    """Converts a refpkg to another layout.
+
+    *args* should be an argparse object with fields refpkg (giving the
+    path to the refpkg to operate on), objects (the object directory,
+    or None) and flat.
+    """
+    log.info('loading reference package')
+
+    rp = refpkg.Refpkg(args.refpkg, verify=args.verify)
+    objects = None if args.flat else args.objects
+    log.warning('storing files of %s %s' % (
+        args.refpkg,
+        'under their names' if objects is None else 'in ' + objects))
+    rp.convert_layout(objects)
+    return 0
@@ -20,7 +20,7 @@ import sys
 
 from taxtastic import lonely
 from sqlalchemy import create_engine
-from taxtastic.taxonomy import Taxonomy
+from taxtastic.taxonomy import Taxonomy, MemoryTaxonomy
 from taxtastic import ncbi
 
 
@@ -43,6 +43,9 @@ def build_parser(parser):
     parser.add_argument('-o', '--output',
                         action='store', default=None,
                         help='Write output to given file')
+    parser.add_argument("--in-memory",
+                        action="store_true", default=False,
+                        help="Load the taxonomy into memory before searching")
 
 
 def action(args):
@@ -55,7 +58,10 @@ def action(args):
                 taxids.append(val.strip())
     # Connect to the taxonomy
     engine = create_engine('sqlite:///%s' % args.taxdb, echo=False)
-    tax = Taxonomy(engine, ncbi.ranks)
+    if args.in_memory:
+        tax = MemoryTaxonomy(engine, ncbi.ranks)
+    else:
+        tax = Taxonomy(engine, ncbi.ranks)
     # Finally, real work...
     if args.cut:
         company = lonely.lonely_company(tax, taxids)
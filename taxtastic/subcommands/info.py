@@ -57,7 +57,7 @@ def action(args):
     """
     log.info('loading reference package')
 
-    pkg = refpkg.Refpkg(args.refpkg)
+    pkg = refpkg.Refpkg(args.refpkg, verify=args.verify)
 
     with open(pkg.file_abspath('seq_info')) as seq_info:
         snames = [row['seqname'] for row in csv.DictReader(seq_info)]
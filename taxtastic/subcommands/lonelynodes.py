@@ -52,7 +52,7 @@ def action(args):
         try:
             if args.verbose:
                 print >>sys.stderr, "Target is a refpkg. Working on taxonomy within it."
-            r = refpkg.Refpkg(args.target)
+            r = refpkg.Refpkg(args.target, verify=args.verify)
             path = r.file_abspath('taxonomy')
         except e:
             print >>sys.stderr, "Failed: %s" % str(e)
@@ -18,6 +18,7 @@ from taxtastic import ncbi
 import os
 from os import path
 import logging
+import time
 
 log = logging.getLogger(__name__)
 
@@ -45,6 +46,41 @@ def build_parser(parser):
         and/or re-create the database even if one or both already
         exists. [%(default)s]""")
 
+    parser.add_argument(
+        '-s', '--schema',
+        dest = 'schema',
+        choices = sorted(ncbi.db_schemas.keys()),
+        default = 'text',
+        help = """Database schema; "integer" stores tax_ids as integers,
+        resulting in a smaller and faster database. [%(default)s]""")
+
+    parser.add_argument(
+        '-j', '--jobs', type = int,
+        dest = 'jobs', default = 1, metavar = 'N',
+        help = """Number of worker processes used to parse the files
+        in the zip archive in parallel. [%(default)s]""")
+
+    parser.add_argument(
+        '--lineages', action = 'store_true',
+        dest = 'lineages', default = False,
+        help = """Precompute the lineage of each node so that
+        lineages can be retrieved using a single query; increases
+        the size of the database. [%(default)s]""")
+
+    parser.add_argument(
+        '--hierarchy', action = 'store_true',
+        dest = 'hierarchy', default = False,
+        help = """Number nodes as nested sets so that ancestors and
+        descendants can be found using a comparison or an index range
+        scan. [%(default)s]""")
+
+    parser.add_argument(
+        '--name-index', action = 'store_true',
+        dest = 'name_index', default = False,
+        help = """Index normalized names and trigrams of names for
+        case-insensitive and fuzzy name searches (see "taxit taxids
+        --fuzzy"). [%(default)s]""")
+
 def action(args):
 
     dbname = args.database_file
@@ -58,9 +94,26 @@ def action(args):
     if not os.access(dbname, os.F_OK) or args.clobber:
         log.warning('creating new database in %s using data in %s' % \
                         (dbname, zfile))
-        con = ncbi.db_connect(dbname, clobber=True)
-        ncbi.db_load(con, zfile)
+        tables, _ = ncbi.db_schemas[args.schema]
+        con = ncbi.db_connect(dbname, schema=tables, clobber=True)
+        # db_load logs the time taken by each stage of the load
+        ncbi.db_load(con, zfile, bulk=True, jobs=args.jobs)
+        timings = []
+        if args.lineages:
+            start = time.time()
+            ncbi.db_lineages(con)
+            timings.append(('build lineages', time.time() - start))
+        if args.hierarchy:
+            start = time.time()
+            ncbi.db_hierarchy(con)
+            timings.append(('build hierarchy', time.time() - start))
+        if args.name_index:
+            start = time.time()
+            ncbi.db_name_index(con)
+            timings.append(('build name index', time.time() - start))
         con.close()
+        for stage, seconds in timings:
+            log.info('%s: %.2f s' % (stage, seconds))
     else:
         log.warning('taxonomy database already exists in %s' % dbname)
 
@@ -36,7 +36,7 @@ def test_output(infile, outfile, ranks):
 
 
 def action(args):
-    rp = Refpkg(args.refpkg)
+    rp = Refpkg(args.refpkg, verify=args.verify)
     rp.load_db()
     cursor = rp.db.cursor()
     ranks = args.ranks.split(',')
@@ -46,7 +46,7 @@ def action(args):
     """
     log.info('loading reference package')
 
-    r = refpkg.Refpkg(args.refpkg)
+    r = refpkg.Refpkg(args.refpkg, verify=args.verify)
 
     # First check if we can do n rollbacks
     q = r.contents
@@ -18,39 +18,33 @@ import logging
 import argparse
 import sys
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select, and_, func
 
-from taxtastic.taxonomy import Taxonomy
+from taxtastic.taxonomy import Taxonomy, in_chunk_size
 from taxtastic.ncbi import ranks as ncbi_ranks
 
 log = logging.getLogger(__name__)
 
-def get_children(engine, parent_ids, rank = 'species'):
+def get_children(tax, parent_ids, rank = 'species'):
     """
-    Recursively fetch children of tax_ids in `parent_ids` until the
-    rank of `rank`
-    """
-
-    if not parent_ids:
-        return []
-
-    cmd = """
-    select tax_id, tax_name, rank from nodes join names using (tax_id)
-    where parent_id = "%s"
-    and is_primary = 1
+    Fetch descendants of tax_ids in `parent_ids` having rank `rank`,
+    descending through nodes of any rank other than `rank` or
+    "no_rank" (see Taxonomy.descendants_of). Returns (keys, rows),
+    where rows is a list of dicts with keys "tax_id", "tax_name" and
+    "rank" for descendants with a primary name not containing "sp.".
     """
 
+    keys = ['tax_id', 'tax_name', 'rank']
+    tax_ids = tax.descendants_of(parent_ids, rank, stop_ranks=[rank, 'no_rank'])
+    names = tax.names
     species = []
-    for parent_id in parent_ids:
-        result = engine.execute(cmd % parent_id)
-        keys = result.keys()
-        rows = [dict(zip(keys, row)) for row in result.fetchall()]
-        species.extend([r for r in rows if r['rank'] == rank and 'sp.' not in r['tax_name']])
-
-        others = [r for r in rows if r['rank'] not in (rank, 'no_rank')]
-        if others:
-            _, s = get_children(engine, [r['tax_id'] for r in others])
-            species.extend(s)
+    for i in xrange(0, len(tax_ids), in_chunk_size):
+        s = select([names.c.tax_id, names.c.tax_name],
+                   and_(names.c.tax_id.in_(tax_ids[i:i+in_chunk_size]),
+                        names.c.is_primary == 1,
+                        func.instr(names.c.tax_name, 'sp.') == 0))
+        species.extend(dict(tax_id=unicode(tax_id), tax_name=tax_name, rank=rank)
+                       for tax_id, tax_name in s.execute())
 
     return keys, species
 
@@ -63,6 +57,20 @@ def build_parser(parser):
         help='Filename of sqlite database [%(default)s].',
         metavar='FILE', required = True)
 
+    parser.add_argument(
+        '--fuzzy', action = 'store_true',
+        dest = 'fuzzy', default = False,
+        help = """Replace names that are not found with the most
+        similar name in the taxonomy, if its similarity is at least
+        --min-score. Faster if the database was created using
+        "taxit new_database --name-index". [%(default)s]""")
+
+    parser.add_argument(
+        '--min-score', type = float,
+        dest = 'min_score', default = 0.8, metavar = 'SCORE',
+        help = """Minimum similarity (between 0 and 1) of names
+        matched using --fuzzy. [%(default)s]""")
+
     input_group = parser.add_argument_group(
         "Input options").add_mutually_exclusive_group()
 
@@ -103,26 +111,44 @@ def action(args):
     if taxnames:
         names += [x.strip() for x in taxnames.split(',')]
 
+    found = tax.primary_from_names(names)
+
+    # keys: names not found; vals: most similar name
+    similar = {}
+    if args.fuzzy:
+        for name in set(names) - set(found):
+            for tax_id, tax_name, is_primary, score in tax.search_names(name, limit=1):
+                if score >= args.min_score:
+                    similar[name] = tax_name
+                    found[name] = (tax_id, tax.primary_from_id(tax_id), is_primary)
+
+    ranks = tax.ranks_from_ids(tax_id for tax_id, _, _ in found.values())
+
     taxa = {}
-    for name in set(names):
+    # tax_ids whose descendants are fetched together below
+    parent_ids = set()
+    for name in sorted(set(names)):
         tax_id, tax_name, is_primary, rank, note = '','','','', ''
 
-        try:
-            tax_id, tax_name, is_primary = tax.primary_from_name(name)
-        except KeyError, msg:
-            note = 'not found'
-        else:
-            parent, rank = tax._node(tax_id)
+        if name in found:
+            tax_id, tax_name, is_primary = found[name]
+            rank = ranks[tax_id]
             note = '' if is_primary else 'not primary'
+            if name in similar:
+                note = ', '.join(filter(None, ['similar to "%s"' % similar[name], note]))
+        else:
+            note = 'not found'
 
         if note:
             log.warning('%(name)20s | %(tax_id)7s %(tax_name)20s %(note)s' % locals())
 
         if rank == 'species':
             taxa[tax_id] = dict(tax_id=tax_id, tax_name=tax_name, rank=rank)
-        else:
-            keys, rows = get_children(engine, [tax_id])
-            taxa.update(dict((row['tax_id'], row) for row in rows))
+        elif tax_id:
+            parent_ids.add(tax_id)
+
+    keys, rows = get_children(tax, parent_ids)
+    taxa.update(dict((row['tax_id'], row) for row in rows))
 
     for d in sorted(taxa.values(), key = lambda x: x['tax_name']):
         outfile.write('%(tax_id)s # %(tax_name)s\n' % d)
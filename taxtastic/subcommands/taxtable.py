@@ -21,7 +21,7 @@ import logging
 import re
 
 from taxtastic import ncbi
-from taxtastic.taxonomy import Taxonomy
+from taxtastic.taxonomy import Taxonomy, MemoryTaxonomy
 from taxtastic.utils import getlines
 
 from sqlalchemy import create_engine
@@ -40,6 +40,12 @@ def build_parser(parser):
         required = True,
         help = 'Name of the sqlite database file')
 
+    parser.add_argument(
+        '--in-memory', action = 'store_true',
+        dest = 'in_memory', default = False,
+        help = """Load the taxonomy into memory before looking up
+        lineages; faster for large numbers of taxa. [%(default)s]""")
+
     input_group = parser.add_argument_group(
         "Input options").add_mutually_exclusive_group()
 
@@ -81,7 +87,10 @@ def build_parser(parser):
 
 def action(args):
     engine = create_engine('sqlite:///%s' % args.database_file, echo=args.verbosity > 2)
-    tax = Taxonomy(engine, ncbi.ranks)
+    if args.in_memory:
+        tax = MemoryTaxonomy(engine, ncbi.ranks)
+    else:
+        tax = Taxonomy(engine, ncbi.ranks)
 
     taxids = set()
 
@@ -93,10 +102,17 @@ def action(args):
             taxids.update([x.strip() for x in re.split(r'[\s,;]+', args.taxids)])
 
     if args.taxnames:
+        names = set()
         for taxname in getlines(args.taxnames):
-            for name in re.split(r'\s*[,;]\s*', taxname):
-                tax_id, primary_name, is_primary = tax.primary_from_name(name.strip())
-                taxids.add(tax_id)
+            names.update(name.strip() for name in re.split(r'\s*[,;]\s*', taxname))
+        found = tax.primary_from_names(names)
+        missing = names - set(found)
+        if missing:
+            for name in sorted(missing):
+                print >>sys.stderr, "Taxonomic name %s not found in taxonomy." % name
+            print >>sys.stderr, "Some taxonomic names were invalid.  Exiting."
+            return 1
+        taxids.update(tax_id for tax_id, _, _ in found.values())
 
     if args.seq_info:
         with args.seq_info:
@@ -105,27 +121,22 @@ def action(args):
 
     # Before digging into lineages, make sure all the taxids exist in
     # the taxonomy database.
-    valid_taxids = True
-    for t in taxids:
-        try:
-            tax._node(t)
-        except KeyError:
-            # Check for merged
-            m = tax._get_merged(t)
-            if m and m != t:
-                print >> sys.stderr, ("Taxid {0} has been replaced by {1}. "
-                        "Please update your records").format(t, m)
-            else:
-                print >>sys.stderr, "Taxid %s not found in taxonomy." % t
-            valid_taxids = False
-    if not(valid_taxids):
+    missing = tax.missing_tax_ids(taxids)
+    for t, m in sorted(missing.items()):
+        if m and m != t:
+            print >> sys.stderr, ("Taxid {0} has been replaced by {1}. "
+                    "Please update your records").format(t, m)
+        else:
+            print >>sys.stderr, "Taxid %s not found in taxonomy." % t
+    if missing:
         print >>sys.stderr, "Some taxids were invalid.  Exiting."
         return 1 # exits with code 1
 
     # Extract all the taxids to be exported in the CSV file.
+    lineages = tax._load_lineages(taxids)
     taxids_to_export = set()
     for t in taxids:
-        taxids_to_export.update([y for (x,y) in tax._get_lineage(t)])
+        taxids_to_export.update([y for (x,y) in lineages[t]])
 
     tax.write_table(taxids_to_export, csvfile = args.out_file)
 
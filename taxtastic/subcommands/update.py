@@ -40,6 +40,9 @@ def build_parser(parser):
                         help='keys to update, in key=some_file format')
     parser.add_argument('--metadata', action='store_const', const=True,
                         default=False, help='Update metadata instead of files')
+    parser.add_argument('--link', action='store_true', default=False,
+                        help=('Hard link files into the refpkg instead of '
+                              'copying them, if they are on the same filesystem'))
 
 
 def action(args):
@@ -54,7 +57,7 @@ def action(args):
 
     pairs = [p.split('=',1) for p in args.changes]
     if args.metadata:
-        rp = refpkg.Refpkg(args.refpkg)
+        rp = refpkg.Refpkg(args.refpkg, verify=args.verify)
         rp.start_transaction()
         for (key,value) in pairs:
             rp.update_metadata(key, value)
@@ -67,10 +70,10 @@ def action(args):
                 print "No such file: %s" % filename
                 exit(1)
 
-        rp = refpkg.Refpkg(args.refpkg)
+        rp = refpkg.Refpkg(args.refpkg, verify=args.verify)
         rp.start_transaction()
         for (key,filename) in pairs:
-            rp.update_file(key, os.path.abspath(filename))
+            rp.update_file(key, os.path.abspath(filename), link=args.link)
         rp.commit_transaction('Updates files: ' + \
                                   ', '.join(['%s=%s' % (a,b)
                                              for a,b in pairs]))
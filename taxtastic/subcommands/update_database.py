@@ -0,0 +1,81 @@
+"""Update a taxonomy database using a newer release of the NCBI taxonomy"""
+# This file is part of taxtastic.
+#
+#    taxtastic is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    taxtastic is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
+
+from taxtastic import ncbi
+import os
+from os import path
+import logging
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+def build_parser(parser):
+
+    parser.add_argument(
+        '-d', '--database-file',
+        dest = 'database_file',
+        default = 'ncbi_taxonomy.db',
+        metavar = 'FILE',
+        help = """Name of the sqlite database file to update [%(default)s].""")
+
+    parser.add_argument(
+        '-z', '--zip-file',
+        dest = 'zip_file',
+        metavar = 'FILE',
+        help = """Zip archive containing the NCBI taxonomy; if not
+        provided, the archive is downloaded.""")
+
+    parser.add_argument(
+        '-p', '--download-dir',
+        dest = 'download_dir',
+        default = None,
+        metavar = 'PATH',
+        help = """Name of the directory into which to download the zip
+        archive. [default is the same directory as the database file]""")
+
+    parser.add_argument(
+        '-x', '--clobber', action = 'store_true',
+        dest = 'clobber', default = False,
+        help = """Download a new zip archive containing NCBI taxonomy
+        even if one already exists. [%(default)s]""")
+
+def action(args):
+
+    dbname = args.database_file
+    if not os.access(dbname, os.F_OK):
+        log.error('taxonomy database %s does not exist' % dbname)
+        return 1
+
+    if args.zip_file:
+        zfile = args.zip_file
+    else:
+        pth, fname = path.split(dbname)
+        zfile, downloaded = ncbi.fetch_data(
+            dest_dir = args.download_dir or pth or '.',
+            clobber = args.clobber)
+
+    log.warning('updating database %s using data in %s' % (dbname, zfile))
+    con = sqlite3.connect(dbname)
+    counts = ncbi.db_update(con, zfile)
+    con.close()
+
+    for tablename, _ in ncbi.dmp_tables:
+        log.warning('%s: %s' % (tablename, ', '.join(
+                    '%s %s' % (counts[tablename][k], k)
+                    for k in ['inserted', 'updated', 'deleted']
+                    if k in counts[tablename])))
+
+    return 0
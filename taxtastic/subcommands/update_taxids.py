@@ -19,17 +19,31 @@ file as passed to `taxit create --seq-info`
 #    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
 import argparse
 import csv
+import itertools
 import logging
 import os.path
 import sys
 
 import sqlalchemy
 
-from taxtastic.taxonomy import Taxonomy
+from taxtastic.taxonomy import Taxonomy, MemoryTaxonomy
 from taxtastic import ncbi
 
 log = logging.getLogger(__name__)
 
+def positive_int(value):
+    """
+    argparse type for an integer of at least 1.
+    """
+
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid int value: %r' % value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1: %r' % value)
+    return value
+
 def build_parser(parser):
     parser.add_argument('infile', help="""Input CSV file to process, minimally
             containing the fields 'seqname' and 'tax_id'. Rows with missing
@@ -42,6 +56,13 @@ def build_parser(parser):
     parser.add_argument('-u', '--unknown-action', help="""Action to take on
             encountering an unknown tax_id [default: %(default)s]""",
             choices=('halt', 'remove'), default='halt')
+    parser.add_argument('--in-memory', action='store_true', default=False,
+            help="""Load the taxonomy into memory before updating
+            tax_ids""")
+    parser.add_argument('--chunk-size', type=positive_int, default=10000,
+            metavar='N', help="""Number of rows to read at a time; the
+            distinct tax_ids in each chunk are checked against the
+            taxonomy using a single query [default: %(default)s]""")
 
 
 def load_csv(fp):
@@ -56,39 +77,43 @@ def load_csv(fp):
     reader = csv.DictReader(fp, dialect=dialect)
     return (reader.fieldnames, dialect, reader)
 
-def taxid_updater(taxonomy, action='halt'):
+def update_rows(taxonomy, rows, action='halt', chunk_size=10000):
     """
-    Create a function to update obsolete taxonomies in
+    Generator yielding rows with obsolete tax_ids replaced. Rows are
+    read chunk_size at a time, and the distinct tax_ids in each chunk
+    are looked up using a single call to taxonomy.missing_tax_ids, so
+    only one chunk is held in memory.
     """
-    def update_taxid(row):
-        current_tax_id = row['tax_id']
-        if not current_tax_id:
-            # Skip blank
-            return row
-        try:
-            node = taxonomy._node(current_tax_id)
-            # _node raises KeyError if the taxon couldn't be found in the
-            # current taxonomy. If found, no update needed.
-            return row
-        except KeyError:
-            pass
-        new_tax_id = taxonomy._get_merged(current_tax_id)
-
-        if new_tax_id and new_tax_id != current_tax_id:
-            row['tax_id'] = new_tax_id
-            log.warn('Replacing %s with %s [%s]', current_tax_id, new_tax_id,
-                    row['seqname'])
-        elif action == 'halt':
-            raise KeyError("Unknown taxon {0}".format(current_tax_id))
-        elif action == 'remove':
-            logging.warn('Unknown Taxon: %s. Removing.', current_tax_id)
-            row['tax_id'] = ''
-        else:
-            assert False
-
-        return row
-
-    return update_taxid
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        missing = taxonomy.missing_tax_ids(
+            row['tax_id'] for row in chunk if row['tax_id'])
+
+        for row in chunk:
+            current_tax_id = row['tax_id']
+            if current_tax_id not in missing:
+                # blank, or found in the current taxonomy
+                yield row
+                continue
+
+            new_tax_id = missing[current_tax_id]
+            if new_tax_id and new_tax_id != current_tax_id:
+                row['tax_id'] = new_tax_id
+                log.warn('Replacing %s with %s [%s]', current_tax_id, new_tax_id,
+                        row['seqname'])
+            elif action == 'halt':
+                raise KeyError("Unknown taxon {0}".format(current_tax_id))
+            elif action == 'remove':
+                logging.warn('Unknown Taxon: %s. Removing.', current_tax_id)
+                row['tax_id'] = ''
+            else:
+                assert False
+
+            yield row
 
 
 def action(args):
@@ -100,7 +125,10 @@ def action(args):
         return 1
 
     e = sqlalchemy.create_engine('sqlite:///{0}'.format(args.database_file))
-    tax = Taxonomy(e, ncbi.ranks)
+    if args.in_memory:
+        tax = MemoryTaxonomy(e, ncbi.ranks)
+    else:
+        tax = Taxonomy(e, ncbi.ranks)
 
     headers, dialect, rows = load_csv(args.infile)
 
@@ -108,8 +136,7 @@ def action(args):
         if header not in headers:
             raise ValueError("Missing required field: {0}".format(header))
 
-    update = taxid_updater(tax, args.unknown_action)
-    updated = (update(row) for row in rows)
+    updated = update_rows(tax, rows, args.unknown_action, args.chunk_size)
 
     with args.out_file as fp:
         writer = csv.DictWriter(fp, headers, dialect)
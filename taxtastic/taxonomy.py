@@ -12,19 +12,140 @@
 #
 #    You should have received a copy of the GNU General Public License
 #    along with taxtastic.  If not, see <http://www.gnu.org/licenses/>.
+import array
+import collections
 import logging
 import csv
+import difflib
 import itertools
+import resource
+import time
 
 log = logging
 
 import sqlalchemy
 from sqlalchemy import MetaData, and_, or_
 from sqlalchemy.sql import select
+from sqlalchemy.types import TypeDecorator, Integer
+
+import ncbi
+
+class TaxIdType(TypeDecorator):
+    """
+    Column type for tax_ids stored as integers (see
+    ncbi.db_tables_integer); values are returned as strings so that
+    tax_ids are represented the same way regardless of the schema.
+    """
+
+    impl = Integer
+
+    def process_bind_param(self, value, dialect):
+        return value
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else unicode(value)
+
+# maximum number of values in each "IN (...)" list; sqlite limits the
+# number of parameters in a statement
+in_chunk_size = 500
+
+# keys: table name; vals: columns containing tax_ids
+tax_id_columns = {
+    'nodes': ['tax_id', 'parent_id'],
+    'names': ['tax_id'],
+    'merged': ['old_tax_id', 'new_tax_id'],
+    'lineages': ['tax_id'],
+    'hierarchy': ['tax_id'],
+    }
+
+class LineageCache(object):
+    """
+    A dict-like cache of lineages keyed by tax_id. If capacity is not
+    None, the least recently used entries are evicted once the cache
+    contains more than capacity entries. Each lineage is a separate
+    list (lineages share only their (rank, tax_id) tuples), so
+    evicting the lineage of a taxon does not affect those of its
+    ancestors or descendants.
+
+    Lookups using get or [] are counted in attributes hits and
+    misses, and evicted entries in evictions.
+    """
+
+    def __init__(self, capacity=None):
+        if capacity is not None and capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self._data = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, tax_id, default=None):
+        try:
+            value = self._data.pop(tax_id)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        # move to the end (most recently used)
+        self._data[tax_id] = value
+        self.hits += 1
+        return value
+
+    def __getitem__(self, tax_id):
+        value = self.get(tax_id, _missing)
+        if value is _missing:
+            raise KeyError(tax_id)
+        return value
+
+    def __setitem__(self, tax_id, value):
+        self._data.pop(tax_id, None)
+        self._data[tax_id] = value
+        if self.capacity is not None:
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def setdefault(self, tax_id, value):
+        if tax_id in self._data:
+            return self[tax_id]
+        self[tax_id] = value
+        return value
+
+    def __contains__(self, tax_id):
+        return tax_id in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        """
+        Returns a dict of cache statistics.
+        """
+
+        return {'size': len(self._data), 'capacity': self.capacity,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+_missing = object()
 
 class Taxonomy(object):
 
-    def __init__(self, engine, ranks, undefined_rank='no_rank', undef_prefix='below'):
+    def __init__(self, engine, ranks, undefined_rank='no_rank', undef_prefix='below',
+                 cache=None):
         """
         The Taxonomy class defines an object providing an interface to
         the taxonomy database.
@@ -36,6 +157,9 @@ class Taxonomy(object):
           a specific rank in the taxonomy.
         * undef_prefix - string prepended to name of parent
           rank to create new labels for undefined ranks.
+        * cache - dict-like object in which lineages are cached;
+          defaults to an unbounded LineageCache. Use, for example,
+          LineageCache(capacity=100000) to limit memory use.
 
         Example:
         >>> from sqlalchemy import create_engine
@@ -64,12 +188,21 @@ class Taxonomy(object):
         self.source = self.meta.tables['source']
         self.merged = self.meta.tables['merged']
 
+        # present integer tax_ids as strings
+        for tablename, columns in tax_id_columns.items():
+            if tablename not in self.meta.tables:
+                continue
+            for colname in columns:
+                column = self.meta.tables[tablename].c[colname]
+                if isinstance(column.type, Integer):
+                    column.type = TaxIdType()
+
         self.ranks = ranks
         self.rankset = set(self.ranks)
 
         # keys: tax_id
         # vals: lineage represented as a list of tuples: (rank, tax_id)
-        self.cached = {}
+        self.cached = LineageCache() if cache is None else cache
 
         # keys: tax_id
         # vals: lineage represented as a dict of {rank:tax_id}
@@ -78,6 +211,22 @@ class Taxonomy(object):
         self.undefined_rank = undefined_rank
         self.undef_prefix = undef_prefix
 
+        # keys: old_tax_id; vals: new_tax_id (see _get_merged)
+        self._merged = None
+        self._merged_duplicates = set()
+
+        # precomputed lineages (see ncbi.db_lineages) can be used
+        # only if undefined ranks are named the same way
+        self.lineages_table = None
+        if (undefined_rank, undef_prefix) == (ncbi.undefined_rank, ncbi.undef_prefix):
+            self.lineages_table = self.meta.tables.get('lineages')
+
+        # nested-set index of nodes (see ncbi.db_hierarchy)
+        self.hierarchy = self.meta.tables.get('hierarchy')
+
+        # full-text index of names (see ncbi.db_name_index)
+        self.names_fts = self.meta.tables.get('names_fts')
+
     def _add_rank(self, rank, parent_rank):
         """
         inserts rank into self.ranks.
@@ -141,6 +290,168 @@ class Taxonomy(object):
 
         return tax_id, tax_name, bool(is_primary)
 
+    def primary_from_names(self, tax_names):
+        """
+        Returns a dict mapping each of tax_names found in table
+        "names" to a tuple (tax_id, primary tax_name, is_primary) as
+        provided by self.primary_from_name; names that are not found
+        are omitted. Names are loaded into a temporary table and
+        resolved using a single join. If a name is both a primary
+        name and a synonym, the tax_id for which it is primary is
+        returned.
+        """
+
+        tax_names = set(tax_names)
+        if not tax_names:
+            return {}
+
+        conn = self.engine.connect()
+        try:
+            self._temp_table(conn, 'query_names', 'tax_name TEXT', tax_names)
+            # the values of bare columns are taken from the row
+            # providing max(is_primary)
+            result = conn.execute("""
+                SELECT q.tax_name, n.tax_id, p.tax_name, max(n.is_primary)
+                FROM temp.query_names q
+                JOIN names n ON n.tax_name = q.tax_name
+                JOIN names p ON p.tax_id = n.tax_id AND p.is_primary = 1
+                GROUP BY q.tax_name""")
+            output = dict((tax_name, (unicode(tax_id), primary_name, bool(is_primary)))
+                          for tax_name, tax_id, primary_name, is_primary in result)
+            conn.execute('DROP TABLE temp.query_names')
+        finally:
+            conn.close()
+
+        return output
+
+    def _temp_table(self, conn, tablename, column, values):
+        """
+        (Re)create temporary table `tablename` with a single primary
+        key column defined by `column` (eg, "tax_name TEXT") using
+        connection conn, and insert values. The table exists only for
+        the lifetime of conn.
+        """
+
+        colname = column.split()[0]
+        conn.execute('DROP TABLE IF EXISTS temp.%s' % tablename)
+        conn.execute('CREATE TEMPORARY TABLE %s (%s PRIMARY KEY)' % (tablename, column))
+        conn.execute(sqlalchemy.text('INSERT INTO temp.%s (%s) VALUES (:value)' % (
+                    tablename, colname)), [{'value': value} for value in values])
+
+    def missing_tax_ids(self, tax_ids):
+        """
+        Returns a dict mapping each of tax_ids not found in table
+        "nodes" to the tax_id into which it has been merged, or to
+        None if it is not found in table "merged" either. The tax_ids
+        are loaded into a temporary table and checked using a single
+        query.
+        """
+
+        tax_ids = set(tax_ids)
+        if not tax_ids:
+            return {}
+
+        conn = self.engine.connect()
+        try:
+            # the column has no type affinity, so values are compared
+            # using that of nodes.tax_id
+            self._temp_table(conn, 'query_tax_ids', 'tax_id', tax_ids)
+            result = conn.execute("""
+                SELECT q.tax_id, m.new_tax_id
+                FROM temp.query_tax_ids q
+                LEFT JOIN merged m ON m.old_tax_id = q.tax_id
+                WHERE NOT EXISTS (SELECT 1 FROM nodes n WHERE n.tax_id = q.tax_id)""")
+            output = dict((tax_id, None if new_tax_id is None else unicode(new_tax_id))
+                          for tax_id, new_tax_id in result)
+            conn.execute('DROP TABLE temp.query_tax_ids')
+        finally:
+            conn.close()
+
+        return output
+
+    def ranks_from_ids(self, tax_ids):
+        """
+        Returns a dict mapping each of tax_ids found in table "nodes"
+        to its rank; tax_ids that are not found are omitted. Nodes are
+        fetched in chunks of in_chunk_size.
+        """
+
+        return dict((unicode(tax_id), rank) for tax_id, rank in self._select_in(
+                [self.nodes.c.tax_id, self.nodes.c.rank],
+                self.nodes.c.tax_id, set(tax_ids)))
+
+    def search_names(self, query, limit=10):
+        """
+        Returns a list of up to `limit` tuples (tax_id, tax_name,
+        is_primary, score) for names resembling `query`, in order of
+        decreasing score: the similarity of the normalized names (see
+        ncbi.name_normalization) as calculated by
+        difflib.SequenceMatcher, which is 1.0 for names differing from
+        query only in case or spacing.
+
+        If the indices created by ncbi.db_name_index are present,
+        candidates are names equal to query once normalized,
+        containing query, or sharing trigrams with query; otherwise
+        only names equal to query once normalized are found, using a
+        full scan of table "names".
+        """
+
+        normalize = ncbi.name_normalization
+        cmd = sqlalchemy.text('SELECT %s' % normalize % ':query')
+        normalized = self.engine.execute(cmd, query=query).scalar()
+
+        if self.names_fts is None:
+            cmd = 'SELECT rowid FROM names WHERE %s = :normalized' % normalize % 'tax_name'
+        else:
+            cmd = 'SELECT rowid FROM names WHERE normalized_name = :normalized'
+        rowids = set(row[0] for row in self.engine.execute(
+                sqlalchemy.text(cmd), normalized=normalized))
+
+        if self.names_fts is not None and len(normalized) >= 3:
+            # Candidates are names containing query; names containing
+            # at least two pieces of query (thirds, or trigrams if
+            # query is short), so that names differing from query by
+            # a single edit are found; and names containing any of
+            # the pieces, in order of relevance. Each set is searched
+            # only if the previous ones provide fewer than `limit`
+            # candidates.
+            quote = lambda s: '"%s"' % s.replace('"', '""')
+            n = len(normalized)
+            if n >= 9:
+                pieces = [normalized[n*i//3:n*(i+1)//3] for i in range(3)]
+            else:
+                pieces = sorted(set(normalized[i:i+3] for i in range(n - 2)))
+            pieces = [quote(piece) for piece in pieces]
+            searches = [
+                (quote(normalized), ''),
+                (' OR '.join('(%s AND %s)' % pair
+                             for pair in itertools.combinations(pieces, 2)), ''),
+                (' OR '.join(pieces), 'ORDER BY rank')]
+            for match, order_by in searches:
+                if len(rowids) >= limit or not match:
+                    continue
+                cmd = sqlalchemy.text("""
+                    SELECT rowid FROM names_fts WHERE names_fts MATCH :match
+                    %s LIMIT :limit""" % order_by)
+                rowids.update(row[0] for row in self.engine.execute(
+                        cmd, match=match, limit=limit * 10))
+
+        candidates = []
+        rowids = list(rowids)
+        for i in xrange(0, len(rowids), in_chunk_size):
+            chunk = rowids[i:i+in_chunk_size]
+            params = dict(('r%i' % j, rowid) for j, rowid in enumerate(chunk))
+            cmd = sqlalchemy.text("""
+                SELECT tax_id, tax_name, is_primary, %s FROM names
+                WHERE rowid IN (%s)""" % (normalize % 'tax_name',
+                                          ', '.join(':r%i' % j for j in range(len(chunk)))))
+            for tax_id, tax_name, is_primary, name in self.engine.execute(cmd, **params):
+                score = difflib.SequenceMatcher(None, normalized, name).ratio()
+                candidates.append((unicode(tax_id), tax_name, bool(is_primary), score))
+
+        candidates.sort(key=lambda c: (-c[3], c[1], c[0]))
+        return candidates[:limit]
+
     def _get_merged(self, old_tax_id):
         """Returns tax_id into which `old_tax_id` has been merged.
 
@@ -152,24 +463,32 @@ class Taxonomy(object):
         );
         """
 
-        s = select([self.merged.c.new_tax_id], self.merged.c.old_tax_id == old_tax_id)
-        res = s.execute()
-        output = res.fetchall() or None
+        if self._merged is None:
+            self._load_merged()
 
-        if output is not None:
-            if len(output) > 1:
-                raise ValueError('There is more than one value for merged.old_tax_id = "%s"' % old_tax_id)
-            else:
-                output = output[0][0]
-        else:
-            output = old_tax_id
+        if old_tax_id in self._merged_duplicates:
+            raise ValueError('There is more than one value for merged.old_tax_id = "%s"' % old_tax_id)
 
-        return output
+        return self._merged.get(old_tax_id, old_tax_id)
+
+    def _load_merged(self):
+        """
+        Load table "merged" (which is small) into self._merged, a dict
+        of {old_tax_id: new_tax_id}.
+        """
+
+        self._merged, self._merged_duplicates = {}, set()
+        s = select([self.merged.c.old_tax_id, self.merged.c.new_tax_id])
+        for old_tax_id, new_tax_id in s.execute():
+            if old_tax_id in self._merged:
+                self._merged_duplicates.add(old_tax_id)
+            self._merged[old_tax_id] = new_tax_id
 
     def _get_lineage(self, tax_id, _level=0, merge_obsolete=True):
         """
-        Returns cached lineage from self.cached or recursively builds
-        lineage of tax_id until the root node is reached.
+        Returns cached lineage from self.cached, reads it from table
+        "lineages" if present, or recursively builds lineage of tax_id
+        until the root node is reached.
         """
         # Be sure we aren't working with an obsolete tax_id
         if merge_obsolete:
@@ -182,6 +501,8 @@ class Taxonomy(object):
         prefix = self.undef_prefix+'_'
 
         lineage = self.cached.get(tax_id)
+        if not lineage and self.lineages_table is not None:
+            lineage = self._stored_lineage(tax_id)
 
         if lineage:
             log.debug('%(indent)s tax_id "%(tax_id)s" is cached' % locals())
@@ -192,7 +513,7 @@ class Taxonomy(object):
 
             # recursively add parent_ids until we reach the root
             if parent_id != tax_id:
-                lineage = self._get_lineage(parent_id, _level+1) + lineage
+                lineage = self._get_lineage(parent_id, _level+1, merge_obsolete=False) + lineage
 
             # now that we've reached the root, rename any undefined ranks
             _parent_rank, _parent_id = None, None
@@ -204,7 +525,6 @@ class Taxonomy(object):
                     self._add_rank(_rank, _parent_rank)
 
                     lineage[i] = (_rank, _tax_id)
-                    self.cached[_tax_id] = lineage
                     log.debug('renamed undefined rank to %(_rank)s in element %(i)s of lineage of %(tax_id)s' \
                                   % locals())
 
@@ -214,6 +534,190 @@ class Taxonomy(object):
 
         return lineage
 
+    def _stored_lineage(self, tax_id):
+        """
+        Returns the lineage of tax_id from table "lineages", adding
+        it and those of its ancestors to self.cached. Returns None if
+        tax_id is not found in the table.
+        """
+
+        table = self.lineages_table
+        s = select([table.c.lineage], table.c.tax_id == tax_id)
+        output = s.execute().fetchone()
+        if not output:
+            return None
+
+        return self._cache_lineage(tax_id, output[0])
+
+    def _cache_lineage(self, tax_id, serialized):
+        """
+        Add the lineage of tax_id serialized as in table "lineages"
+        ("rank:tax_id;rank:tax_id;...") and those of its ancestors to
+        self.cached. Returns the lineage of tax_id.
+        """
+
+        prefix = self.undef_prefix+'_'
+        lineage = [tuple(node.split(':', 1)) for node in serialized.split(';')]
+        for i, (rank, _tax_id) in enumerate(lineage):
+            if rank not in self.rankset and rank.startswith(prefix):
+                self._add_rank(rank, lineage[i-1][0])
+            self.cached.setdefault(_tax_id, lineage[:i+1])
+
+        self.cached[tax_id] = lineage
+        return lineage
+
+    def _select_in(self, columns, column, values, *whereclauses):
+        """
+        Return all rows of select(columns) in which column has one of
+        values; values are passed in chunks of in_chunk_size.
+        """
+
+        values = list(values)
+        rows = []
+        for i in xrange(0, len(values), in_chunk_size):
+            s = select(columns, and_(column.in_(values[i:i+in_chunk_size]), *whereclauses))
+            rows.extend(s.execute().fetchall())
+        return rows
+
+    def _load_lineages(self, tax_ids):
+        """
+        Returns a dict of {tax_id: lineage} for each of tax_ids,
+        adding lineages to self.cached. Lineages are read from table
+        "lineages" if present; otherwise nodes are fetched one level
+        of ancestors at a time for all tax_ids at once.
+        """
+
+        lineages = {}
+        for tax_id in set(tax_ids):
+            lineage = self.cached.get(tax_id)
+            if lineage:
+                lineages[tax_id] = lineage
+
+        pending = set(tax_ids) - set(lineages)
+        table = self.lineages_table
+        if table is not None and pending:
+            for tax_id, serialized in self._select_in(
+                [table.c.tax_id, table.c.lineage], table.c.tax_id, pending):
+                lineages[tax_id] = self._cache_lineage(tax_id, serialized)
+            pending -= set(lineages)
+
+        # keys: tax_id; vals: (parent_id, rank)
+        nodes = {}
+        # lineages of ancestors; cached lineages are copied here so
+        # that they remain available if evicted from self.cached
+        built = {}
+        level = pending
+        while level:
+            rows = self._select_in(
+                [self.nodes.c.tax_id, self.nodes.c.parent_id, self.nodes.c.rank],
+                self.nodes.c.tax_id, level)
+            found = dict((tax_id, (parent_id, rank)) for tax_id, parent_id, rank in rows)
+            missing = level - set(found)
+            if missing:
+                raise KeyError('value "%s" not found in nodes.tax_id' % missing.pop())
+            nodes.update(found)
+
+            level = set()
+            for parent_id, rank in found.values():
+                if parent_id in nodes or parent_id in built:
+                    continue
+                lineage = self.cached.get(parent_id)
+                if lineage:
+                    built[parent_id] = lineage
+                else:
+                    level.add(parent_id)
+
+        for tax_id in pending:
+            lineages[tax_id] = self._lineage_from_nodes(tax_id, nodes, built)
+
+        return lineages
+
+    def _lineage_from_nodes(self, tax_id, nodes, built):
+        """
+        Returns the lineage of tax_id from built (a dict of {tax_id:
+        lineage}), or builds it from nodes (a dict of {tax_id:
+        (parent_id, rank)}) as in self._get_lineage, adding it to
+        both built and self.cached.
+        """
+
+        lineage = built.get(tax_id)
+        if not lineage:
+            parent_id, rank = nodes[tax_id]
+            lineage = []
+            if parent_id != tax_id:
+                lineage = self._lineage_from_nodes(parent_id, nodes, built)
+
+            if rank == self.undefined_rank:
+                parent_rank = lineage[-1][0]
+                rank = self.undef_prefix + '_' + parent_rank
+                self._add_rank(rank, parent_rank)
+
+            lineage = lineage + [(rank, tax_id)]
+            built[tax_id] = self.cached[tax_id] = lineage
+
+        return lineage
+
+    def _delete_stored_lineages(self, tax_id):
+        """
+        Delete rows of table "lineages" for tax_id and all of its
+        descendants; their lineages are subsequently reconstructed
+        from table "nodes".
+        """
+
+        cmd = sqlalchemy.text("""
+            DELETE FROM lineages WHERE tax_id IN (
+              WITH RECURSIVE descendants(tax_id) AS (
+                SELECT :tax_id
+                UNION
+                SELECT n.tax_id FROM nodes n
+                JOIN descendants d ON n.parent_id = d.tax_id
+              )
+              SELECT tax_id FROM descendants)""")
+        self.engine.execute(cmd, tax_id=tax_id)
+
+    def _intervals(self, tax_ids):
+        """
+        Returns a dict of {tax_id: (lft, rgt)} from table "hierarchy"
+        for each of tax_ids that is present in the table.
+        """
+
+        table = self.hierarchy
+        if table is None:
+            return {}
+
+        s = select([table.c.tax_id, table.c.lft, table.c.rgt],
+                   table.c.tax_id.in_(list(set(tax_ids))))
+        return dict((tax_id, (lft, rgt)) for tax_id, lft, rgt in s.execute())
+
+    def _delete_intervals(self, tax_ids):
+        """
+        Delete rows of table "hierarchy" for the ancestors and
+        descendants of each of tax_ids (which are about to be moved or
+        given a new child). The intervals of the remaining nodes still
+        describe their ancestors and descendants exactly; other nodes
+        are handled by walking the tree.
+        """
+
+        for tax_id in set(tax_ids):
+            cmd = sqlalchemy.text("""
+                DELETE FROM hierarchy WHERE tax_id IN (
+                  WITH RECURSIVE
+                  ancestors(tax_id) AS (
+                    SELECT :tax_id
+                    UNION
+                    SELECT n.parent_id FROM nodes n
+                    JOIN ancestors a ON n.tax_id = a.tax_id
+                  ),
+                  descendants(tax_id) AS (
+                    SELECT :tax_id
+                    UNION
+                    SELECT n.tax_id FROM nodes n
+                    JOIN descendants d ON n.parent_id = d.tax_id
+                  )
+                  SELECT tax_id FROM ancestors
+                  UNION SELECT tax_id FROM descendants)""")
+            self.engine.execute(cmd, tax_id=tax_id)
+
     def synonyms(self, tax_id=None, tax_name=None):
         if not bool(tax_id) ^ bool(tax_name):
             raise ValueError('Exactly one of tax_id and tax_name may be provided.')
@@ -254,15 +758,44 @@ class Taxonomy(object):
         if new_tax_id:
             tax_id = new_tax_id
 
-        ldict = dict(self._get_lineage(tax_id))
+        lineage = self._get_lineage(tax_id, merge_obsolete=False)
+        ldict = dict(lineage)
 
         ldict['tax_id'] = tax_id
         ldict['parent_id'], _ = self._node(tax_id)
-        ldict['rank'] = self.cached[tax_id][-1][0]
+        ldict['rank'] = lineage[-1][0]
         ldict['tax_name'] = self.primary_from_id(tax_id)
 
         return ldict
 
+    def lineages(self, tax_ids):
+        """
+        Returns a dict mapping each of tax_ids to its lineage as
+        provided by self.lineage. Lineages and primary names are
+        resolved for all tax_ids at once using a few queries for each
+        chunk of in_chunk_size tax_ids.
+        """
+
+        tax_ids = set(tax_ids)
+
+        new_tax_ids = dict((tax_id, self._get_merged(tax_id)) for tax_id in tax_ids)
+
+        found = self._load_lineages(set(new_tax_ids.values()))
+
+        names = self._primary_names(new_tax_ids.values())
+
+        lineages = {}
+        for tax_id, new_tax_id in new_tax_ids.items():
+            lineage = found[new_tax_id]
+            ldict = dict(lineage)
+            ldict['tax_id'] = new_tax_id
+            ldict['parent_id'] = lineage[-2][1] if len(lineage) > 1 else new_tax_id
+            ldict['rank'] = lineage[-1][0]
+            ldict['tax_name'] = names[new_tax_id]
+            lineages[tax_id] = ldict
+
+        return lineages
+
     def write_table(self, taxa=None, csvfile=None, full=False):
         """
         Represent the currently defined taxonomic lineages as a rectangular
@@ -275,30 +808,59 @@ class Taxonomy(object):
          * csvfile - an open file-like object (see "csvfile" argument to csv.writer)
          * full - if True (the default), includes a column for each rank in self.ranks;
            otherwise, omits ranks (columns) the are undefined for all taxa.
+
+        Lineages and primary names are fetched for all taxa at once;
+        rows are sorted by rank and tax_name and written one at a time.
         """
 
         if not taxa:
             taxa = self.cached.keys()
 
+        tax_ids = set(self._get_merged(tax_id) for tax_id in taxa)
+        lineages = self._load_lineages(tax_ids)
+        names = self._primary_names(tax_ids)
+
         # which ranks are actually represented?
         if full:
             ranks = self.ranks
         else:
-            represented = set(itertools.chain.from_iterable(
-                    [[node[0] for node in lineage] for lineage in self.cached.values()])
-            )
+            represented = set(rank for lineage in lineages.values()
+                              for rank, _ in lineage)
             ranks = [r for r in self.ranks if r in represented]
 
-        fields = ['tax_id','parent_id','rank','tax_name'] + ranks
-        writer = csv.DictWriter(csvfile, fieldnames=fields,
-                                extrasaction='ignore', quoting=csv.QUOTE_NONNUMERIC)
+        position = dict((rank, i) for i, rank in enumerate(ranks))
+
+        writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
 
         # header row
-        writer.writerow(dict(zip(fields, fields)))
-        lineages = [self.lineage(tax_id) for tax_id in taxa]
+        writer.writerow(['tax_id','parent_id','rank','tax_name'] + ranks)
+
+        order = sorted((position[lineage[-1][0]], names[tax_id], tax_id)
+                       for tax_id, lineage in lineages.iteritems())
+        for _, tax_name, tax_id in order:
+            lineage = lineages[tax_id]
+            ldict = dict(lineage)
+            parent_id = lineage[-2][1] if len(lineage) > 1 else tax_id
+            writer.writerow([tax_id, parent_id, lineage[-1][0], tax_name] +
+                            [ldict.get(rank, '') for rank in ranks])
+
+    def _primary_names(self, tax_ids):
+        """
+        Returns a dict of {tax_id: primary tax_name} for each of
+        tax_ids, raising KeyError if any is not found in table "names".
+        """
+
+        tax_ids = set(tax_ids)
+        names = dict(self._select_in(
+                [self.names.c.tax_id, self.names.c.tax_name],
+                self.names.c.tax_id, tax_ids,
+                self.names.c.is_primary == 1))
+
+        missing = tax_ids - set(names)
+        if missing:
+            raise KeyError('value "%s" not found in names.tax_id' % missing.pop())
 
-        for lin in sorted(lineages, key=lambda x: (ranks.index(x['rank']), x['tax_name'])):
-             writer.writerow(lin)
+        return names
 
     def add_source(self, name, description=None):
         """
@@ -327,6 +889,9 @@ class Taxonomy(object):
         if not source_id:
             source_id, source_is_new = self.add_source(name=source_name)
 
+        if self.hierarchy is not None:
+            self._delete_intervals([parent_id] + list(children or []))
+
         result = self.nodes.insert().execute(tax_id = tax_id,
                                              parent_id = parent_id,
                                              rank = rank,
@@ -340,12 +905,30 @@ class Taxonomy(object):
             for child in children:
                 ret = self.nodes.update(self.nodes.c.tax_id == child, {'parent_id':tax_id})
                 ret.execute()
+                if self.lineages_table is not None:
+                    self._delete_stored_lineages(child)
 
         lineage = self.lineage(tax_id)
 
         log.debug(lineage)
         return lineage
 
+    def _children(self, tax_id, ranks, exclude=None, limit=None):
+        """
+        Returns a list of up to `limit` tax_ids of children of tax_id
+        having one of ranks (or any rank if ranks is empty), omitting
+        tax_id `exclude`.
+        """
+
+        conditions = [self.nodes.c.parent_id == tax_id,
+                      or_(*[self.nodes.c.rank == r for r in ranks])]
+        if exclude is not None:
+            conditions.append(self.nodes.c.tax_id != exclude)
+        s = select([self.nodes.c.tax_id], and_(*conditions))
+        if limit:
+            s = s.limit(limit)
+        return [row[0] for row in s.execute()]
+
     def sibling_of(self, tax_id):
         """Return None or a tax_id of a sibling of *tax_id*.
 
@@ -355,12 +938,7 @@ class Taxonomy(object):
         if tax_id == None:
             return None
         parent_id, rank = self._node(tax_id)
-        s = select([self.nodes.c.tax_id],
-                   and_(self.nodes.c.parent_id == parent_id,
-                        self.nodes.c.tax_id != tax_id,
-                        self.nodes.c.rank == rank))
-        res = s.execute()
-        output = res.fetchone()
+        output = self._children(parent_id, [rank], exclude=tax_id, limit=1)
         if not output:
             log.warning('No sibling of tax_id %s with rank %s found in taxonomy' % (tax_id, rank))
             return None
@@ -370,6 +948,14 @@ class Taxonomy(object):
     def is_ancestor_of(self, node, ancestor):
         if node is None or ancestor is None:
             return False
+
+        # compare intervals if both are available
+        node = self._get_merged(node)
+        intervals = self._intervals([node, ancestor])
+        if node in intervals and ancestor in intervals:
+            lft, rgt = intervals[ancestor]
+            return lft <= intervals[node][0] <= rgt
+
         l = self.lineage(node)
         return ancestor in l.values()
 
@@ -394,11 +980,7 @@ class Taxonomy(object):
         if tax_id == None:
             return None
         parent_id, rank = self._node(tax_id)
-        s = select([self.nodes.c.tax_id],
-                   and_(self.nodes.c.parent_id == tax_id,
-                        or_(*[self.nodes.c.rank == r for r in ranks_below(rank)])))
-        res = s.execute()
-        output = res.fetchone()
+        output = self._children(tax_id, ranks_below(rank), limit=1)
         if not output:
             log.warning("No children of tax_id %s with rank below %s found in database" % (tax_id, rank))
             return None
@@ -411,19 +993,101 @@ class Taxonomy(object):
         if tax_id == None:
             return None
         parent_id, rank = self._node(tax_id)
-        s = select([self.nodes.c.tax_id],
-                   and_(self.nodes.c.parent_id == tax_id,
-                        or_(*[self.nodes.c.rank == r for r in ranks_below(rank)]))).limit(n)
-        res = s.execute()
-        output = res.fetchall()
+        output = self._children(tax_id, ranks_below(rank), limit=n)
         if not output:
             return []
         else:
-            r = [x[0] for x in output]
+            r = output
             for x in r:
                 assert self.is_ancestor_of(x, tax_id)
             return r
 
+    def descendants(self, tax_id, rank=None):
+        """
+        Returns a list of tax_ids of all nodes below tax_id, or only
+        of those having rank `rank` (see descendants_of).
+        """
+
+        return self.descendants_of([tax_id], rank)
+
+    def descendants_of(self, tax_ids, rank=None, stop_ranks=()):
+        """
+        Returns a list of the distinct tax_ids of nodes below any of
+        tax_ids, or only of those having rank `rank`. Nodes having one
+        of `stop_ranks` are included, but the nodes below them are
+        not. Nodes are found using a range scan of table "hierarchy"
+        for each of tax_ids present there, and otherwise by
+        traversing the subtrees of tax_ids in chunks of in_chunk_size
+        using a single recursive query for each chunk.
+        """
+
+        tax_ids = list(set(tax_ids))
+        stop_ranks = set(stop_ranks)
+        intervals = self._intervals(tax_ids)
+
+        found = []
+        h = self.hierarchy
+        for lft, rgt in intervals.values():
+            conditions = [h.c.lft > lft, h.c.lft < rgt]
+            if not stop_ranks:
+                if rank is not None:
+                    conditions.extend([self.nodes.c.tax_id == h.c.tax_id,
+                                       self.nodes.c.rank == rank])
+                found.extend(row[0] for row in
+                             select([h.c.tax_id], and_(*conditions)).execute())
+                continue
+            # skip the intervals of nodes below nodes having a stop rank
+            conditions.append(self.nodes.c.tax_id == h.c.tax_id)
+            s = select([h.c.tax_id, h.c.rgt, self.nodes.c.rank],
+                       and_(*conditions)).order_by(h.c.lft)
+            skip_to = lft
+            for tax_id, node_rgt, node_rank in s.execute():
+                if node_rgt < skip_to:
+                    continue
+                if rank in (None, node_rank):
+                    found.append(tax_id)
+                if node_rank in stop_ranks:
+                    skip_to = node_rgt
+
+        # the statement begins with SELECT so that an empty result is
+        # still recognized as returning rows
+        cmd = """
+            SELECT tax_id FROM nodes WHERE tax_id IN (
+              WITH RECURSIVE descendants(tax_id, rank) AS (
+                SELECT tax_id, rank FROM nodes
+                WHERE parent_id IN (%s) AND tax_id != parent_id
+                UNION
+                SELECT n.tax_id, n.rank FROM nodes n
+                JOIN descendants d ON n.parent_id = d.tax_id
+                WHERE n.tax_id != n.parent_id %s
+              )
+              SELECT tax_id FROM descendants %s)"""
+        params = dict(('s%i' % i, stop_rank) for i, stop_rank in enumerate(stop_ranks))
+        stop = ''
+        if stop_ranks:
+            stop = 'AND d.rank NOT IN (%s)' % ', '.join(':%s' % k for k in sorted(params))
+        where = ''
+        if rank is not None:
+            where = 'WHERE rank = :rank'
+            params['rank'] = rank
+
+        pending = [tax_id for tax_id in tax_ids if tax_id not in intervals]
+        for i in xrange(0, len(pending), in_chunk_size):
+            chunk = pending[i:i+in_chunk_size]
+            chunk_params = dict(('p%i' % j, tax_id) for j, tax_id in enumerate(chunk))
+            chunk_params.update(params)
+            placeholders = ', '.join(':p%i' % j for j in range(len(chunk)))
+            found.extend(row[0] for row in self.engine.execute(
+                    sqlalchemy.text(cmd % (placeholders, stop, where)), **chunk_params))
+
+        output, seen = [], set()
+        for tax_id in found:
+            tax_id = unicode(tax_id)
+            if tax_id not in seen:
+                seen.add(tax_id)
+                output.append(tax_id)
+        return output
+
     def parent_id(self, tax_id):
         if tax_id is None:
             return None
@@ -466,6 +1130,371 @@ class Taxonomy(object):
             assert self.is_ancestor_of(newc, tax_id)
             return newc
 
+class MemoryTaxonomy(Taxonomy):
+    """
+    A Taxonomy in which nodes, primary names and merged tax_ids are
+    loaded from the database once, so that lookups do not require a
+    query. Parent tax_ids and ranks are stored in arrays indexed by
+    integer tax_id; tax_ids that are not integers (eg, those of nodes
+    added using add_node) are assigned negative codes and stored in
+    dicts. Synonyms are still looked up in the database.
+
+    Changes made using add_node are applied to both the database and
+    the in-memory copy.
+    """
+
+    def __init__(self, engine, ranks, undefined_rank='no_rank', undef_prefix='below',
+                 cache=None):
+        super(MemoryTaxonomy, self).__init__(
+            engine, ranks, undefined_rank, undef_prefix, cache)
+        self._load()
+
+    def _load(self):
+        """
+        Load nodes, primary names and merged tax_ids from the database.
+        """
+
+        start = time.time()
+
+        # indices of self._rank_names; 0 identifies a missing node
+        self._rank_names = [None]
+        self._rank_codes = {}
+        # non-integer tax_ids; the code of self._other_ids[i] is -(i + 1)
+        self._other_ids = []
+        self._other_codes = {}
+        # keys: negative codes; vals: (parent code, rank index)
+        self._other_nodes = {}
+        # keys: negative codes; vals: primary name
+        self._other_names = {}
+        # keys: primary name; vals: code
+        self._name_codes = {}
+        # keys: parent code; vals: list of child codes (see _child_codes)
+        self._child_index = None
+
+        con = self.engine.raw_connection()
+        try:
+            cur = con.cursor()
+            cur.execute('SELECT max(CAST(tax_id AS INTEGER)) FROM nodes')
+            size = (cur.fetchone()[0] or 0) + 1
+            self._parents = array.array('l', [0]) * size
+            self._ranks = array.array('B', [0]) * size
+            self._names = [None] * size
+
+            # tax_ids that are integers are returned as such
+            integer = ('CASE WHEN CAST(CAST(%(c)s AS INTEGER) AS TEXT) = CAST(%(c)s AS TEXT) '
+                       'THEN CAST(%(c)s AS INTEGER) ELSE %(c)s END')
+            tax_id, parent_id = integer % {'c': 'tax_id'}, integer % {'c': 'parent_id'}
+
+            # avoid method calls for integer tax_ids in the loops below
+            parents, ranks, rank_codes = self._parents, self._ranks, self._rank_codes
+            cur.execute('SELECT %s, %s, rank FROM nodes' % (tax_id, parent_id))
+            for tax_id, parent_id, rank in cur:
+                if type(tax_id) is int and type(parent_id) is int and rank in rank_codes:
+                    parents[tax_id] = parent_id
+                    ranks[tax_id] = rank_codes[rank]
+                else:
+                    self._set_node(self._code(tax_id, add=True),
+                                   self._code(parent_id, add=True), rank)
+
+            names, name_codes = self._names, self._name_codes
+            cur.execute('SELECT %s, tax_name FROM names WHERE is_primary = 1' % (
+                    integer % {'c': 'tax_id'}))
+            for tax_id, tax_name in cur:
+                if type(tax_id) is int and tax_id < size:
+                    if names[tax_id] is None:
+                        names[tax_id] = tax_name
+                        name_codes.setdefault(tax_name, tax_id)
+                else:
+                    code = self._code(tax_id, add=True)
+                    if self._primary_name(code) is None:
+                        self._set_name(code, tax_name)
+
+        finally:
+            con.close()
+        self._load_merged()
+
+        log.info('loaded taxonomy into memory in %.2f s; peak RSS %s kB' % (
+                time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+    def _code(self, tax_id, add=False):
+        """
+        Returns the integer code of tax_id: the tax_id itself if it is
+        an integer, and a negative value otherwise. Returns None for
+        unknown non-integer tax_ids unless add is True.
+        """
+
+        if isinstance(tax_id, (int, long)):
+            return tax_id
+        if tax_id is None:
+            return None
+
+        tax_id = unicode(tax_id)
+        if tax_id.isdigit() and unicode(int(tax_id)) == tax_id:
+            return int(tax_id)
+
+        code = self._other_codes.get(tax_id)
+        if code is None and add:
+            self._other_ids.append(tax_id)
+            code = self._other_codes[tax_id] = -len(self._other_ids)
+        return code
+
+    def _tax_id(self, code):
+        return unicode(code) if code >= 0 else self._other_ids[-code - 1]
+
+    def _grow(self, code):
+        """
+        Extend the arrays so that code is a valid index.
+        """
+
+        n = code + 1 - len(self._ranks)
+        if n > 0:
+            self._parents.extend(array.array('l', [0]) * n)
+            self._ranks.extend(array.array('B', [0]) * n)
+            self._names.extend([None] * n)
+
+    def _set_node(self, code, parent_code, rank):
+        rank_code = self._rank_codes.get(rank)
+        if rank_code is None:
+            self._rank_names.append(rank)
+            rank_code = self._rank_codes[rank] = len(self._rank_names) - 1
+
+        if code < 0:
+            self._other_nodes[code] = (parent_code, rank_code)
+        else:
+            self._grow(code)
+            self._parents[code] = parent_code
+            self._ranks[code] = rank_code
+
+    def _get_node(self, code):
+        """
+        Returns (parent code, rank index), or None if there is no node
+        with the given code.
+        """
+
+        if code is None:
+            return None
+        elif code < 0:
+            return self._other_nodes.get(code)
+        elif code < len(self._ranks) and self._ranks[code]:
+            return self._parents[code], self._ranks[code]
+        else:
+            return None
+
+    def _set_name(self, code, tax_name):
+        if code < 0:
+            self._other_names[code] = tax_name
+        else:
+            self._grow(code)
+            self._names[code] = tax_name
+        self._name_codes.setdefault(tax_name, code)
+
+    def _primary_name(self, code):
+        if code is None:
+            return None
+        elif code < 0:
+            return self._other_names.get(code)
+        elif code < len(self._names):
+            return self._names[code]
+        else:
+            return None
+
+    def _child_codes(self, code):
+        """
+        Returns a list of codes of the children of the node
+        identified by code, ordered by tax_id.
+        """
+
+        if self._child_index is None:
+            self._child_index = {}
+            # integer tax_ids first, then others in the order loaded
+            for child in itertools.chain(xrange(len(self._ranks)),
+                                         sorted(self._other_nodes, reverse=True)):
+                node = self._get_node(child)
+                if node:
+                    self._child_index.setdefault(node[0], []).append(child)
+        return self._child_index.get(code, [])
+
+    def _stored_lineage(self, tax_id):
+        """
+        Lineages are reconstructed from nodes in memory rather than
+        read from table "lineages", which is only kept up to date.
+        """
+
+        return False
+
+    def _intervals(self, tax_ids):
+        """
+        Ancestors and descendants are found using the nodes in memory
+        rather than table "hierarchy", which is only kept up to date.
+        """
+
+        return {}
+
+    def _node(self, tax_id):
+        """
+        Returns parent, rank
+        """
+        if tax_id == None:
+            return None
+
+        node = self._get_node(self._code(tax_id))
+        if node is None:
+            raise KeyError('value "%s" not found in nodes.tax_id' % tax_id)
+
+        parent_code, rank_code = node
+        return self._tax_id(parent_code), self._rank_names[rank_code]
+
+    def primary_from_id(self, tax_id):
+        """
+        Returns primary taxonomic name associated with tax_id
+        """
+
+        tax_name = self._primary_name(self._code(tax_id))
+        if tax_name is None:
+            raise KeyError('value "%s" not found in names.tax_id' % tax_id)
+        return tax_name
+
+    def primary_from_name(self, tax_name):
+        """
+        Return tax_id and primary tax_name corresponding to tax_name.
+        """
+
+        code = self._name_codes.get(tax_name)
+        if code is None:
+            # may be a synonym
+            return super(MemoryTaxonomy, self).primary_from_name(tax_name)
+        return self._tax_id(code), tax_name, True
+
+    def missing_tax_ids(self, tax_ids):
+        """
+        Returns a dict mapping each of tax_ids not found in nodes to
+        the tax_id into which it has been merged, or to None.
+        """
+
+        if self._merged is None:
+            self._load_merged()
+
+        return dict((tax_id, self._merged.get(tax_id)) for tax_id in set(tax_ids)
+                    if self._get_node(self._code(tax_id)) is None)
+
+    def ranks_from_ids(self, tax_ids):
+        """
+        Returns a dict mapping each of tax_ids found in nodes to its rank.
+        """
+
+        output = {}
+        for tax_id in set(tax_ids):
+            node = self._get_node(self._code(tax_id))
+            if node is not None:
+                output[tax_id] = self._rank_names[node[1]]
+        return output
+
+    def primary_from_names(self, tax_names):
+        """
+        Returns a dict mapping each of tax_names found to a tuple
+        (tax_id, primary tax_name, is_primary); names other than
+        primary names are looked up in the database.
+        """
+
+        output, synonyms = {}, set()
+        for tax_name in set(tax_names):
+            code = self._name_codes.get(tax_name)
+            if code is None:
+                synonyms.add(tax_name)
+            else:
+                output[tax_name] = (self._tax_id(code), tax_name, True)
+        output.update(super(MemoryTaxonomy, self).primary_from_names(synonyms))
+        return output
+
+    def _children(self, tax_id, ranks, exclude=None, limit=None):
+        """
+        Returns a list of up to `limit` tax_ids of children of tax_id
+        having one of ranks (or any rank if ranks is empty), omitting
+        tax_id `exclude`.
+        """
+
+        ranks = set(ranks)
+        exclude = self._code(exclude)
+        output = []
+        for child in self._child_codes(self._code(tax_id)):
+            if child == exclude:
+                continue
+            if not ranks or self._rank_names[self._get_node(child)[1]] in ranks:
+                output.append(self._tax_id(child))
+                if len(output) == limit:
+                    break
+        return output
+
+    def descendants_of(self, tax_ids, rank=None, stop_ranks=()):
+        """
+        Returns a list of the distinct tax_ids of nodes below any of
+        tax_ids, or only of those having rank `rank`; nodes below
+        nodes having one of `stop_ranks` are not included.
+        """
+
+        output = []
+        seen = set()
+        stack = [code for code in set(self._code(tax_id) for tax_id in tax_ids)
+                 if code is not None]
+        while stack:
+            parent = stack.pop()
+            for child in self._child_codes(parent):
+                if child == parent or child in seen:
+                    continue
+                seen.add(child)
+                child_rank = self._rank_names[self._get_node(child)[1]]
+                if child_rank not in stop_ranks:
+                    stack.append(child)
+                if rank is None or child_rank == rank:
+                    output.append(self._tax_id(child))
+        return output
+
+    def _load_lineages(self, tax_ids):
+        """
+        Returns a dict of {tax_id: lineage} for each of tax_ids.
+        """
+
+        return dict((tax_id, self._get_lineage(tax_id, merge_obsolete=False))
+                    for tax_id in set(tax_ids))
+
+    def _primary_names(self, tax_ids):
+        """
+        Returns a dict of {tax_id: primary tax_name} for each of tax_ids.
+        """
+
+        return dict((tax_id, self.primary_from_id(tax_id)) for tax_id in set(tax_ids))
+
+    def lineages(self, tax_ids):
+        """
+        Returns a dict mapping each of tax_ids to its lineage as
+        provided by self.lineage.
+        """
+
+        return dict((tax_id, self.lineage(tax_id)) for tax_id in set(tax_ids))
+
+    def add_node(self, tax_id, parent_id, rank, tax_name, children=None, **kwargs):
+        """
+        Add a node to the taxonomy.
+        """
+
+        code = self._code(tax_id, add=True)
+        self._set_node(code, self._code(parent_id, add=True), rank)
+        self._set_name(code, tax_name)
+        for child in children or []:
+            child_code = self._code(child)
+            node = self._get_node(child_code)
+            if node:
+                self._set_node(child_code, code, self._rank_names[node[1]])
+        self._child_index = None
+
+        try:
+            return super(MemoryTaxonomy, self).add_node(
+                tax_id, parent_id, rank, tax_name, children=children, **kwargs)
+        except:
+            # restore the contents of the database
+            self._load()
+            raise
+
 ranks = ['species', 'genus', 'family', 'order', 'class', 'phylum', 'kingdom']
 
 def is_below(lower, upper):
@@ -1,7 +1,10 @@
 from Bio import Phylo
 from StringIO import StringIO
+import collections
+import itertools
+import random
 import unittest
-from taxtastic import algotax
+from taxtastic import algotax, taxdb
 
 class ColoredTreeTestMixin(object):
     @classmethod
@@ -69,6 +72,92 @@ class CladeColorTest3(CladeColorTestMixin, unittest.TestCase):
         None: {4},
     }
 
+def reference_color_clades(tree, colors):
+    """
+    The original implementation of algotax.color_clades, which walks up
+    from each leaf and builds a set of cut colors for each clade.
+    """
+
+    parents = {tree.root: None}
+    cut_colors = collections.defaultdict(set)
+    stack = [('down', tree.root, None)]
+    while stack:
+        phase, cur, color = stack.pop()
+        if phase == 'down':
+            if not cur.clades:
+                if cur not in colors:
+                    continue
+                stack.append(('up', cur, colors[cur]))
+            else:
+                for child in cur.clades:
+                    parents[child] = cur
+                    stack.append(('down', child, None))
+        elif phase == 'up':
+            if cur is None or color in cut_colors[cur]:
+                continue
+            cut_colors[cur].add(color)
+            stack.append(('up', parents[cur], color))
+
+    stack = [(tree.root, set())]
+    while stack:
+        node, okayed = stack.pop()
+        if not node.clades:
+            continue
+        okayed = algotax.union(cut_colors[a] & cut_colors[b]
+            for a, b in itertools.combinations(node.clades, 2)) | okayed
+        for e in node.clades:
+            e_ = cut_colors[e] & okayed
+            if e_ != cut_colors[e]:
+                stack.append((e, okayed))
+                cut_colors[e] = e_
+
+    return algotax.CladeMetadata(parents, colors, cut_colors)
+
+class CladeColorReferenceTest(unittest.TestCase):
+    """
+    color_clades agrees with the original implementation on larger trees.
+    """
+
+    def colored_leaves(self, n, block=10):
+        # leaves colored in blocks, with a few left uncolored or misplaced
+        rand = random.Random(n)
+        leaves = [Phylo.BaseTree.Clade(name=str(i)) for i in range(n)]
+        colors = {}
+        for i, leaf in enumerate(leaves):
+            if rand.random() < 0.05:
+                continue
+            colors[leaf] = i // block
+            if rand.random() < 0.05:
+                colors[leaf] = rand.randrange(max(1, n // block))
+        return leaves, colors
+
+    def check(self, tree, colors):
+        expected = reference_color_clades(tree, colors)
+        metadata = algotax.color_clades(tree, colors)
+        self.assertEqual(metadata.parents, expected.parents)
+        for node in algotax.postorder(tree.root):
+            self.assertEqual(metadata.cut_colors[node], expected.cut_colors[node])
+            self.assertEqual(node in metadata.cut_colors,
+                             bool(expected.cut_colors[node]))
+        self.assertEqual(len(metadata.cut_colors),
+                         sum(1 for c in expected.cut_colors.values() if c))
+
+    def test_balanced(self):
+        for n in [1, 2, 7, 64, 500]:
+            nodes, colors = self.colored_leaves(n)
+            while len(nodes) > 1:
+                nodes = [Phylo.BaseTree.Clade(clades=nodes[i:i + 2])
+                         for i in range(0, len(nodes), 2)]
+            self.check(Phylo.BaseTree.Tree(root=nodes[0], rooted=True), colors)
+
+    def test_deep(self):
+        for n in [2, 50, 500]:
+            leaves, colors = self.colored_leaves(n)
+            root = leaves[0]
+            for leaf in leaves[1:]:
+                root = Phylo.BaseTree.Clade(clades=[root, leaf])
+            self.check(Phylo.BaseTree.Tree(root=root, rooted=True), colors)
+
 class AlgotaxWalkTestMixin(ColoredTreeTestMixin):
     @classmethod
     def setup_class(cls):
@@ -100,6 +189,22 @@ class AlgotaxWalkTest5(AlgotaxWalkTestMixin, unittest.TestCase):
     tree = '(A,(A,(B,C)))'
     convex_tree_size = 4
 
+class AlgotaxWalkDeepTreeTest(unittest.TestCase):
+    def test_walk(self):
+        # a caterpillar tree deeper than the recursion limit, with one
+        # misplaced leaf
+        leaves = [Phylo.BaseTree.Clade(name='A' if i < 3000 else 'B')
+                  for i in range(4000)]
+        leaves[10].name = 'B'
+        root = leaves[0]
+        for leaf in leaves[1:]:
+            root = Phylo.BaseTree.Clade(clades=[root, leaf])
+        tree = Phylo.BaseTree.Tree(root=root, rooted=True)
+        colors = {n: n.name for n in leaves}
+        nodeset = algotax.walk(tree.root, algotax.color_clades(tree, colors))
+        self.assertEqual(len(nodeset), 3999)
+        self.assertNotIn(leaves[10], nodeset)
+
 class RerootingTestMixin(object):
     @classmethod
     def setup_class(cls):
@@ -135,3 +240,42 @@ class RerootingTest3(RerootingTestMixin, unittest.TestCase):
 class RerootingTest4(RerootingTestMixin, unittest.TestCase):
     tree = '((((6,7)4,5)2,3)0,1)'
     root_number = 0
+
+class CladeMrcaTest(unittest.TestCase):
+    taxtable = [
+        ('1', None, 'root', 'root'),
+        ('2', '1', 'phylum', 'P1'),
+        ('3', '2', 'genus', 'G1'),
+        ('4', '3', 'species', 'S1'),
+        ('5', '3', 'species', 'S2'),
+        ('6', '1', 'phylum', 'P2'),
+        ('7', '6', 'species', 'S3'),
+    ]
+
+    def setUp(self):
+        self.db = taxdb.Taxdb()
+        self.db.create_tables()
+        fieldnames = ['tax_id', 'parent_id', 'rank', 'tax_name',
+                      'root', 'phylum', 'genus', 'species']
+        self.db.insert_from_taxtable(
+            lambda: fieldnames,
+            [dict(zip(fieldnames, row)) for row in self.taxtable])
+        self.name_map = {'a': '4', 'b': '5', 'c': '7', 'd': '3'}
+
+    def test_lineage_index(self):
+        index = algotax.lineage_index(self.db)
+        self.assertEqual(index['1'], (None, 0))
+        self.assertEqual(index['3'], ('2', 2))
+        self.assertEqual(index['7'], ('6', 2))
+
+    def test_clade_mrcas(self):
+        tree = Phylo.read(StringIO('(((a,b)x,d)y,(c,e)z)w;'), 'newick')
+        clades = {n.name: n for n in tree.find_clades()}
+        mrcas = algotax.clade_mrcas(
+            tree.root, self.name_map, algotax.lineage_index(self.db),
+            ignore_missing_sequences=True)
+        self.assertEqual(mrcas[clades['x']], '3')
+        self.assertEqual(mrcas[clades['y']], '3')
+        self.assertEqual(mrcas[clades['z']], '7')
+        self.assertEqual(mrcas[clades['w']], '1')
+        self.assertIsNone(mrcas[clades['e']])
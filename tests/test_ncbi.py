@@ -3,6 +3,7 @@
 import os
 from os import path
 import logging
+import zipfile
 
 import taxtastic
 import taxtastic.ncbi
@@ -83,3 +84,342 @@ class TestLoadData(TestBase):
                 maxrows = self.maxrows)
             cur.execute('select * from names')
             self.assertTrue(len(list(cur.fetchall())) == self.maxrows)
+
+class TestReadArchive(TestBase):
+
+    def test01(self):
+        # rows should be identical to those obtained by reading the
+        # whole file at once, regardless of buffer size
+        zfile = zipfile.ZipFile(ncbi_data)
+        for fname in ['nodes.dmp', 'names.dmp', 'merged.dmp']:
+            expected = [line.rstrip('\t|\n').split('\t|\t')
+                        for line in zfile.read(fname).splitlines()]
+            for bufsize in [7, 64, 2 ** 20]:
+                rows = list(taxtastic.ncbi.read_archive(
+                        ncbi_data, fname, bufsize=bufsize))
+                self.assertEqual(rows, expected)
+
+class TestBulkLoad(TestBase):
+
+    def setUp(self):
+        outdir = self.mkoutdir()
+        self.dbname = os.path.join(outdir, 'taxonomy.db')
+        self.bulk_dbname = os.path.join(outdir, 'taxonomy_bulk.db')
+
+    def dump(self, con):
+        cur = con.cursor()
+        cur.execute("""select type, name, sql from sqlite_master
+                       where name not like 'sqlite_%' order by name""")
+        schema = cur.fetchall()
+        data = {}
+        for table in ['nodes', 'names', 'merged', 'source']:
+            cur.execute('select * from "%s" order by rowid' % table)
+            data[table] = cur.fetchall()
+        return schema, data
+
+    def test01(self):
+        with taxtastic.ncbi.db_connect(self.dbname) as con:
+            taxtastic.ncbi.db_load(con, ncbi_data)
+            expected = self.dump(con)
+
+        with taxtastic.ncbi.db_connect(
+            self.bulk_dbname, schema=taxtastic.ncbi.db_tables) as con:
+            taxtastic.ncbi.db_load(con, ncbi_data, bulk=True)
+            self.assertEqual(self.dump(con), expected)
+            cur = con.cursor()
+            cur.execute('pragma journal_mode')
+            self.assertEqual(cur.fetchone()[0], 'delete')
+
+    def test02(self):
+        # parallel parsing should give the same result
+        with taxtastic.ncbi.db_connect(self.dbname) as con:
+            taxtastic.ncbi.db_load(con, ncbi_data)
+            expected = self.dump(con)
+
+        with taxtastic.ncbi.db_connect(
+            self.bulk_dbname, schema=taxtastic.ncbi.db_tables) as con:
+            timings = taxtastic.ncbi.db_load(con, ncbi_data, bulk=True, jobs=3)
+            self.assertEqual(self.dump(con), expected)
+
+        stages = [stage for stage, seconds in timings]
+        self.assertIn('parse names.dmp', stages)
+        self.assertIn('insert names', stages)
+        self.assertIn('create indices', stages)
+
+    def test03(self):
+        # a malformed dump should raise an error rather than hang
+        archive = os.path.join(path.dirname(self.dbname), 'taxdmp.zip')
+        src = zipfile.ZipFile(ncbi_data)
+        dest = zipfile.ZipFile(archive, 'w')
+        for fname in ['nodes.dmp', 'names.dmp', 'merged.dmp']:
+            data = src.read(fname)
+            if fname == 'nodes.dmp':
+                data += 'malformed\n'
+            dest.writestr(fname, data)
+        dest.close()
+
+        with taxtastic.ncbi.db_connect(
+            self.bulk_dbname, schema=taxtastic.ncbi.db_tables) as con:
+            self.assertRaises(Exception, taxtastic.ncbi.db_load,
+                              con, archive, bulk=True, jobs=3)
+
+    def test04(self):
+        # a worker that died is detected
+        class _Result(object):
+            def ready(self):
+                return False
+        live = set([1234])
+        process_exists = taxtastic.ncbi._process_exists
+        taxtastic.ncbi._process_exists = live.__contains__
+        try:
+            self.assertRaises(RuntimeError, taxtastic.ncbi._check_workers,
+                              ['nodes.dmp'], {'nodes.dmp': _Result()},
+                              {'nodes.dmp': 4321})
+            taxtastic.ncbi._check_workers(
+                ['nodes.dmp'], {'nodes.dmp': _Result()}, {'nodes.dmp': 1234})
+            # workers that haven't reported a pid yet are not checked
+            taxtastic.ncbi._check_workers(['nodes.dmp'], {'nodes.dmp': _Result()}, {})
+        finally:
+            taxtastic.ncbi._process_exists = process_exists
+
+class TestUpdate(TestBase):
+
+    def setUp(self):
+        self.outdir = self.mkoutdir()
+        self.dbname = os.path.join(self.outdir, 'taxonomy.db')
+        self.archive = os.path.join(self.outdir, 'taxdmp.zip')
+
+        # write a modified copy of the archive
+        src = zipfile.ZipFile(ncbi_data)
+        dest = zipfile.ZipFile(self.archive, 'w')
+        for fname in ['nodes.dmp', 'names.dmp', 'merged.dmp']:
+            lines = src.read(fname).splitlines()
+            # remove tax_id 19
+            lines = [line for line in lines if not line.startswith('19\t')]
+            if fname == 'nodes.dmp':
+                lines = [line.replace('genus', 'subgenus')
+                         if line.startswith('20\t') else line
+                         for line in lines]
+                lines.append('21\t|\t20\t|\tspecies\t|\t\t|\t0\t|')
+            elif fname == 'names.dmp':
+                lines.append('21\t|\tNew species\t|\t\t|\tscientific name\t|')
+            elif fname == 'merged.dmp':
+                lines = [line for line in lines if not line.startswith('12\t')]
+                lines.append('19\t|\t18\t|')
+            dest.writestr(fname, '\n'.join(lines) + '\n')
+        dest.close()
+
+    def contents(self, con):
+        cur = con.cursor()
+        data = {}
+        for table in ['nodes', 'names', 'merged']:
+            cur.execute('select * from "%s"' % table)
+            data[table] = sorted(cur.fetchall())
+        return data
+
+    def test01(self):
+        with taxtastic.ncbi.db_connect(self.dbname) as con:
+            taxtastic.ncbi.db_load(con, ncbi_data)
+            original = self.contents(con)
+
+            # updating from the same archive changes nothing
+            counts = taxtastic.ncbi.db_update(con, ncbi_data)
+            self.assertEqual(self.contents(con), original)
+            for table in counts:
+                self.assertFalse(any(counts[table].values()))
+
+            counts = taxtastic.ncbi.db_update(con, self.archive)
+            self.assertEqual(counts['nodes'],
+                             {'inserted': 1, 'updated': 1, 'deleted': 1})
+            updated = self.contents(con)
+
+        with taxtastic.ncbi.db_connect(self.dbname, clobber=True) as con:
+            taxtastic.ncbi.db_load(con, self.archive)
+            self.assertEqual(updated, self.contents(con))
+
+    def test02(self):
+        # custom nodes are preserved
+        with taxtastic.ncbi.db_connect(self.dbname) as con:
+            taxtastic.ncbi.db_load(con, ncbi_data)
+            cur = con.cursor()
+            cur.execute("""insert into nodes (tax_id, parent_id, rank, source_id)
+                           values ('7_1', '6', 'species_group', 2)""")
+            cur.execute("""insert into names (tax_id, tax_name, is_primary)
+                           values ('7_1', 'Custom group', 1)""")
+            cur.execute("update nodes set parent_id = '7_1' where tax_id = '7'")
+            con.commit()
+
+            taxtastic.ncbi.db_update(con, self.archive)
+
+            cur.execute("select parent_id, source_id from nodes where tax_id = '7_1'")
+            self.assertEqual(cur.fetchone(), ('6', 2))
+            cur.execute("select tax_name from names where tax_id = '7_1'")
+            self.assertEqual(cur.fetchone(), ('Custom group',))
+            cur.execute("select parent_id from nodes where tax_id = '7'")
+            self.assertEqual(cur.fetchone(), ('7_1',))
+            cur.execute("select rank from nodes where tax_id = '20'")
+            self.assertEqual(cur.fetchone(), ('subgenus',))
+
+    def test03(self):
+        # table "lineages" is rebuilt
+        with taxtastic.ncbi.db_connect(self.dbname) as con:
+            taxtastic.ncbi.db_load(con, ncbi_data)
+            taxtastic.ncbi.db_lineages(con)
+            taxtastic.ncbi.db_update(con, self.archive)
+            updated = sorted(con.execute('select * from lineages'))
+
+        with taxtastic.ncbi.db_connect(self.dbname, clobber=True) as con:
+            taxtastic.ncbi.db_load(con, self.archive)
+            taxtastic.ncbi.db_lineages(con)
+            self.assertTrue(updated)
+            self.assertEqual(updated, sorted(con.execute('select * from lineages')))
+
+    def test04(self):
+        # table "hierarchy" is rebuilt
+        with taxtastic.ncbi.db_connect(self.dbname) as con:
+            taxtastic.ncbi.db_load(con, ncbi_data)
+            taxtastic.ncbi.db_hierarchy(con)
+            taxtastic.ncbi.db_update(con, self.archive)
+            updated = sorted(con.execute('select * from hierarchy'))
+
+        with taxtastic.ncbi.db_connect(self.dbname, clobber=True) as con:
+            taxtastic.ncbi.db_load(con, self.archive)
+            taxtastic.ncbi.db_hierarchy(con)
+            self.assertTrue(updated)
+            self.assertEqual(len(updated), len(list(con.execute('select * from hierarchy'))))
+            # intervals are nested or disjoint
+            for _, lft1, rgt1 in updated:
+                for _, lft2, rgt2 in updated:
+                    self.assertTrue(lft1 < rgt1)
+                    self.assertTrue(rgt1 < lft2 or rgt2 < lft1 or
+                                    lft1 <= lft2 < rgt2 <= rgt1 or
+                                    lft2 <= lft1 < rgt1 <= rgt2)
+
+    def test05(self):
+        # name search indices are maintained by triggers
+        with taxtastic.ncbi.db_connect(self.dbname) as con:
+            taxtastic.ncbi.db_load(con, ncbi_data)
+            taxtastic.ncbi.db_name_index(con)
+            taxtastic.ncbi.db_update(con, self.archive)
+            cur = con.cursor()
+            cur.execute("""select tax_id, normalized_name from names
+                           where normalized_name = 'new species'""")
+            self.assertEqual(cur.fetchall(), [('21', 'new species')])
+            cur.execute("""select count(*) from names
+                           where normalized_name is not lower(tax_name)""")
+            self.assertEqual(cur.fetchone()[0], 0)
+            cur.execute("""select rowid from names_fts
+                           where names_fts match '"w spec"'""")
+            rowids = cur.fetchall()
+            cur.execute("select rowid from names where tax_id = '21'")
+            self.assertEqual(rowids, cur.fetchall())
+
+class TestLineages(TestBase):
+
+    def setUp(self):
+        self.outdir = self.mkoutdir()
+
+    def test01(self):
+        # replacing the lineages of changed nodes and their
+        # descendants is equivalent to rebuilding the table
+        with taxtastic.ncbi.db_connect(ncbi_master_db) as con:
+            text_con = taxtastic.ncbi.db_convert(
+                con, os.path.join(self.outdir, 'text.db'), schema='text')
+            int_con = taxtastic.ncbi.db_convert(
+                con, os.path.join(self.outdir, 'integer.db'))
+
+        for con in [text_con, int_con]:
+            taxtastic.ncbi.db_lineages(con)
+            original = sorted(con.execute('select * from lineages'))
+            cur = con.cursor()
+            # a genus is moved, a family loses its rank, a genus is
+            # deleted and a species added
+            cur.execute("update nodes set parent_id = '613' where tax_id = '561'")
+            cur.execute("update nodes set rank = 'no_rank' where tax_id = '543'")
+            cur.execute("delete from nodes where tax_id = '642'")
+            cur.execute("""insert into nodes (tax_id, parent_id, rank, source_id)
+                           values ('999999', '561', 'species', 1)""")
+            con.commit()
+
+            taxtastic.ncbi.db_lineages(con, ['561', '543', '642', '999999'])
+            updated = sorted(con.execute('select * from lineages'))
+            taxtastic.ncbi.db_lineages(con)
+            expected = sorted(con.execute('select * from lineages'))
+            self.assertNotEqual(updated, original)
+            self.assertEqual(updated, expected)
+            lineages = dict((unicode(tax_id), lineage) for tax_id, lineage in updated)
+            self.assertTrue(lineages['561'].endswith(';below_order:543;genus:613;genus:561'))
+            self.assertNotIn('642', lineages)
+
+            taxtastic.ncbi.db_lineages(con, [])
+            self.assertEqual(sorted(con.execute('select * from lineages')), expected)
+            con.close()
+
+class TestConvert(TestBase):
+
+    def setUp(self):
+        outdir = self.mkoutdir()
+        self.dbname = os.path.join(outdir, 'taxonomy_integer.db')
+        self.text_dbname = os.path.join(outdir, 'taxonomy_text.db')
+
+    def contents(self, con):
+        cur = con.cursor()
+        data = {}
+        for table in ['nodes', 'names', 'merged', 'source']:
+            cur.execute('select * from "%s"' % table)
+            # compare tax_ids as strings
+            data[table] = sorted(tuple(unicode(x) for x in row)
+                                 for row in cur.fetchall())
+        return data
+
+    def test01(self):
+        with taxtastic.ncbi.db_connect(ncbi_master_db) as con:
+            self.assertEqual(taxtastic.ncbi.schema_name(con), 'text')
+            expected = self.contents(con)
+
+            new_con = taxtastic.ncbi.db_convert(con, self.dbname)
+            self.assertEqual(taxtastic.ncbi.schema_name(new_con), 'integer')
+            self.assertEqual(self.contents(new_con), expected)
+            cur = new_con.cursor()
+            cur.execute("select typeof(tax_id) from nodes limit 1")
+            self.assertEqual(cur.fetchone()[0], 'integer')
+
+            # ... and back again
+            text_con = taxtastic.ncbi.db_convert(
+                new_con, self.text_dbname, schema='text')
+            self.assertEqual(taxtastic.ncbi.schema_name(text_con), 'text')
+            self.assertEqual(self.contents(text_con), expected)
+
+            new_con.close()
+            text_con.close()
+
+        self.assertRaises(ValueError, taxtastic.ncbi.db_convert,
+                          None, self.dbname)
+
+    def test02(self):
+        with taxtastic.ncbi.db_connect(
+            self.dbname, schema=taxtastic.ncbi.db_tables_integer,
+            clobber=True) as con:
+            taxtastic.ncbi.db_load(con, ncbi_data, bulk=True)
+            cur = con.cursor()
+            cur.execute("select name from sqlite_master where type = 'index'")
+            indices = set(name for name, in cur.fetchall())
+            self.assertNotIn('nodes_tax_id', indices)
+            self.assertIn('nodes_parent_id', indices)
+
+    def test03(self):
+        # table "lineages" is rebuilt in the new database
+        with taxtastic.ncbi.db_connect(ncbi_master_db) as con:
+            text_con = taxtastic.ncbi.db_convert(con, self.text_dbname,
+                                                 schema='text')
+        taxtastic.ncbi.db_lineages(text_con)
+        expected = sorted(text_con.execute('select * from lineages'))
+
+        new_con = taxtastic.ncbi.db_convert(text_con, self.dbname)
+        self.assertTrue(taxtastic.ncbi.has_lineages(new_con))
+        self.assertEqual(
+            sorted((unicode(tax_id), lineage) for tax_id, lineage in
+                   new_con.execute('select * from lineages')),
+            expected)
+        new_con.close()
+        text_con.close()
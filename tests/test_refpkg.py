@@ -113,6 +113,37 @@ class TestRefpkg(unittest.TestCase):
         finally:
             shutil.rmtree(scratch)
 
+    def test_update_file_link(self):
+        scratch = tempfile.mkdtemp()
+        try:
+            pkg_path = os.path.join(scratch, 'test.refpkg')
+            r = refpkg.Refpkg(pkg_path)
+            test_file = os.path.join(scratch, 'bv_refdata.csv')
+            shutil.copyfile(config.data_path('bv_refdata.csv'), test_file)
+            md5_value = refpkg.md5file(test_file)
+
+            r.update_file('a', test_file, link=True)
+            self.assertEqual(r.file_md5('a'), md5_value)
+            self.assertTrue(os.path.samefile(r.file_abspath('a'), test_file))
+
+            r.update_file('b', test_file)
+            self.assertEqual(r.file_md5('b'), md5_value)
+            self.assertFalse(os.path.samefile(r.file_abspath('b'), test_file))
+        finally:
+            shutil.rmtree(scratch)
+
+    def test_copy_md5file(self):
+        scratch = tempfile.mkdtemp()
+        try:
+            test_file = config.data_path('bv_refdata.csv')
+            dest = os.path.join(scratch, 'copy.csv')
+            self.assertEqual(refpkg.md5file(test_file),
+                             refpkg.copy_md5file(test_file, dest))
+            with open(test_file) as a, open(dest) as b:
+                self.assertEqual(a.read(), b.read())
+        finally:
+            shutil.rmtree(scratch)
+
     def test_update_metadata(self):
         scratch = tempfile.mkdtemp()
         try:
@@ -222,6 +253,83 @@ class TestRefpkg(unittest.TestCase):
             self.assertRaises(ValueError,
                               lambda: r.rollforward())
 
+    def test_md5_cache(self):
+        with config.tempdir() as d:
+            rpkg = os.path.join(d, 'test.refpkg')
+            shutil.copytree(config.data_path('lactobacillus2-0.2.refpkg'), rpkg)
+            r = refpkg.Refpkg(rpkg)
+            cache_path = os.path.join(rpkg, r._md5_cache_name)
+            with open(cache_path) as h:
+                cache = json.load(h)
+            self.assertEqual(
+                sorted(cache), sorted(r.contents['files'].values()))
+            for key, filename in r.contents['files'].iteritems():
+                self.assertEqual(cache[filename][3], r.file_md5(key))
+
+            # A stale entry is used only if the file looks unchanged
+            filename = r.contents['files']['taxonomy']
+            cache[filename][3] = 'stale'
+            with open(cache_path, 'w') as h:
+                json.dump(cache, h)
+            self.assertRaises(ValueError, refpkg.Refpkg, rpkg)
+            self.assertTrue(refpkg.Refpkg(rpkg, verify='none'))
+            self.assertTrue(refpkg.Refpkg(rpkg, verify='full'))
+            # verify='full' replaced the stale entry
+            self.assertTrue(refpkg.Refpkg(rpkg))
+
+            cache[filename][0] += 1
+            with open(cache_path, 'w') as h:
+                json.dump(cache, h)
+            self.assertTrue(refpkg.Refpkg(rpkg))
+
+    def test_is_ill_formed_md5(self):
+        with config.tempdir() as d:
+            rpkg = os.path.join(d, 'test.refpkg')
+            shutil.copytree(config.data_path('lactobacillus2-0.2.refpkg'), rpkg)
+            refpkg.Refpkg(rpkg)
+            # change a file in place without changing its size or mtime
+            path = os.path.join(rpkg, refpkg.Refpkg(rpkg).contents['files']['phylo_model'])
+            st = os.stat(path)
+            with open(path, 'r+') as h:
+                c = h.read(1)
+                h.seek(0)
+                h.write(' ' if c != ' ' else '\n')
+            os.utime(path, (st.st_atime, st.st_mtime))
+
+            # the cache is trusted when loading the refpkg, but not by is_ill_formed
+            r = refpkg.Refpkg(rpkg)
+            self.assertFalse(r.is_invalid())
+            self.assertIn('did not match its MD5 sum', r.is_ill_formed())
+            self.assertRaises(ValueError, refpkg.Refpkg, rpkg, verify='full')
+
+    def test_hashed_once(self):
+        with config.tempdir() as d:
+            rpkg = os.path.join(d, 'test.refpkg')
+            shutil.copytree(config.data_path('lactobacillus2-0.2.refpkg'), rpkg)
+            r = refpkg.Refpkg(rpkg, verify='full')
+            hashed = []
+            md5file = refpkg.md5file
+            def counting_md5file(path):
+                hashed.append(path)
+                return md5file(path)
+            refpkg.md5file = counting_md5file
+            try:
+                # files hashed by the same Refpkg are not hashed again...
+                self.assertFalse(r.is_ill_formed())
+                self.assertEqual(hashed, [])
+                # ...unless they change
+                with open(r.file_abspath('seq_info'), 'a') as h:
+                    h.write('extra,1,1\n')
+                self.assertIn('did not match its MD5 sum', r.is_ill_formed())
+                self.assertEqual(hashed, [r.file_abspath('seq_info')])
+            finally:
+                refpkg.md5file = md5file
+
+    def test_verify_mode(self):
+        with config.tempdir() as d:
+            self.assertRaises(ValueError, refpkg.Refpkg,
+                              os.path.join(d, 'test.refpkg'), verify='some')
+
     def test_strip(self):
         with config.tempdir() as d:
             rpkg = os.path.join(d, 'test.refpkg')
@@ -239,7 +347,161 @@ class TestRefpkg(unittest.TestCase):
             self.assertEqual(r.log(), ['Stripped refpkg (removed 1 files)'] + original_log)
             self.assertFalse(os.path.exists(boris_path))
             self.assertFalse(r.is_invalid())
-            self.assertEqual(len(r.contents['files']), len(os.listdir(r.path))-1)
+            filenames = set(os.listdir(r.path))
+            filenames.discard(r._md5_cache_name)
+            self.assertEqual(len(r.contents['files']), len(filenames)-1)
+
+    def test_convert_layout(self):
+        with config.tempdir() as d:
+            rpkg = os.path.join(d, 'test.refpkg')
+            shutil.copytree(config.data_path('lactobacillus2-0.2.refpkg'), rpkg)
+            r = refpkg.Refpkg(rpkg)
+            files = dict(r.contents['files'])
+            md5s = dict(r.contents['md5'])
+
+            r.convert_layout('objects')
+            self.assertEqual(r.contents['objects'], 'objects')
+            self.assertEqual(r.contents['md5'], md5s)
+            for key, md5_value in md5s.iteritems():
+                self.assertEqual(r.file_name(key),
+                                 os.path.join('objects', md5_value))
+                self.assertEqual(refpkg.md5file(r.file_abspath(key)), md5_value)
+            self.assertFalse(refpkg.Refpkg(rpkg, verify='full').is_invalid())
+
+            # identical files are stored once
+            r.update_file('copy', r.file_abspath('taxonomy'))
+            self.assertEqual(r.file_name('copy'), r.file_name('taxonomy'))
+            self.assertEqual(r.contents['names']['copy'],
+                             r.contents['md5']['taxonomy'])
+            r.rollback()
+
+            r.strip()
+            self.assertEqual(
+                sorted(os.listdir(rpkg)),
+                sorted(['CONTENTS.json', r._md5_cache_name, 'objects']))
+            self.assertEqual(len(os.listdir(os.path.join(rpkg, 'objects'))),
+                             len(set(md5s.values())))
+
+            r.convert_layout(None)
+            self.assertEqual(r.contents['files'], files)
+            self.assertNotIn('objects', r.contents)
+            self.assertNotIn('names', r.contents)
+            r.strip()
+            self.assertFalse(os.path.exists(os.path.join(rpkg, 'objects')))
+            self.assertFalse(refpkg.Refpkg(rpkg, verify='full').is_invalid())
+
+    def test_store_object_once(self):
+        with config.tempdir() as d:
+            r = refpkg.Refpkg(os.path.join(d, 'test.refpkg'))
+            r.convert_layout('objects')
+            test_file = config.data_path('bv_refdata.csv')
+            copied = []
+            copy_md5file = refpkg.copy_md5file
+            def counting_copy_md5file(src, dest):
+                copied.append(src)
+                return copy_md5file(src, dest)
+            refpkg.copy_md5file = counting_copy_md5file
+            try:
+                r.update_file('a', test_file)
+                self.assertEqual(copied, [test_file])
+                # files already in the object directory aren't copied again
+                r.update_file('a', test_file)
+                r.update_file('b', test_file)
+                r.update_file('c', test_file, link=True)
+                self.assertEqual(copied, [test_file])
+            finally:
+                refpkg.copy_md5file = copy_md5file
+            objects = os.path.join(r.path, 'objects')
+            self.assertEqual(os.listdir(objects), [refpkg.md5file(test_file)])
+            self.assertEqual(os.stat(os.path.join(objects, refpkg.md5file(test_file))).st_nlink, 1)
+
+            # a linked file is stored as a link
+            with open(os.path.join(d, 'new.csv'), 'w') as h:
+                h.write('a,b\n')
+            r.update_file('d', os.path.join(d, 'new.csv'), link=True)
+            self.assertEqual(os.stat(r.file_abspath('d')).st_ino,
+                             os.stat(os.path.join(d, 'new.csv')).st_ino)
+            self.assertEqual(sorted(os.listdir(objects)),
+                             sorted(set(r.contents['md5'].values())))
+
+    def test_shared_objects(self):
+        with config.tempdir() as d:
+            objects = os.path.join(d, 'objects')
+            test_file = config.data_path('bv_refdata.csv')
+            rs = [refpkg.Refpkg(os.path.join(d, name))
+                  for name in ['a.refpkg', 'b.refpkg']]
+            for r in rs:
+                r.convert_layout(objects)
+                r.update_file('a', test_file)
+                self.assertEqual(r.file_abspath('a'),
+                                 os.path.join(objects, refpkg.md5file(test_file)))
+                r.strip()
+            self.assertEqual(os.listdir(objects), [refpkg.md5file(test_file)])
+            self.assertEqual(r.contents['names']['a'], 'bv_refdata.csv')
+
+    def test_is_ill_formed_jobs(self):
+        with config.tempdir() as d:
+            rpkg = os.path.join(d, 'test.refpkg')
+            shutil.copytree(config.data_path('lactobacillus2-0.2.refpkg'), rpkg)
+            r = refpkg.Refpkg(rpkg, verify='full', jobs=3)
+            self.assertFalse(r.is_ill_formed())
+            with open(r.file_abspath('seq_info'), 'a') as h:
+                h.write('extra,1,1\n')
+            r = refpkg.Refpkg(rpkg, verify='none', jobs=3)
+            self.assertEqual(
+                r.is_ill_formed(), refpkg.Refpkg(rpkg, verify='none').is_ill_formed())
+            self.assertTrue(isinstance(r.is_ill_formed(), basestring))
+
+    def test_file_checks(self):
+        import Bio.SeqIO
+        pkg = config.data_path('lactobacillus2-0.2.refpkg')
+        fasta = os.path.join(pkg, 'chosen.fasta')
+        sto = os.path.join(pkg, 'lactobacillus2.sto')
+        with open(fasta) as f:
+            fasta_names = set(s.id for s in Bio.SeqIO.parse(f, 'fasta'))
+        with open(sto) as f:
+            sto_names = set(s.id for s in Bio.SeqIO.parse(f, 'stockholm'))
+        self.assertEqual(refpkg._check_fasta(fasta), (None, fasta_names))
+        self.assertEqual(refpkg._check_stockholm(sto), (None, sto_names))
+
+        with config.tempdir() as d:
+            path = os.path.join(d, 'file')
+            def check(checker, contents):
+                with open(path, 'w') as h:
+                    h.write(contents)
+                return checker(path)
+
+            self.assertEqual(check(refpkg._check_fasta, ''), (None, set()))
+            self.assertEqual(check(refpkg._check_fasta, '>a b\nAC\n>c\nGT\n'),
+                             (None, set(['a', 'c'])))
+            self.assertTrue(check(refpkg._check_fasta, 'ACGT\n')[0])
+
+            self.assertEqual(check(refpkg._check_stockholm, ''), (None, set()))
+            self.assertEqual(
+                check(refpkg._check_stockholm,
+                      '# STOCKHOLM 1.0\n#=GS a AC x\na AC-\nb A.G\n\n'
+                      'a T\nb T\n//\n'),
+                (None, set(['a', 'b'])))
+            self.assertTrue(check(refpkg._check_stockholm, 'a ACG\n//\n')[0])
+            self.assertTrue(check(refpkg._check_stockholm,
+                                  '# STOCKHOLM 1.0\na ACG\nb AC\n//\n')[0])
+            self.assertTrue(check(refpkg._check_stockholm,
+                                  '# STOCKHOLM 1.0\n//\n')[0])
+
+            self.assertEqual(
+                check(refpkg._check_seq_info, 'seqname,tax_id\na,1\nb,2\n'),
+                (None, set(['a', 'b'])))
+            self.assertTrue(
+                check(refpkg._check_seq_info, 'seqname,tax_id\na\n')[0])
+            self.assertTrue(
+                check(refpkg._check_seq_info, 'seqname,other\na,1\n')[0])
+
+    def test_parallel_map(self):
+        self.assertEqual(refpkg.parallel_map(abs, [-1, 2, -3], jobs=2),
+                         [1, 2, 3])
+        self.assertEqual(refpkg.parallel_map(abs, [-1, 2, -3], jobs=2,
+                                             processes=True),
+                         [1, 2, 3])
 
     def test_is_ill_formed(self):
         with config.tempdir() as d:
@@ -1,14 +1,17 @@
 import sys; sys.path.insert(0, '../')
+import argparse
 import contextlib
+from StringIO import StringIO
 import unittest
 import tempfile
 import shutil
 import copy
+import csv
 import os
 
 from taxtastic import refpkg
 from taxtastic.lonely import Tree
-from taxtastic.subcommands import update, create, strip, rollback, rollforward, taxtable, check, lonelynodes, findcompany
+from taxtastic.subcommands import update, create, strip, convert_refpkg, rollback, rollforward, taxtable, check, lonelynodes, findcompany, taxids, update_taxids
 
 import config
 from config import OutputRedirectMixin
@@ -23,6 +26,8 @@ class TestUpdate(OutputRedirectMixin, unittest.TestCase):
                 refpkg=pkg_path
                 changes = ['meep='+test_file, 'hilda='+test_file]
                 metadata = False
+                link = False
+                verify = None
             update.action(_Args())
             r._sync_from_disk()
             self.assertEqual(r.contents['files']['meep'], 'bv_refdata.csv')
@@ -36,6 +41,7 @@ class TestUpdate(OutputRedirectMixin, unittest.TestCase):
                 refpkg=pkg_path
                 changes = ['meep=boris', 'hilda=vrrp']
                 metadata = True
+                verify = None
             update.action(_Args())
             r._sync_from_disk()
             self.assertEqual(r.metadata('meep'), 'boris')
@@ -61,6 +67,7 @@ class TestCreate(OutputRedirectMixin, unittest.TestCase):
                 readme = None
                 tree = None
                 taxonomy = None
+                verify = None
             create.action(_Args())
             r = refpkg.Refpkg(_Args().package_name)
             self.assertEqual(r.metadata('locus'), 'Nowhere')
@@ -87,12 +94,34 @@ class TestStrip(OutputRedirectMixin, unittest.TestCase):
 
             class _Args(object):
                 refpkg = rpkg
+                verify = None
             strip.action(_Args())
 
             r._sync_from_disk()
             self.assertEqual(r.contents['rollback'], None)
             self.assertEqual(r.contents['rollforward'], None)
 
+class TestConvertRefpkg(OutputRedirectMixin, unittest.TestCase):
+    def test_action(self):
+        with config.tempdir() as scratch:
+            rpkg = os.path.join(scratch, 'test.refpkg')
+            shutil.copytree(config.data_path('lactobacillus2-0.2.refpkg'), rpkg)
+            files = refpkg.Refpkg(rpkg).contents['files']
+
+            class _Args(object):
+                refpkg = rpkg
+                objects = 'objects'
+                flat = False
+                verify = None
+            self.assertEqual(convert_refpkg.action(_Args()), 0)
+            r = refpkg.Refpkg(rpkg)
+            self.assertEqual(r.contents['objects'], 'objects')
+
+            _Args.objects, _Args.flat = None, True
+            self.assertEqual(convert_refpkg.action(_Args()), 0)
+            r._sync_from_disk()
+            self.assertEqual(r.contents['files'], files)
+
 class TestRollback(OutputRedirectMixin, unittest.TestCase):
     maxDiff = None
     def test_rollback(self):
@@ -107,6 +136,7 @@ class TestRollback(OutputRedirectMixin, unittest.TestCase):
 
             class _Args(object):
                 refpkg = rpkg
+                verify = None
                 def __init__(self, n):
                     self.n = n
 
@@ -136,6 +166,7 @@ class TestRollforward(OutputRedirectMixin, unittest.TestCase):
 
             class _Args(object):
                 refpkg = rpkg
+                verify = None
                 def __init__(self, n):
                     self.n = n
 
@@ -182,6 +213,7 @@ class TestTaxtable(OutputRedirectMixin, unittest.TestCase):
                     seq_info = None
                     verbosity = 0
                     out_file = h
+                    in_memory = False
                 self.assertEqual(taxtable.action(_Args()), 0)
             self.assertEqual(refpkg.md5file(out), '88ed5643d4754c60d5c472ff0b298f0f')
 
@@ -195,8 +227,31 @@ class TestTaxtable(OutputRedirectMixin, unittest.TestCase):
                     seq_info = None
                     verbosity = 0
                     out_file = h
+                    in_memory = False
                 self.assertEqual(taxtable.action(_Args()), 1)
 
+    def test_taxnames(self):
+        for taxnames, status in [('Gemella;Staphylococcus aureus', 0),
+                                 ('Gemella, horace', 1)]:
+            with scratch_file() as names, scratch_file() as out:
+                with open(names, 'w') as h:
+                    h.write(taxnames + '\n')
+                with open(out, 'w') as h:
+                    class _Args(object):
+                        database_file = config.ncbi_master_db
+                        taxids = None
+                        seq_info = None
+                        verbosity = 0
+                        out_file = h
+                        in_memory = False
+                    _Args.taxnames = names
+                    self.assertEqual(taxtable.action(_Args()), status)
+                if status == 0:
+                    with open(out) as h:
+                        tax_ids = [row['tax_id'] for row in csv.DictReader(h)]
+                    self.assertIn('1378', tax_ids)
+                    self.assertIn('1280', tax_ids)
+
     def test_seqinfo(self):
         with tempfile.TemporaryFile() as tf, \
              open(config.data_path('simple_seqinfo.csv')) as ifp:
@@ -207,16 +262,91 @@ class TestTaxtable(OutputRedirectMixin, unittest.TestCase):
                 seq_info = ifp
                 out_file = tf
                 verbosity = 0
+                in_memory = False
             self.assertEqual(taxtable.action(_Args()), 0)
             # No output check at present
             self.assertTrue(tf.tell() > 0)
 
+class TestUpdateTaxids(OutputRedirectMixin, unittest.TestCase):
+    seq_info = ('seqname,tax_id\n'
+                's1,1280\ns2,30630\ns3,\ns4,buh\ns5,30630\ns6,1280\n')
+
+    def run_action(self, unknown_action, in_memory=False, chunk_size=2):
+        with scratch_file() as out:
+            class _Args(object):
+                infile = StringIO(self.seq_info)
+                database_file = config.ncbi_master_db
+                out_file = open(out, 'w')
+            _Args.unknown_action = unknown_action
+            _Args.in_memory = in_memory
+            _Args.chunk_size = chunk_size
+            try:
+                update_taxids.action(_Args())
+            finally:
+                _Args.out_file.close()
+            with open(out) as h:
+                return [(row['seqname'], row['tax_id']) for row in csv.DictReader(h)]
+
+    def test_remove(self):
+        expected = [('s1', '1280'), ('s2', '537919'), ('s3', ''),
+                    ('s4', ''), ('s5', '537919'), ('s6', '1280')]
+        self.assertEqual(self.run_action('remove'), expected)
+        self.assertEqual(self.run_action('remove', in_memory=True), expected)
+
+    def test_halt(self):
+        self.assertRaises(KeyError, self.run_action, 'halt')
+
+    def test_chunk_size(self):
+        # chunks smaller than, equal to and larger than the input
+        expected = self.run_action('remove', chunk_size=10000)
+        for chunk_size in [1, 5, 6]:
+            self.assertEqual(self.run_action('remove', chunk_size=chunk_size), expected)
+        parser = argparse.ArgumentParser()
+        update_taxids.build_parser(parser)
+        argv = [config.data_path('simple_seqinfo.csv'), '-d', 'taxonomy.db', '--chunk-size']
+        args = parser.parse_args(argv + ['1'])
+        args.infile.close()
+        self.assertEqual(args.chunk_size, 1)
+        for chunk_size in ['0', '-1', 'buh']:
+            self.assertRaises(SystemExit, parser.parse_args, argv + [chunk_size])
+
 class TestCheck(OutputRedirectMixin, unittest.TestCase):
     def test_runs(self):
         class _Args(object):
             refpkg = config.data_path('lactobacillus2-0.2.refpkg')
+            jobs = 1
+            verify = None
         self.assertEqual(check.action(_Args()), 0)
 
+    def test_jobs(self):
+        class _Args(object):
+            refpkg = config.data_path('lactobacillus2-0.2.refpkg')
+            jobs = 3
+            verify = None
+        self.assertEqual(check.action(_Args()), 0)
+
+    def test_full_by_default(self):
+        with config.tempdir() as scratch:
+            rpkg = os.path.join(scratch, 'test.refpkg')
+            shutil.copytree(config.data_path('lactobacillus2-0.2.refpkg'), rpkg)
+            # record MD5 sums in the cache, then change a file without
+            # changing its size or mtime
+            path = refpkg.Refpkg(rpkg).file_abspath('phylo_model')
+            st = os.stat(path)
+            with open(path, 'r+') as h:
+                h.write(' ' if h.read(1) != ' ' else '\n')
+            os.utime(path, (st.st_atime, st.st_mtime))
+
+            class _Args(object):
+                refpkg = rpkg
+                jobs = 1
+                verify = None
+            self.assertEqual(check.action(_Args()), 1)
+            self.assertIn('did not match its MD5 sum', sys.stdout.getvalue())
+            # MD5 sums are only left unchecked if asked to
+            _Args.verify = 'none'
+            self.assertEqual(check.action(_Args()), 0)
+
 def test_lonelynodes(capsys,tmpdir):
     t = Tree(1, rank='phylum', tax_name='a')(
              Tree(3, rank='order', tax_name='b')(
@@ -241,24 +371,42 @@ def test_lonelynodes(capsys,tmpdir):
         target = str(infile)
         output = None
         verbose = True
+        verify = None
     status = lonelynodes.action(_Args())
     assert status == 0
     out, err = capsys.readouterr()
     assert out == expected
 
 def test_findcompany(capsys):
-    class _Args(object):
-        taxdb = '../testfiles/small_taxonomy.db'
-        tax_ids = ['1239', '186801']
-        input = None
-        output = None
-        cut = True
-    status = findcompany.action(_Args())
-    out, err = capsys.readouterr()
-    assert status == 0
-    assert err == ""
-    assert out.strip() == "562\n1280"
+    for in_memory in [False, True]:
+        class _Args(object):
+            taxdb = '../testfiles/small_taxonomy.db'
+            tax_ids = ['1239', '186801']
+            input = None
+            output = None
+            cut = True
+        _Args.in_memory = in_memory
+        status = findcompany.action(_Args())
+        out, err = capsys.readouterr()
+        assert status == 0
+        assert err == ""
+        assert out.strip() == "562\n1280"
 
 
 
 
+
+def test_taxids():
+    for taxnames, fuzzy in [('Staphylococcus,Enterococcus,root,buh', False),
+                            ('staphylococcus,ENTEROCOCCUS,root,buh', True)]:
+        class _Args(object):
+            dbfile = '../testfiles/small_taxonomy.db'
+            taxnames_file = None
+            outfile = StringIO()
+            min_score = 0.8
+        # root has no species below nodes of a defined rank
+        _Args.taxnames = taxnames
+        _Args.fuzzy = fuzzy
+        taxids.action(_Args())
+        assert _Args.outfile.getvalue() == (
+            "37734 # Enterococcus casseliflavus\n1280 # Staphylococcus aureus\n")
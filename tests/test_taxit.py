@@ -120,4 +120,13 @@ class TestTaxTable(TestScriptBase):
         self.cmd_ok('taxtable -d %(taxdb)s -o %(outfile)s -t %(datadir)s/taxids1.txt')
         self.assertTrue(path.isfile(self.outfile))
 
+    def test07(self):
+        """--in-memory gives the same output"""
+        self.cmd_ok('taxtable -d %(taxdb)s -o %(outfile)s -t %(datadir)s/taxids1.txt')
+        with open(self.outfile) as f:
+            expected = f.read()
+        self.cmd_ok('taxtable -d %(taxdb)s -o %(outfile)s -t %(datadir)s/taxids1.txt --in-memory')
+        with open(self.outfile) as f:
+            self.assertEqual(f.read(), expected)
+
 
@@ -1,19 +1,24 @@
 #!/usr/bin/env python
 
+import csv
 import os
 from os import path
 import logging
 import shutil
+import sqlite3
+from StringIO import StringIO
 import unittest
 
+import sqlalchemy
 from sqlalchemy import create_engine
 
 import config
 from config import TestBase
 
 import taxtastic
-from taxtastic.taxonomy import Taxonomy, ranks_below, is_below
+from taxtastic.taxonomy import Taxonomy, MemoryTaxonomy, LineageCache, ranks_below, is_below
 import taxtastic.ncbi
+import taxtastic.taxonomy
 import taxtastic.utils
 
 log = logging
@@ -38,6 +43,32 @@ class TestTaxonomyBase(TestBase):
     def tearDown(self):
         self.engine.dispose()
 
+    def copy_db(self, *prepare):
+        """
+        Copy the test database to this test's output directory as
+        self.dbname, then apply each function in `prepare` (eg,
+        taxtastic.ncbi.db_lineages) to a connection to the copy.
+        """
+
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        shutil.copyfile(dbname, self.dbname)
+        con = sqlite3.connect(self.dbname)
+        for func in prepare:
+            func(con)
+        con.close()
+
+    def column(self, query):
+        """
+        Return the values in the first column of the result of
+        `query` on self.dbname.
+        """
+
+        con = sqlite3.connect(self.dbname)
+        try:
+            return [value for value, in con.execute(query)]
+        finally:
+            con.close()
+
 
 class TestAddNode(TestTaxonomyBase):
     """
@@ -171,3 +202,510 @@ def test_nary_subtree():
     t = tax.nary_subtree('1239')
     assert t == ['1280', '372074', '1579', '1580', '37734', '420335', '166485', '166486']
     
+
+class TestIntegerSchema(TestTaxonomyBase):
+    """
+    tax_ids are presented as strings when stored as integers
+    """
+
+    def setUp(self):
+        self.dbname = path.join(self.mkoutdir(), 'taxonomy.db')
+        con = sqlite3.connect(dbname)
+        taxtastic.ncbi.db_convert(con, self.dbname, clobber=True).close()
+        con.close()
+        super(TestIntegerSchema, self).setUp()
+
+    def test01(self):
+        self.assertEqual(self.tax._node('91061'), (u'1239', u'class'))
+        self.assertEqual(self.tax.primary_from_name('Gemella'),
+                         (u'1378', u'Gemella', True))
+        self.assertEqual(self.tax._get_merged('30630'), u'537919')
+        self.assertEqual(self.tax.missing_tax_ids(['1280', '30630', 'buh']),
+                         {'30630': u'537919', 'buh': None})
+
+        lineage = self.tax.lineage('1280')
+        self.assertEqual(lineage['parent_id'], u'1279')
+        self.assertEqual(lineage['phylum'], u'1239')
+
+    def test02(self):
+        self.tax.add_node(
+            tax_id = '1578_1',
+            parent_id = '1578',
+            rank = 'species_group',
+            tax_name = 'Lactobacillus helveticis/crispatus',
+            children = ['47770'],
+            source_id = 2
+            )
+
+        lineage = self.tax.lineage('47770')
+        self.assertEqual(lineage['parent_id'], u'1578_1')
+        self.assertEqual(lineage['genus'], u'1578')
+
+    def test03(self):
+        text = Taxonomy(create_engine('sqlite:///%s' % dbname), list(taxtastic.ncbi.ranks))
+        for tax_id, rank in [('1239', None), ('1239', 'species'), ('1', 'genus')]:
+            self.assertEqual(sorted(self.tax.descendants(tax_id, rank)),
+                             sorted(text.descendants(tax_id, rank)))
+
+class TestDescendants(TestTaxonomyBase):
+    """
+    test tax.descendants
+    """
+
+    def setUp(self):
+        self.dbname = dbname
+        super(TestDescendants, self).setUp()
+        self.tax_ids = self.column('select tax_id from nodes')
+
+    def test01(self):
+        lineages = self.tax.lineages(self.tax_ids)
+        for tax_id in ['1', '1239', '1279', '1280']:
+            for rank in [None, 'species', 'no_rank']:
+                expected = [lineage['tax_id'] for lineage in lineages.values()
+                            if lineage['tax_id'] != tax_id
+                            and tax_id in lineage.values()
+                            and rank in (None, self.tax.rank(lineage['tax_id']))]
+                self.assertEqual(sorted(self.tax.descendants(tax_id, rank)),
+                                 sorted(set(expected)))
+
+    def test02(self):
+        self.assertEqual(self.tax.descendants('1280'), [])
+        self.assertEqual(self.tax.descendants('buh'), [])
+
+class TestDescendantsOf(TestTaxonomyBase):
+    """
+    test tax.descendants_of using table "hierarchy", a recursive
+    query and MemoryTaxonomy
+    """
+
+    def setUp(self):
+        self.copy_db(taxtastic.ncbi.db_hierarchy)
+        super(TestDescendantsOf, self).setUp()
+        con = sqlite3.connect(self.dbname)
+        self.nodes = dict((tax_id, (parent_id, rank)) for tax_id, parent_id, rank in
+                          con.execute('select tax_id, parent_id, rank from nodes'))
+        con.close()
+
+    def expected(self, tax_ids, rank, stop_ranks):
+        output = set()
+        for tax_id, (parent_id, node_rank) in self.nodes.iteritems():
+            if rank not in (None, node_rank):
+                continue
+            # walk up to the root, stopping at a node of a stop rank
+            node = tax_id
+            while parent_id != node:
+                if parent_id in tax_ids:
+                    output.add(tax_id)
+                    break
+                if self.nodes[parent_id][1] in stop_ranks:
+                    break
+                node, parent_id = parent_id, self.nodes[parent_id][0]
+        return sorted(output)
+
+    def test01(self):
+        walk = Taxonomy(self.engine, list(taxtastic.ncbi.ranks))
+        walk.hierarchy = None
+        mem = MemoryTaxonomy(self.engine, list(taxtastic.ncbi.ranks))
+        self.assertTrue(self.tax.hierarchy is not None)
+        for tax_ids in [['1'], ['1239', '1578'], ['1279', '1280'], ['buh'], []]:
+            for rank in [None, 'species']:
+                for stop_ranks in [(), ('species', 'no_rank'), ('genus',)]:
+                    expected = self.expected(tax_ids, rank, stop_ranks)
+                    for tax in [self.tax, walk, mem]:
+                        found = tax.descendants_of(tax_ids, rank, stop_ranks)
+                        self.assertEqual(len(found), len(set(found)))
+                        self.assertEqual(sorted(found), expected)
+
+    def test02(self):
+        # several chunks
+        taxtastic.taxonomy.in_chunk_size = 2
+        try:
+            self.tax.hierarchy = None
+            self.assertEqual(
+                sorted(self.tax.descendants_of(['1239', '1578', '1279', '1280', '1'])),
+                self.expected(['1'], None, ()))
+        finally:
+            taxtastic.taxonomy.in_chunk_size = 500
+
+class TestBatchLineages(TestTaxonomyBase):
+    """
+    test tax.lineages
+    """
+
+    def setUp(self):
+        self.dbname = dbname
+        super(TestBatchLineages, self).setUp()
+        self.tax_ids = self.column('select tax_id from nodes')
+
+    def tearDown(self):
+        taxtastic.taxonomy.in_chunk_size = 500
+        super(TestBatchLineages, self).tearDown()
+
+    def test01(self):
+        # use several chunks
+        taxtastic.taxonomy.in_chunk_size = 7
+        single = Taxonomy(self.engine, list(taxtastic.ncbi.ranks))
+        expected = {}
+        for tax_id in self.tax_ids + ['30630']:
+            try:
+                expected[tax_id] = single.lineage(tax_id)
+            except KeyError:
+                pass
+        self.assertEqual(self.tax.lineages(expected.keys()), expected)
+        self.assertEqual(self.tax.ranks, single.ranks)
+        self.assertEqual(expected['30630']['tax_id'], '537919')
+
+    def test02(self):
+        self.assertRaises(KeyError, self.tax.lineages, ['1280', 'buh'])
+
+    def test03(self):
+        # write_table with taxa not yet in the cache
+        tax_ids = ['1280', '1279', '91061', '30630']
+        out = StringIO()
+        self.tax.write_table(tax_ids, out)
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        expected = self.tax.lineages(tax_ids)
+        self.assertEqual(sorted(row['tax_id'] for row in rows),
+                         sorted(set(lineage['tax_id'] for lineage in expected.values())))
+        self.assertEqual([row['rank'] for row in rows],
+                         ['class', 'genus', 'species', 'species'])
+        for row in rows:
+            lineage = self.tax.lineage(row['tax_id'])
+            self.assertEqual(row['tax_name'], lineage['tax_name'])
+            self.assertEqual(row['parent_id'], lineage['parent_id'])
+            self.assertEqual(row['genus'], lineage.get('genus', ''))
+
+class TestPrimaryFromNames(TestTaxonomyBase):
+    """
+    test tax.primary_from_names
+    """
+
+    def setUp(self):
+        self.dbname = dbname
+        super(TestPrimaryFromNames, self).setUp()
+        self.tax_names = self.column('select tax_name from names')
+
+    def test01(self):
+        found = self.tax.primary_from_names(self.tax_names + ['buh'])
+        self.assertNotIn('buh', found)
+        self.assertEqual(set(found), set(self.tax_names))
+        for tax_name in self.tax_names:
+            self.assertEqual(found[tax_name], self.tax.primary_from_name(tax_name))
+
+    def test02(self):
+        self.assertEqual(self.tax.primary_from_names([]), {})
+        # the temporary table is replaced on subsequent calls
+        self.assertEqual(self.tax.primary_from_names(['Gemella']),
+                         {'Gemella': ('1378', 'Gemella', True)})
+        self.assertEqual(self.tax.primary_from_names(['Gemella']),
+                         {'Gemella': ('1378', 'Gemella', True)})
+
+class TestMissingTaxIds(TestTaxonomyBase):
+    """
+    test tax.missing_tax_ids
+    """
+
+    def setUp(self):
+        self.dbname = dbname
+        super(TestMissingTaxIds, self).setUp()
+
+    def test01(self):
+        self.assertEqual(self.tax.missing_tax_ids(['1280', '1279', '30630', 'buh', 'buh']),
+                         {'30630': '537919', 'buh': None})
+
+    def test02(self):
+        self.assertEqual(self.tax.missing_tax_ids([]), {})
+        self.assertEqual(self.tax.missing_tax_ids(['1280']), {})
+
+class TestRanksFromIds(TestTaxonomyBase):
+    """
+    test tax.ranks_from_ids
+    """
+
+    def setUp(self):
+        self.dbname = dbname
+        super(TestRanksFromIds, self).setUp()
+        self.tax_ids = self.column('select tax_id from nodes')
+
+    def test01(self):
+        self.assertEqual(self.tax.ranks_from_ids(['1280', '1239', '30630', 'buh']),
+                         {'1280': 'species', '1239': 'phylum'})
+
+    def test02(self):
+        self.assertEqual(self.tax.ranks_from_ids(self.tax_ids),
+                         dict((tax_id, self.tax.rank(tax_id)) for tax_id in self.tax_ids))
+        self.assertEqual(self.tax.ranks_from_ids([]), {})
+
+class TestSearchNames(TestTaxonomyBase):
+    """
+    test tax.search_names
+    """
+
+    def setUp(self):
+        self.copy_db(taxtastic.ncbi.db_name_index)
+        super(TestSearchNames, self).setUp()
+
+    def test01(self):
+        self.assertTrue(self.tax.names_fts is not None)
+        # names differing in case or spacing
+        self.assertEqual(self.tax.search_names('  staphylococcus   AUREUS', limit=1),
+                         [('1280', 'Staphylococcus aureus', True, 1.0)])
+        # names differing by a few characters
+        tax_id, tax_name, is_primary, score = self.tax.search_names('Gemela', limit=1)[0]
+        self.assertEqual((tax_id, tax_name, is_primary), ('1378', 'Gemella', True))
+        self.assertTrue(0.8 < score < 1.0)
+        # candidates are ordered by score
+        scores = [c[3] for c in self.tax.search_names('lactobacillus', limit=20)]
+        self.assertEqual(len(scores), 20)
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertEqual(self.tax.search_names('xyz'), [])
+
+    def test02(self):
+        self.tax.add_node(
+            tax_id = '1578_1',
+            parent_id = '1578',
+            rank = 'species_group',
+            tax_name = 'Lactobacillus helveticis/crispatus',
+            source_id = 2
+            )
+        self.assertEqual(self.tax.search_names('lactobacillus helveticis/crispatus', limit=1),
+                         [('1578_1', 'Lactobacillus helveticis/crispatus', True, 1.0)])
+
+    def test03(self):
+        # only names differing in case or spacing are found without the indices
+        tax = Taxonomy(create_engine('sqlite:///%s' % dbname), list(taxtastic.ncbi.ranks))
+        self.assertTrue(tax.names_fts is None)
+        self.assertEqual(tax.search_names('  staphylococcus   AUREUS'),
+                         [('1280', 'Staphylococcus aureus', True, 1.0)])
+        self.assertEqual(tax.search_names('Gemela'), [])
+
+    def test04(self):
+        # runs of any length of any ASCII whitespace are collapsed
+        query = '\n staphylococcus' + ' ' * 30 + '\r\n\tAUREUS \x0b\x0c'
+        self.assertEqual(self.tax.search_names(query, limit=1),
+                         [('1280', 'Staphylococcus aureus', True, 1.0)])
+        self.tax.add_node(
+            tax_id = '1578_1',
+            parent_id = '1578',
+            rank = 'species_group',
+            tax_name = 'Lactobacillus' + ' ' * 17 + 'helveticis/\ncrispatus',
+            source_id = 2
+            )
+        self.assertEqual(
+            self.column("select normalized_name from names where tax_id = '1578_1'"),
+            ['lactobacillus helveticis/ crispatus'])
+        for name in [query, 'A' + ' ' * 17 + 'b', '\tA\n\nb c  ', '']:
+            normalized = self.engine.execute(sqlalchemy.text(
+                    'SELECT %s' % taxtastic.ncbi.name_normalization % ':name'),
+                                             name=name).scalar()
+            self.assertEqual(normalized, ' '.join(name.split()).lower())
+
+class TestLineages(TestTaxonomyBase):
+    """
+    lineages are read from table "lineages" when present
+    """
+
+    def setUp(self):
+        self.copy_db(taxtastic.ncbi.db_lineages)
+        self.tax_ids = self.column('select tax_id from lineages')
+        super(TestLineages, self).setUp()
+
+    def test01(self):
+        self.assertTrue(self.tax.lineages_table is not None)
+        walk = Taxonomy(self.engine, list(taxtastic.ncbi.ranks))
+        walk.lineages_table = None
+        for tax_id in self.tax_ids:
+            self.assertEqual(self.tax._get_lineage(tax_id), walk._get_lineage(tax_id))
+        self.assertEqual(self.tax.ranks, walk.ranks)
+
+    def test02(self):
+        self.tax.add_node(
+            tax_id = '1578_1',
+            parent_id = '1578',
+            rank = 'species_group',
+            tax_name = 'Lactobacillus helveticis/crispatus',
+            children = ['47770'],
+            source_id = 2
+            )
+
+        tax = Taxonomy(self.engine, taxtastic.ncbi.ranks)
+        lineage = tax.lineage('47770')
+        self.assertEqual(lineage['parent_id'], u'1578_1')
+        self.assertEqual(lineage['species_group'], u'1578_1')
+
+class TestHierarchy(TestTaxonomyBase):
+    """
+    ancestors and descendants are found using table "hierarchy" when
+    present
+    """
+
+    def setUp(self):
+        self.copy_db(taxtastic.ncbi.db_hierarchy)
+        self.tax_ids = self.column('select tax_id from nodes')
+        super(TestHierarchy, self).setUp()
+
+    def compare(self):
+        tax = Taxonomy(self.engine, list(taxtastic.ncbi.ranks))
+        walk = Taxonomy(self.engine, list(taxtastic.ncbi.ranks))
+        walk.hierarchy = None
+        for tax_id in self.tax_ids:
+            for ancestor in ['1', '2', '1239', '1578', '1578_1', '1279', tax_id]:
+                self.assertEqual(tax.is_ancestor_of(tax_id, ancestor),
+                                 walk.is_ancestor_of(tax_id, ancestor))
+            for rank in [None, 'species']:
+                self.assertEqual(sorted(tax.descendants(tax_id, rank)),
+                                 sorted(walk.descendants(tax_id, rank)))
+
+    def test01(self):
+        self.assertTrue(self.tax.hierarchy is not None)
+        self.assertEqual(len(self.tax._intervals(self.tax_ids)), len(self.tax_ids))
+        self.compare()
+
+    def test02(self):
+        self.tax.add_node(
+            tax_id = '1578_1',
+            parent_id = '1578',
+            rank = 'species_group',
+            tax_name = 'Lactobacillus helveticis/crispatus',
+            children = ['47770', '1280'],
+            source_id = 2
+            )
+        self.tax_ids.append('1578_1')
+
+        # rows are removed only for nodes above or below those changed
+        intervals = self.tax._intervals(self.tax_ids)
+        for tax_id in ['1', '1578', '47770', '1279', '1280', '1578_1']:
+            self.assertNotIn(tax_id, intervals)
+        for tax_id in ['562', '1378']:
+            self.assertIn(tax_id, intervals)
+
+        self.compare()
+
+class TestMemoryTaxonomy(TestTaxonomyBase):
+    """
+    MemoryTaxonomy gives the same results as Taxonomy
+    """
+
+    def setUp(self):
+        self.copy_db()
+        super(TestMemoryTaxonomy, self).setUp()
+        self.mem = MemoryTaxonomy(self.engine, list(taxtastic.ncbi.ranks))
+        self.tax_ids = self.column('select tax_id from nodes')
+        self.tax_names = self.column('select tax_name from names')
+        self.merged = self.column('select old_tax_id from merged')
+
+    def results(self, tax, method, *args):
+        try:
+            return getattr(tax, method)(*args)
+        except (KeyError, AssertionError), err:
+            return type(err)
+
+    def test01(self):
+        for tax_id in self.tax_ids + self.merged + ['buh']:
+            for method in ['_node', 'primary_from_id', '_get_merged', 'lineage',
+                           'sibling_of', 'child_of']:
+                self.assertEqual(self.results(self.mem, method, tax_id),
+                                 self.results(self.tax, method, tax_id))
+            self.assertEqual(self.results(self.mem, 'children_of', tax_id, 2),
+                             self.results(self.tax, 'children_of', tax_id, 2))
+        for tax_id in self.tax_ids:
+            self.assertEqual(sorted(self.mem.descendants(tax_id)),
+                             sorted(self.tax.descendants(tax_id)))
+            self.assertEqual(sorted(self.mem.descendants(tax_id, 'species')),
+                             sorted(self.tax.descendants(tax_id, 'species')))
+        for tax_name in self.tax_names + ['buh']:
+            self.assertEqual(self.results(self.mem, 'primary_from_name', tax_name),
+                             self.results(self.tax, 'primary_from_name', tax_name))
+        self.assertEqual(self.mem.primary_from_names(self.tax_names + ['buh']),
+                         self.tax.primary_from_names(self.tax_names + ['buh']))
+        self.assertEqual(self.mem.missing_tax_ids(self.tax_ids + self.merged + ['buh']),
+                         self.tax.missing_tax_ids(self.tax_ids + self.merged + ['buh']))
+        self.assertEqual(self.mem.ranks_from_ids(self.tax_ids + self.merged + ['buh']),
+                         self.tax.ranks_from_ids(self.tax_ids + self.merged + ['buh']))
+
+    def test02(self):
+        self.mem.add_node(
+            tax_id = '1578_1',
+            parent_id = '1578',
+            rank = 'species_group',
+            tax_name = 'Lactobacillus helveticis/crispatus',
+            children = ['47770', '1587'],
+            source_id = 2
+            )
+
+        self.assertEqual(self.mem.primary_from_name('Lactobacillus helveticis/crispatus'),
+                         ('1578_1', 'Lactobacillus helveticis/crispatus', True))
+        self.assertEqual(self.mem.sibling_of('47770'), '1587')
+        for tax_id in ['1578_1', '47770', '1587']:
+            self.assertEqual(self.mem.lineage(tax_id), self.tax.lineage(tax_id))
+
+        # the database is updated as well
+        self.assertEqual(self.tax._node('47770'), ('1578_1', 'species'))
+        self.assertEqual(sorted(self.mem.descendants('1578_1')), ['1587', '47770'])
+        self.assertEqual(sorted(self.mem.descendants('1578')),
+                         sorted(self.tax.descendants('1578')))
+
+        # the in-memory copy is restored if the database update fails
+        self.assertRaises(sqlalchemy.exc.IntegrityError, self.mem.add_node,
+                          tax_id = '1578', parent_id = '1578_1', rank = 'genus',
+                          tax_name = 'Duplicate', source_id = 2)
+        self.assertEqual(self.mem._node('1578'), self.tax._node('1578'))
+
+class TestLineageCache(TestTaxonomyBase):
+
+    def setUp(self):
+        self.dbname = dbname
+        super(TestLineageCache, self).setUp()
+        self.tax_ids = self.column('select tax_id from nodes')
+
+    def test01(self):
+        cache = LineageCache(capacity=2)
+        cache['a'] = [1]
+        cache['b'] = [2]
+        self.assertEqual(cache['a'], [1])
+        cache['c'] = [3] # evicts 'b', the least recently used
+        self.assertEqual(sorted(cache.keys()), ['a', 'c'])
+        self.assertEqual(cache.get('b'), None)
+        self.assertRaises(KeyError, lambda: cache['b'])
+        self.assertEqual(cache.stats(), {'size': 2, 'capacity': 2, 'hits': 1,
+                                         'misses': 2, 'evictions': 1})
+        self.assertRaises(ValueError, LineageCache, 0)
+
+    def test02(self):
+        # lineages are unaffected by eviction
+        tax = Taxonomy(self.engine, list(taxtastic.ncbi.ranks),
+                       cache=LineageCache(capacity=3))
+        for tax_id in self.tax_ids:
+            try:
+                expected = self.tax.lineage(tax_id)
+            except KeyError:
+                self.assertRaises(KeyError, tax.lineage, tax_id)
+            else:
+                self.assertEqual(tax.lineage(tax_id), expected)
+        self.assertEqual(len(tax.cached), 3)
+        self.assertTrue(tax.cached.evictions > 0)
+
+        tax_ids = [t for t in self.tax_ids if t in self.tax.cached]
+        self.assertEqual(tax.lineages(tax_ids), self.tax.lineages(tax_ids))
+        self.assertEqual(tax.ranks, self.tax.ranks)
+
+class TestMerged(TestTaxonomyBase):
+    """
+    table "merged" is queried once
+    """
+
+    def setUp(self):
+        self.dbname = dbname
+        super(TestMerged, self).setUp()
+        self.statements = []
+        sqlalchemy.event.listen(
+            self.engine, 'before_cursor_execute',
+            lambda conn, cursor, statement, *args: self.statements.append(statement))
+
+    def test01(self):
+        lineage = self.tax.lineage('30630')
+        self.assertEqual(lineage['tax_id'], '537919')
+        for tax_id in ['1280', '1279', '91061']:
+            self.tax.lineage(tax_id)
+        self.assertEqual(len([s for s in self.statements if 'merged' in s]), 1)
+        self.assertEqual(self.tax._get_merged('1280'), '1280')